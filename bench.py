@@ -0,0 +1,868 @@
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import random
+import selectors
+import statistics
+import sys
+import tempfile
+import time
+from struct import pack, unpack_from
+
+from block_rotation import ConnectionRotation, RotatingSensor
+from block_writer import BlockWriter
+from poll_scheduler import PollScheduler
+from buzzer_sequencer import encode_buzzer_frame, encode_pattern
+import jinro
+import mesh_broker
+import nomorenoknock
+from room_collector import RoomCollector, RoomPublisher
+from room_history import OCCUPIED, HistoryStore
+from room_mqtt import MqttRoomPublisher
+from sample_archive import MD_COLUMNS, TH_COLUMNS, SampleArchive
+
+# jinro・nomorenoknock のホットパスのベンチマーク
+# 実機の代わりに模擬ブロックを使い、仮想時計のイベントループで動かす。
+# 仮想時計ではスリープやタイムアウトは実時間を使わずに進むので、
+# 議論時間やフェーズのタイムアウトを含むゲーム全体も短時間で決まった結果になる。
+# 各ベンチマークは次の2つを返し、保存したベースラインと比較する。
+# - throughput: 1秒 (実時間) あたりの処理数。CPU時間の増加で下がる
+# - p99_ms: 99パーセンタイルの遅延。書き込みの模擬遅延を含むものは仮想時間、それ以外は実時間
+
+BASELINE_FILE_NAME = "bench_baseline.json"
+REGRESSION_THRESHOLD = 0.25 # ベースラインからこの割合以上悪化したら失敗
+
+# 実機の代わりに使う模擬ブロック
+# 書き込みは1台のBLEアダプタを共有するので、アダプタ単位のロックで直列化し
+# 1回あたり WRITE_LATENCY_SECONDS かかるものとして扱う
+WRITE_LATENCY_SECONDS = 0.0075 # 接続間隔7.5ms相当
+
+class SimulatedAdapter:
+    def __init__(self, write_latency=WRITE_LATENCY_SECONDS):
+        self.write_latency = write_latency
+        self.lock = asyncio.Lock()
+        self.write_count = 0
+
+class SimulatedBlock:
+    def __init__(self, adapter, address, name=None):
+        self.adapter = adapter
+        self.address = address
+        self.name = name or address
+        self.is_connected = True
+        self.last_write = None
+        self.writes = [] # 書き込まれたデータ (順番どおり)
+        self.written = asyncio.Event()
+        self.handlers = {} # {特性UUID: 通知ハンドラー}
+
+    async def connect(self):
+        self.is_connected = True
+
+    async def disconnect(self):
+        self.is_connected = False
+
+    async def start_notify(self, char_uuid, handler):
+        self.handlers[char_uuid] = handler
+
+    async def stop_notify(self, char_uuid):
+        self.handlers.pop(char_uuid, None)
+
+    async def write_gatt_char(self, char_uuid, data, response=False):
+        async with self.adapter.lock:
+            await asyncio.sleep(self.adapter.write_latency)
+            self.adapter.write_count += 1
+        self.last_write = bytes(data)
+        self.writes.append(self.last_write)
+        self.written.set()
+
+    async def notify(self, char_uuid, data):
+        # ブロックからの通知を購読中のハンドラーに渡す
+        handler = self.handlers.get(char_uuid)
+        if handler:
+            result = handler(self, bytearray(data))
+            if asyncio.iscoroutine(result):
+                await result
+
+# 仮想時計のイベントループ
+# 次のタイマーまで待つ代わりに時計をその分だけ進める (I/Oの待ちはしない)
+class VirtualClockSelector(selectors.DefaultSelector):
+    def __init__(self):
+        super().__init__()
+        self.now = 0.0
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if not events:
+            if timeout is None:
+                raise RuntimeError("仮想時計: 待っているタイマーがありません (デッドロック)")
+            self.now += timeout
+        return events
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self.clock = VirtualClockSelector()
+        super().__init__(self.clock)
+
+    def time(self):
+        return self.clock.now
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def result(operations, wall_seconds, latencies_ms, **extra):
+    return {
+        "throughput": operations / wall_seconds if wall_seconds else 0.0,
+        "p50_ms": statistics.median(latencies_ms),
+        "p99_ms": percentile(latencies_ms, 99),
+        **extra,
+    }
+
+# 卓の準備
+def make_table(seat_count, adapter):
+    # 模擬ブロックで seat_count 人の卓を作り、jinroのグローバル状態に設定する
+    player_ids = [f"player{i}" for i in range(1, seat_count + 1)]
+    jinro.PLAYER_IDS = player_ids
+    jinro.PLAYER_COUNT = seat_count
+    jinro.PLAYER_COLORS = {p_id: jinro.PLAYER_COLOR_PALETTE[i % len(jinro.PLAYER_COLOR_PALETTE)]
+                           for i, p_id in enumerate(player_ids)}
+    jinro.led_states.clear()
+    clients = {}
+    for p_id in player_ids:
+        clients[p_id] = {
+            "led": SimulatedBlock(adapter, f"{p_id}_LED"),
+            "button": SimulatedBlock(adapter, f"{p_id}_BUTTON"),
+        }
+        jinro.player_button_event_queues[p_id] = asyncio.Queue()
+    jinro.player_clients = clients
+    jinro.gpio_client = SimulatedBlock(adapter, "gpio_block")
+    jinro.motion_client = SimulatedBlock(adapter, "motion_block")
+    # 実機と同じく全ての書き込みをブロックごとの書き込みキューに通す
+    for block_id, client in jinro.all_blocks(clients):
+        jinro.block_writers[client] = BlockWriter(client, block_id)
+        jinro.block_writers[client].start()
+    jinro.buzzer.client = jinro.gpio_client
+    jinro.buzzer.writer = jinro.block_writers[jinro.gpio_client]
+    jinro.reset_event_queues()
+    return clients
+
+async def close_table():
+    jinro.buzzer.stop()
+    for client in list(jinro.led_animator.animations):
+        jinro.led_animator.cancel(client)
+    await jinro.led_animator.wait_idle()
+    await asyncio.gather(*[writer.close() for writer in jinro.block_writers.values()])
+    jinro.block_writers.clear()
+
+# 卓のプレイヤーの代わりにボタンと動きブロックを操作する
+# ボタンは読まれずに残っている押下がなければ短押し・長押しを送り、
+# 動きブロックは今のターンが待っている向きを送る
+TURN_ORIENTATIONS = {
+    "役職配布": jinro.ORIENTATION_LEFT,
+    "夜の活動時間": jinro.ORIENTATION_UP,
+    "昼の議論時間": jinro.ORIENTATION_RIGHT,
+    "投票時間": jinro.ORIENTATION_BACK,
+}
+LONG_PRESS_RATE = 0.3 # 押下のうち長押しの割合
+PLAYER_TICK_SECONDS = 0.2
+
+async def play_table(clients, rng):
+    for client in [jinro.motion_client] + [p_data["button"] for p_data in clients.values()]:
+        client.handlers.clear()
+    await jinro.motion_client.start_notify(jinro.NOTIFICATION_CHAR_UUID, jinro.motion_notification_handler)
+    for p_id, p_data in clients.items():
+        await p_data["button"].start_notify(jinro.NOTIFICATION_CHAR_UUID, jinro.button_notification_handler_factory(p_id))
+    while True:
+        orientation = TURN_ORIENTATIONS.get(jinro.current_turn)
+        if orientation:
+            await jinro.motion_client.notify(jinro.NOTIFICATION_CHAR_UUID,
+                                             [jinro.NOTIF_ID_MOTION_ORIENTATION, 0x00, orientation])
+        for p_id, p_data in clients.items():
+            if jinro.player_button_event_queues[p_id].empty():
+                state = 0x02 if rng.random() < LONG_PRESS_RATE else 0x01
+                await p_data["button"].notify(jinro.NOTIFICATION_CHAR_UUID, [jinro.NOTIF_ID_BUTTON_EVENT, state])
+        await asyncio.sleep(PLAYER_TICK_SECONDS)
+
+# ベンチマーク
+def bench_notify_decode(iterations=20000, batch=100):
+    # 通知のデコード (ボタン・動き・温湿度・人感) 1件あたりの処理時間
+    jinro.player_button_event_queues["player1"] = asyncio.Queue()
+    button_handler = jinro.button_notification_handler_factory("player1")
+    th_data = bytearray(pack('<BBBBhh', 0x01, 0x00, 0x00, 0x00, 235, 48))
+    md_data = bytearray([0x01, 0x00, 0x00, 0x01])
+    motion_data = bytearray([jinro.NOTIF_ID_MOTION_ORIENTATION, 0x00, jinro.ORIENTATION_UP])
+    button_data = bytearray([jinro.NOTIF_ID_BUTTON_EVENT, 0x01])
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations // batch):
+        batch_started = time.perf_counter()
+        for _ in range(batch // 4):
+            nomorenoknock.on_receive_th_notify(None, th_data)
+            nomorenoknock.on_receive_md_notify(None, md_data)
+            jinro.motion_notification_handler(None, motion_data)
+            coro = button_handler(None, button_data)
+            try:
+                coro.send(None) # 待ちの発生しない put を同期的に最後まで進める
+            except StopIteration:
+                pass
+        latencies.append((time.perf_counter() - batch_started) * 1000 / batch)
+        jinro.reset_event_queues()
+    return result(iterations, time.perf_counter() - started, latencies)
+
+def bench_command_encode(iterations=20000, batch=100):
+    # LED・ブザー・人感ブロックの設定コマンド1件あたりの作成時間
+    colors = jinro.PLAYER_COLOR_PALETTE
+    latencies = []
+    started = time.perf_counter()
+    for i in range(iterations // batch):
+        batch_started = time.perf_counter()
+        for j in range(batch // 4):
+            jinro.encode_led_frame(colors[j % len(colors)], j % 2 == 0)
+            encode_buzzer_frame(440, 500, 200 + j)
+            encode_pattern(jinro.BUZZER_PATTERNS["turn"])
+            md_request = pack('<BBBBHH', 0x01, 0x00, 0x01, 0x10, 500, 500)
+            md_request + pack('B', nomorenoknock.checksum(md_request))
+        latencies.append((time.perf_counter() - batch_started) * 1000 / batch)
+    return result(iterations, time.perf_counter() - started, latencies)
+
+async def bench_led_fanout(seat_count=12, rounds=100):
+    # 卓の全LEDを同時に切り替えて全て書き込み終わるまでの時間 (仮想時間)
+    loop = asyncio.get_running_loop()
+    adapter = SimulatedAdapter()
+    clients = make_table(seat_count, adapter)
+    leds = [p_data["led"] for p_data in clients.values()]
+    latencies = []
+    started = time.perf_counter()
+    for i in range(rounds):
+        color = jinro.PLAYER_COLOR_PALETTE[i % len(jinro.PLAYER_COLOR_PALETTE)]
+        fanout_started = loop.time()
+        await asyncio.gather(*[jinro.set_led_state(led, color) for led in leds])
+        latencies.append((loop.time() - fanout_started) * 1000)
+    wall = time.perf_counter() - started
+    await close_table()
+    return result(rounds * seat_count, wall, latencies, writes=adapter.write_count)
+
+async def bench_selection_feedback(seat_count, presses=50):
+    # 短押しから選択中のプレイヤーのLEDが点灯するまでの時間 (仮想時間)
+    loop = asyncio.get_running_loop()
+    adapter = SimulatedAdapter()
+    clients = make_table(seat_count, adapter)
+    chooser_id = "player1"
+    debounce = jinro.SELECTION_DEBOUNCE_SECONDS
+    jinro.SELECTION_DEBOUNCE_SECONDS = 0
+    select_task = asyncio.create_task(jinro.select_target(clients, chooser_id, "ベンチマーク"))
+    player_list = list(clients.keys())
+    latencies = []
+    writes_before = adapter.write_count
+    started = time.perf_counter()
+    for press in range(1, presses + 1):
+        target = clients[player_list[press % seat_count]]["led"]
+        target.written.clear()
+        press_started = loop.time()
+        jinro.player_button_event_queues[chooser_id].put_nowait(0x01)
+        await target.written.wait()
+        latencies.append((loop.time() - press_started) * 1000)
+        # 次の押下の前に残りの書き込み (前の選択の消灯) を終わらせる
+        await asyncio.sleep(adapter.write_latency * 2)
+    wall = time.perf_counter() - started
+    writes_per_press = (adapter.write_count - writes_before) / presses
+    jinro.player_button_event_queues[chooser_id].put_nowait(0x02)
+    await select_task
+    jinro.SELECTION_DEBOUNCE_SECONDS = debounce
+    await close_table()
+    return result(presses, wall, latencies, writes_per_press=writes_per_press)
+
+async def bench_button_dispatch(seat_count=12, rounds=200):
+    # 全員が wait_for_button_press で待っているところに通知を届け、待ちが戻るまでの時間 (実時間)
+    adapter = SimulatedAdapter()
+    clients = make_table(seat_count, adapter)
+    handlers = {p_id: jinro.button_notification_handler_factory(p_id) for p_id in clients}
+    press = bytearray([jinro.NOTIF_ID_BUTTON_EVENT, 0x01])
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(rounds):
+        waiters = [asyncio.create_task(jinro.wait_for_button_press(p_data["button"], timeout=jinro.PHASE_TIMEOUT_SECONDS))
+                   for p_data in clients.values()]
+        await asyncio.sleep(0) # 全員が待ち始めてから押す
+        round_started = time.perf_counter()
+        for handler in handlers.values():
+            await handler(None, press)
+        assert all(await asyncio.gather(*waiters))
+        latencies.append((time.perf_counter() - round_started) * 1000 / seat_count)
+    wall = time.perf_counter() - started
+    await close_table()
+    return result(rounds * seat_count, wall, latencies)
+
+async def bench_voting(seat_count=12, rounds=20, seed=1):
+    # 投票時間ターン全体 (投票・集計・結果の点滅) の実時間
+    rng = random.Random(seed)
+    adapter = SimulatedAdapter()
+    clients = make_table(seat_count, adapter)
+    jinro.current_turn = "投票時間"
+    players = asyncio.create_task(play_table(clients, rng))
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(rounds):
+        round_started = time.perf_counter()
+        most_voted = await jinro.voting_phase(clients)
+        latencies.append((time.perf_counter() - round_started) * 1000)
+        assert most_voted and len(jinro.player_votes) == seat_count
+    wall = time.perf_counter() - started
+    players.cancel()
+    await asyncio.gather(players, return_exceptions=True)
+    await close_table()
+    return result(rounds, wall, latencies)
+
+async def bench_jinro_game(seat_count=12, games=3, seed=1):
+    # 模擬プレイヤーでゲームを最初から最後まで遊ぶ (1ゲームあたりの実時間)
+    loop = asyncio.get_running_loop()
+    random.seed(seed)
+    rng = random.Random(seed)
+    adapter = SimulatedAdapter()
+    clients = make_table(seat_count, adapter)
+    jinro.ROLES = (["占い師", "怪盗"] + ["人狼"] * max(2, seat_count // 4) + ["市民"] * seat_count)[:seat_count + 2]
+    players = asyncio.create_task(play_table(clients, rng))
+    latencies = []
+    game_minutes = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint_path = os.path.join(tmp_dir, jinro.CHECKPOINT_FILE_NAME)
+        started = time.perf_counter()
+        for _ in range(games):
+            game_started = time.perf_counter()
+            virtual_started = loop.time()
+            jinro.current_turn = "リセット"
+            await jinro.run_game(clients, None, checkpoint_path)
+            latencies.append((time.perf_counter() - game_started) * 1000)
+            game_minutes.append((loop.time() - virtual_started) / 60)
+            jinro.reset_event_queues()
+        wall = time.perf_counter() - started
+    players.cancel()
+    await asyncio.gather(players, return_exceptions=True)
+    await close_table()
+    return result(games, wall, latencies, game_minutes=statistics.mean(game_minutes), writes=adapter.write_count)
+
+class SimulatedRoom:
+    # 部屋の1日: 9時〜18時はほぼ在室、それ以外はまれに人が通る (在室状況は2〜15分ごとに変わる)
+    # 人感ブロックは書き込まれた通知モードの間隔で通知し、1回だけの通知の要求にも応える
+    # 温湿度は1分ごとと、データ要求を受けたときに通知し、動きブロックは昼休みに1回裏返して戻す
+    def __init__(self, th, md, ac, rng):
+        self.th = th
+        self.md = md
+        self.ac = ac
+        self.rng = rng
+        self.elapsed = 0.0
+        self.md_interval = nomorenoknock.MD_FIXED_INTERVAL_MS / 1000
+        self.md_frames = 0
+        self.md_writes_seen = 0
+        self.th_writes_seen = 0
+        self.occupied = False
+        self.next_presence_change = 0.0
+        self.next_th = 0.0
+        self.ac_events = [(12 * 3600, 0x04), (13 * 3600, 0x03)]
+
+    async def md_frame(self):
+        self.md_frames += 1
+        await self.md.notify(nomorenoknock.CORE_NOTIFY_UUID, [0x01, 0x00, 0x00, 0x01 if self.occupied else 0x00])
+
+    async def read_md_modes(self):
+        for data in self.md.writes[self.md_writes_seen:]:
+            if len(data) >= 8 and data[0] == 0x01 and data[1] == 0x00:
+                if data[3] == nomorenoknock.MD_MODE_CONTINUOUS:
+                    self.md_interval = unpack_from('<H', data, 4)[0] / 1000
+                elif data[3] == nomorenoknock.MD_MODE_ONCE:
+                    await self.md_frame()
+        self.md_writes_seen = len(self.md.writes)
+
+    async def th_frame(self):
+        temperature = int(220 + 30 * self.rng.random())
+        await self.th.notify(nomorenoknock.CORE_NOTIFY_UUID, pack('<BBBBhh', 0x01, 0x00, 0x00, 0x00, temperature, 45))
+
+    async def read_th_requests(self):
+        # 温湿度ブロックはデータ要求に通知で応える
+        for data in self.th.writes[self.th_writes_seen:]:
+            if data == nomorenoknock.TH_REQUEST:
+                await self.th_frame()
+        self.th_writes_seen = len(self.th.writes)
+
+    async def run(self, seconds):
+        loop = asyncio.get_running_loop()
+        end = self.elapsed + seconds
+        while self.elapsed < end:
+            step_started = loop.time()
+            await self.read_md_modes()
+            await self.read_th_requests()
+            if self.elapsed >= self.next_presence_change:
+                hour = (self.elapsed / 3600) % 24
+                self.occupied = self.rng.random() < (0.8 if 9 <= hour < 18 else 0.02)
+                self.next_presence_change = self.elapsed + self.rng.uniform(120, 900)
+            await self.md_frame()
+            if self.elapsed >= self.next_th:
+                await self.th_frame()
+                self.next_th += 60
+            while self.ac_events and self.elapsed >= self.ac_events[0][0]:
+                _, orientation = self.ac_events.pop(0)
+                await self.ac.notify(nomorenoknock.CORE_NOTIFY_UUID, [0x01, 0x03, orientation])
+            await asyncio.sleep(self.md_interval)
+            self.elapsed += loop.time() - step_started
+
+class RecordingMqttClient:
+    # MQTTブローカーの代わりに、送ったメッセージを数える (paho の Client.publish と同じ引数)
+    def __init__(self):
+        self.topics = {}
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.topics[topic] = self.topics.get(topic, 0) + 1
+
+async def bench_nomorenoknock_day(days=1, seed=1, mqtt=False):
+    # 模擬ブロックで main_loop を1日分動かす (1時間分あたりの実時間)
+    # 人感ブロックの1時間あたりの通知数を、以前の固定モードの通知数と並べて表示する
+    # mqtt=True なら部屋の状態をMQTTにも送り、1分あたりの送信数をブロックからの通知数と並べる
+    rng = random.Random(seed)
+    adapter = SimulatedAdapter()
+    blocks = {sn: SimulatedBlock(adapter, sn) for sn in (nomorenoknock.SN_TH, nomorenoknock.SN_MD, nomorenoknock.SN_AC)}
+
+    async def find_block(serial_number):
+        return blocks[serial_number]
+
+    saved = (nomorenoknock.find_block, nomorenoknock.BleakClient, nomorenoknock.CSV_FILE_NAME)
+    nomorenoknock.find_block = find_block
+    nomorenoknock.BleakClient = lambda device, **kwargs: device
+    room = SimulatedRoom(*blocks.values(), rng)
+    latencies = []
+    mqtt_client = RecordingMqttClient()
+    if mqtt:
+        nomorenoknock.mqtt = MqttRoomPublisher(client=mqtt_client)
+    notifications = nomorenoknock.th_frame_count + nomorenoknock.md_frame_count
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        nomorenoknock.CSV_FILE_NAME = os.path.join(tmp_dir, "room_status.csv")
+        monitor = asyncio.create_task(nomorenoknock.main_loop())
+        await asyncio.sleep(0)
+        started = time.perf_counter()
+        for _ in range(days * 24):
+            hour_started = time.perf_counter()
+            await room.run(3600)
+            latencies.append((time.perf_counter() - hour_started) * 1000)
+        wall = time.perf_counter() - started
+        monitor.cancel()
+        await asyncio.gather(monitor, return_exceptions=True)
+        await nomorenoknock.stop_all_blocks()
+    nomorenoknock.find_block, nomorenoknock.BleakClient, nomorenoknock.CSV_FILE_NAME = saved
+    nomorenoknock.mqtt = None
+    loop_iterations = days * 24 * 3600 / 15
+    md_frames_per_hour = room.md_frames / (days * 24)
+    fixed_frames_per_hour = 3600 * 1000 / nomorenoknock.MD_FIXED_INTERVAL_MS
+    extra = {}
+    if mqtt:
+        minutes = days * 24 * 60
+        notifications = nomorenoknock.th_frame_count + nomorenoknock.md_frame_count - notifications
+        extra = dict(mqtt_publishes_per_min=sum(mqtt_client.topics.values()) / minutes,
+                     notifications_per_min=notifications / minutes, mqtt_topics=len(mqtt_client.topics))
+    return result(loop_iterations, wall, latencies, simulated_hours=days * 24,
+                  md_frames_per_hour=md_frames_per_hour, md_frames_saved_per_hour=fixed_frames_per_hour - md_frames_per_hour,
+                  **extra)
+
+async def run_broker_commands(commands, concurrency, block_count):
+    # 模擬ブロックを持つブローカーを立て、Unixソケット越しに書き込みコマンドを送る
+    adapter = SimulatedAdapter(write_latency=0)
+    blocks = {f"{1000000 + i}": SimulatedBlock(adapter, f"{1000000 + i}", f"MESH-100LE{1000000 + i}")
+              for i in range(block_count)}
+
+    async def connect(serial, disconnected_callback):
+        return blocks[serial], blocks[serial].name
+
+    broker = mesh_broker.Broker(connect=connect)
+    latencies = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "broker.sock")
+        await broker.serve(path)
+        client = await mesh_broker.BrokerClient.connect(path)
+        await client.open(blocks)
+        serials = list(blocks)
+        window = asyncio.Semaphore(concurrency)
+
+        async def send(i):
+            async with window:
+                command_started = time.perf_counter()
+                await client.write(serials[i % block_count], mesh_broker.WRITE_CHAR_UUID, jinro.encode_led_frame(jinro.PLAYER_COLOR_PALETTE[i % len(jinro.PLAYER_COLOR_PALETTE)]))
+                latencies.append((time.perf_counter() - command_started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[send(i) for i in range(commands)])
+        wall = time.perf_counter() - started
+        await client.close()
+        await broker.close()
+    delivered = sum(len(block.writes) for block in blocks.values()) - block_count # 接続時の機能有効化コマンドを除く
+    return result(commands, wall, latencies, concurrency=concurrency, delivered=delivered)
+
+def bench_broker_commands(commands=5000, concurrency=32, block_count=4):
+    # ブローカーのソケット越しの書き込みコマンドの処理数 (1秒あたり)
+    # 実際のソケットI/Oを待つので、仮想時計ではなく別スレッドの通常のイベントループで動かす
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        return pool.submit(asyncio.run, run_broker_commands(commands, concurrency, block_count)).result()
+
+# 接続の入れ替えで読む部屋
+# 接続に CONNECT_SECONDS かかり、1回だけの読み取り要求には RESPONSE_SECONDS 後に通知で応えるブロック
+CONNECT_SECONDS = 1.5
+RESPONSE_SECONDS = 0.2
+
+class SimulatedSensorBlock(SimulatedBlock):
+    def __init__(self, adapter, address, reading):
+        super().__init__(adapter, address)
+        self.reading = reading
+        self.is_connected = False
+
+    async def write_gatt_char(self, char_uuid, data, response=False):
+        await super().write_gatt_char(char_uuid, data, response)
+        await asyncio.sleep(RESPONSE_SECONDS)
+        await self.notify(nomorenoknock.CORE_NOTIFY_UUID, self.reading)
+
+async def bench_rotation_staleness(room_count, slots=nomorenoknock.ROTATION_SLOTS, hours=2):
+    # room_count 部屋の温湿度・人感ブロックを slots 本の接続で入れ替えながら hours 時間読む
+    # p99_ms は読む直前の古さ (仮想時間) の99パーセンタイル、worst_room_s は一番古くなった部屋の最大値
+    adapter = SimulatedAdapter()
+    blocks = {}
+
+    async def connect(serial):
+        await asyncio.sleep(CONNECT_SECONDS)
+        await blocks[serial].connect()
+        return blocks[serial]
+
+    rotation = ConnectionRotation(connect, slots)
+    for room in range(room_count):
+        th_serial, md_serial = f"TH{room:04d}", f"MD{room:04d}"
+        blocks[th_serial] = SimulatedSensorBlock(adapter, th_serial, pack('<BBBBhh', 0x01, 0x00, 0x00, 0x00, 235, 48))
+        blocks[md_serial] = SimulatedSensorBlock(adapter, md_serial, [0x01, 0x00, 0x01, 0x01])
+        rotation.add(RotatingSensor(f"room{room}", "TH", th_serial, nomorenoknock.TH_FRESHNESS_SECONDS,
+                                    nomorenoknock.TH_REQUEST, nomorenoknock.is_th_reading))
+        rotation.add(RotatingSensor(f"room{room}", "MD", md_serial, nomorenoknock.MD_FRESHNESS_SECONDS,
+                                    nomorenoknock.encode_md_mode(nomorenoknock.MD_MODE_ONCE, request_id=0x01),
+                                    nomorenoknock.is_md_reading))
+    started = time.perf_counter()
+    rotation.start()
+    await asyncio.sleep(hours * 3600)
+    await rotation.stop()
+    wall = time.perf_counter() - started
+    staleness = [sample * 1000 for sensor in rotation.sensors for sample in sensor.staleness.samples]
+    worst_by_room = {}
+    for sensor in rotation.sensors:
+        worst_by_room[sensor.room] = max(worst_by_room.get(sensor.room, 0.0), sensor.staleness.max)
+    on_target = sum(1 for sensor in rotation.sensors if sensor.staleness.percentile(99) <= sensor.freshness_seconds * 1.1)
+    return result(len(staleness), wall, staleness, rooms=room_count, slots=slots,
+                  worst_room_s=max(worst_by_room.values()), sensors_on_target=f"{on_target}/{len(rotation.sensors)}")
+
+async def bench_poll_stagger(stagger, block_count=64, periods=20):
+    # block_count 台の温湿度ブロックに同じ周期でデータ要求を出し、要求から通知までの時間を計る
+    # 書き込みは1台のアダプタで直列になるので、ずらさないと後ろの要求ほど待たされる
+    # 途中で1/4のブロックが抜けて戻り、位相の割り当て直しも通す
+    loop = asyncio.get_running_loop()
+    adapter = SimulatedAdapter()
+    reading = pack('<BBBBhh', 0x01, 0x00, 0x00, 0x00, 235, 48)
+    blocks = {f"{'staggered' if stagger else 'aligned'}.room{i}.TH": SimulatedSensorBlock(adapter, f"TH{i:04d}", reading)
+              for i in range(block_count)}
+    scheduler = PollScheduler(nomorenoknock.TH_POLL_SECONDS, stagger=stagger)
+
+    def poll_factory(block):
+        async def poll():
+            done = loop.create_future()
+            block.handlers[nomorenoknock.CORE_NOTIFY_UUID] = lambda sender, data: done.done() or done.set_result(None)
+            await block.write_gatt_char(nomorenoknock.CORE_WRITE_UUID, nomorenoknock.TH_REQUEST, response=True)
+            await done
+        return poll
+
+    for name, block in blocks.items():
+        scheduler.add(name, poll_factory(block))
+    started = time.perf_counter()
+    scheduler.start()
+    leaving = list(blocks)[:block_count // 4]
+    await asyncio.sleep(nomorenoknock.TH_POLL_SECONDS * periods / 2)
+    for name in leaving:
+        scheduler.remove(name)
+    await asyncio.sleep(nomorenoknock.TH_POLL_SECONDS * 2)
+    for name in leaving:
+        scheduler.add(name, poll_factory(blocks[name]))
+    await asyncio.sleep(nomorenoknock.TH_POLL_SECONDS * (periods / 2 - 2))
+    await scheduler.stop()
+    wall = time.perf_counter() - started
+    latencies = [sample for entry in scheduler.entries.values() for sample in entry.latency.samples]
+    return result(len(latencies), wall, latencies, blocks=block_count, stagger=stagger,
+                  failed=scheduler.failed.value, skipped=scheduler.skipped.value)
+
+COLLECTOR_TICK_SECONDS = 0.001 # 負荷試験で変化を送る間隔
+UPDATES_PER_TICK = 10          # 1回の間隔で起こる変化の数 (合わせて最大1万件/秒ほど)
+
+async def run_collector_load(host_count, rooms_per_host, updates, seed):
+    # host_count 台の監視ホストが合わせて updates 回、ランダムな部屋の状態を変えて集約サーバに送る
+    # 最後に全件を送り直し、集約サーバの表が各ホストの状態と一致するかを確かめる
+    rng = random.Random(seed)
+    published = {} # {(ホストID, 部屋ID): 送った時刻} (同じ周回の変化はまとめて1回と数える)
+    latencies = []
+
+    def on_update(host_id, room_id, fields):
+        sent_at = published.pop((host_id, room_id), None)
+        if sent_at is not None:
+            latencies.append((time.perf_counter() - sent_at) * 1000)
+
+    collector = await RoomCollector.listen(("127.0.0.1", 0), on_update=on_update)
+    address = collector.transport.get_extra_info("sockname")
+    publishers = [await RoomPublisher.connect(f"host{h}", address) for h in range(host_count)]
+    # 送信数のカウンタは全ての送信側で共有しているので、始める前の値との差を取る
+    sent_before = publishers[0].sent.value
+    truth = {}
+    started = time.perf_counter()
+    for i in range(updates):
+        publisher = rng.choice(publishers)
+        room_id = f"{publisher.host_id}-room{rng.randrange(rooms_per_host):03d}"
+        status = truth.setdefault(room_id, {'occupancy': '空室', 'temperature': 'N/A', 'humidity': 'N/A', 'entry_start_time': ''})
+        if rng.random() < 0.5:
+            status['occupancy'] = '使用中' if status['occupancy'] == '空室' else '空室'
+        else:
+            status['temperature'] = f"{rng.randint(180, 280) / 10} ℃"
+        published.setdefault((publisher.host_id, room_id), time.perf_counter())
+        publisher.publish(room_id, status)
+        if i % UPDATES_PER_TICK == UPDATES_PER_TICK - 1:
+            await asyncio.sleep(COLLECTOR_TICK_SECONDS) # 同じ周回の変化をまとめて送らせる
+    await asyncio.sleep(0.05)
+    for publisher in publishers:
+        publisher.send_full()
+    await asyncio.sleep(0.2)
+    wall = time.perf_counter() - started
+    mismatched = sum(1 for room_id, status in truth.items()
+                     if {field: collector.rooms.get(room_id, {}).get(field) for field in status} != status)
+    sent = publishers[0].sent.value - sent_before
+    for publisher in publishers:
+        publisher.close()
+    collector.close()
+    return result(updates, wall, latencies or [0.0], rooms=len(truth), hosts=host_count, sent=sent,
+                  datagrams=collector.datagrams.value, lost=collector.lost.value, mismatched_rooms=mismatched)
+
+def bench_collector_load(host_count=8, rooms_per_host=50, updates=20000, seed=1):
+    # 集約サーバが受け付ける部屋の状態の変化の数 (1秒あたり) と、送ってから表に入るまでの時間
+    # 実際のUDP通信を待つので、仮想時計ではなく別スレッドの通常のイベントループで動かす
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        return pool.submit(asyncio.run, run_collector_load(host_count, rooms_per_host, updates, seed)).result()
+
+HISTORY_TIMEZONES = ["UTC", "Asia/Tokyo", "America/New_York", "Asia/Kolkata", "Australia/Adelaide", "Asia/Kathmandu"]
+
+def history_timezone_mismatches(tz, rng, days=30, queries=300):
+    # タイムゾーン tz で days 日分の在室状況の変化を書き、2〜8日の範囲で集計表を使う問い合わせと
+    # 変化の記録だけを数える問い合わせを比べて、答えが違った回数を返す
+    saved_tz = os.environ.get("TZ")
+    os.environ["TZ"] = tz
+    time.tzset()
+    try:
+        end = time.time()
+        start = end - days * 86400
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = HistoryStore(os.path.join(tmp_dir, "history.db"))
+            ts, occupied = start, False
+            while ts < end:
+                store.record_occupancy("room", OCCUPIED if occupied else '空室', ts)
+                occupied = not occupied
+                ts += rng.uniform(120, 3600)
+            store.flush()
+            mismatches = 0
+            for _ in range(queries):
+                query_start = rng.uniform(start, end - 8 * 86400)
+                query_end = query_start + rng.uniform(2 * 86400, 8 * 86400)
+                if abs(store.occupied_seconds("room", query_start, query_end, now=end)
+                       - store.scan_occupied_seconds("room", query_start, query_end, now=end)) > 1e-3:
+                    mismatches += 1
+            store.close()
+    finally:
+        if saved_tz is None:
+            os.environ.pop("TZ", None)
+        else:
+            os.environ["TZ"] = saved_tz
+        time.tzset()
+    return mismatches
+
+def bench_history_year(rooms=2, queries=200, seed=1):
+    # 1年分の在室状況の変化 (2〜60分ごと) と温湿度 (5分ごと) を書き、在室時間の問い合わせを計る
+    # throughput は書き込みの件数/秒、p50・p99 は1週間〜1年の範囲の問い合わせの時間
+    # 集計表を使う問い合わせと、変化の記録だけを数える問い合わせの答えが一致することも確かめる
+    # (1時間単位でない時差のタイムゾーンも含めて、HISTORY_TIMEZONES のそれぞれで確かめる)
+    rng = random.Random(seed)
+    end = time.time()
+    start = end - 365 * 86400
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = HistoryStore(os.path.join(tmp_dir, "history.db"))
+        records = 0
+        write_started = time.perf_counter()
+        for room in range(rooms):
+            ts, occupied = start, False
+            while ts < end:
+                store.record_occupancy(f"room{room}", OCCUPIED if occupied else '空室', ts)
+                occupied = not occupied
+                ts += rng.uniform(120, 3600)
+                records += 1
+            for ts in range(int(start), int(end), 300):
+                store.record_sample(f"room{room}", 20 + 5 * rng.random(), 40 + rng.randrange(20), ts)
+                records += 1
+        store.flush()
+        write_wall = time.perf_counter() - write_started
+        latencies = []
+        mismatches = 0
+        for i in range(queries):
+            query_start = rng.uniform(start, end - 7 * 86400)
+            query_end = rng.uniform(query_start + 7 * 86400, end)
+            room = f"room{rng.randrange(rooms)}"
+            query_started = time.perf_counter()
+            seconds = store.occupied_seconds(room, query_start, query_end, now=end)
+            latencies.append((time.perf_counter() - query_started) * 1000)
+            if i % 20 == 0 and abs(seconds - store.scan_occupied_seconds(room, query_start, query_end, now=end)) > 1e-3:
+                mismatches += 1
+        scan_started = time.perf_counter()
+        store.scan_occupied_seconds("room0", start, end, now=end)
+        scan_ms = (time.perf_counter() - scan_started) * 1000
+        store.close()
+    if hasattr(time, "tzset"):
+        mismatches += sum(history_timezone_mismatches(tz, rng) for tz in HISTORY_TIMEZONES)
+    return result(records, write_wall, latencies, records=records, year_scan_ms=scan_ms, mismatches=mismatches)
+
+def bench_archive_months(days=90, queries=200, compress=False, seed=1):
+    # days 日分の人感 (平均4秒ごと) と温湿度 (1分ごと) の生のサンプルを書き、開き直して範囲の問い合わせを計る
+    # throughput は書き込みの行数/秒、p50・p99 は1日〜1か月の範囲の人感の平均の問い合わせの時間
+    rng = random.Random(seed)
+    start = 1.7e9
+    end = start + days * 86400
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        md = SampleArchive(tmp_dir, "md", MD_COLUMNS, compress)
+        th = SampleArchive(tmp_dir, "th", TH_COLUMNS, compress)
+        write_started = time.perf_counter()
+        ts, presence = start, 0
+        while ts < end:
+            if rng.random() < 0.01:
+                presence ^= 1
+            md.append(ts, presence)
+            ts += rng.uniform(0.5, 7.5)
+        for ts in range(int(start), int(end), 60):
+            th.append(ts, 220 + rng.randrange(60), 40 + rng.randrange(20))
+        md.close()
+        th.close()
+        write_wall = time.perf_counter() - write_started
+        rows = sum(entry[2] for archive in (md, th) for entry in archive.chunks)
+        size = os.path.getsize(md.data_path) + os.path.getsize(th.data_path)
+
+        md = SampleArchive(tmp_dir, "md", MD_COLUMNS, compress)
+        latencies = []
+        for _ in range(queries):
+            query_start = rng.uniform(start, end - 30 * 86400)
+            query_end = query_start + rng.uniform(86400, 30 * 86400)
+            query_started = time.perf_counter()
+            md.mean("presence", query_start, query_end)
+            latencies.append((time.perf_counter() - query_started) * 1000)
+        all_started = time.perf_counter()
+        md.mean("presence", start, end)
+        all_ms = (time.perf_counter() - all_started) * 1000
+        md.close()
+    return result(rows, write_wall, latencies, rows=rows, bytes_per_row=size / rows, all_days_ms=all_ms, compress=compress)
+
+# 実行と比較
+def regressions(results, baseline, threshold):
+    # ベースラインより throughput が threshold 以上下がったか、p99 が threshold 以上伸びたものを返す
+    found = []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if current["throughput"] < base["throughput"] * (1 - threshold):
+            found.append(f"{name}: throughput {base['throughput']:.1f} -> {current['throughput']:.1f}/s")
+        if current["p99_ms"] > base["p99_ms"] * (1 + threshold):
+            found.append(f"{name}: p99 {base['p99_ms']:.4f} -> {current['p99_ms']:.4f}ms")
+    return found
+
+def save_baseline(path, results):
+    # 書きかけのファイルが残らないよう置き換えで書く
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"recorded_at": time.strftime('%Y-%m-%d %H:%M:%S'), "python": sys.version.split()[0],
+                   "benchmarks": results}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def report(name, bench_result):
+    extra = " ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}"
+                     for k, v in bench_result.items() if k not in ("throughput", "p50_ms", "p99_ms"))
+    print(f"{name:<28} {bench_result['throughput']:>12.1f}/s p50={bench_result['p50_ms']:9.4f}ms "
+          f"p99={bench_result['p99_ms']:9.4f}ms {extra}")
+
+async def main(args):
+    benchmarks = {
+        "notify_decode": lambda: bench_notify_decode(),
+        "command_encode": lambda: bench_command_encode(),
+        "led_fanout": lambda: bench_led_fanout(),
+        "button_dispatch": lambda: bench_button_dispatch(),
+        "voting_phase": lambda: bench_voting(),
+        "jinro_game": lambda: bench_jinro_game(games=args.games),
+        "nomorenoknock_day": lambda: bench_nomorenoknock_day(),
+        "nomorenoknock_day_mqtt": lambda: bench_nomorenoknock_day(mqtt=True),
+        "broker_commands": lambda: bench_broker_commands(),
+        "poll_staggered": lambda: bench_poll_stagger(True),
+        "poll_aligned": lambda: bench_poll_stagger(False),
+        "collector_load": lambda: bench_collector_load(),
+        "history_year": lambda: bench_history_year(),
+        "archive_months": lambda: bench_archive_months(),
+        "archive_months_zlib": lambda: bench_archive_months(compress=True),
+    }
+    for seat_count in args.seats:
+        benchmarks[f"selection_feedback_{seat_count}"] = (
+            lambda seat_count=seat_count: bench_selection_feedback(seat_count, args.presses))
+    for room_count in args.rooms:
+        benchmarks[f"rotation_staleness_{room_count}"] = (
+            lambda room_count=room_count: bench_rotation_staleness(room_count, args.slots))
+    names = args.only or list(benchmarks)
+    unknown = [name for name in names if name not in benchmarks]
+    if unknown:
+        raise SystemExit(f"不明なベンチマーク: {', '.join(unknown)} (選べるもの: {', '.join(benchmarks)})")
+
+    print(f"模擬書き込み遅延: {WRITE_LATENCY_SECONDS * 1000:.1f}ms/回")
+    results = {}
+    for name in names:
+        # ゲームの進行表示は計測の邪魔になるので捨てる
+        with contextlib.redirect_stdout(io.StringIO()):
+            bench_result = benchmarks[name]()
+            if asyncio.iscoroutine(bench_result):
+                bench_result = await bench_result
+        results[name] = bench_result
+        report(name, bench_result)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="jinro・nomorenoknockのホットパスのベンチマーク (模擬ブロック使用)")
+    parser.add_argument("--seats", type=int, nargs="+", default=[4, 8, 12], help="選択フィードバックを計測する人数")
+    parser.add_argument("--presses", type=int, default=50)
+    parser.add_argument("--rooms", type=int, nargs="+", default=[1, 8, 32, 64],
+                        help="接続の入れ替えで鮮度を計測する部屋数")
+    parser.add_argument("--slots", type=int, default=nomorenoknock.ROTATION_SLOTS, help="入れ替えに使う接続の数")
+    parser.add_argument("--games", type=int, default=3, help="jinro_game で遊ぶゲーム数")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="指定したベンチマークだけ実行する")
+    parser.add_argument("--baseline", default=BASELINE_FILE_NAME, help="ベースラインのファイル (JSON)")
+    parser.add_argument("--save-baseline", action="store_true", help="今回の結果をベースラインとして保存する")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="ベースラインからの悪化をこの割合まで許容する")
+    args = parser.parse_args()
+
+    loop = VirtualClockLoop()
+    try:
+        results = loop.run_until_complete(main(args))
+    finally:
+        loop.close()
+
+    if args.save_baseline:
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as f:
+                results = {**json.load(f)["benchmarks"], **results}
+        save_baseline(args.baseline, results)
+        print(f"ベースラインを保存しました: {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)["benchmarks"]
+        found = regressions(results, baseline, args.threshold)
+        if found:
+            print(f"ベースラインから{args.threshold:.0%}以上悪化しました:")
+            for line in found:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"ベースライン ({args.baseline}) からの悪化はありません。")
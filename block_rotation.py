@@ -0,0 +1,187 @@
+import asyncio
+
+import mesh_metrics
+
+# 接続の入れ替え (タイムスライス)
+# 変化の遅いセンサー (温湿度、定期通知の人感) は接続し続けずに、順番に
+# 接続 → 1回だけの読み取り要求 → 通知を受け取る → 切断 を繰り返す。
+# 同時に使う接続は slots 本までなので、アダプタの接続数の上限より多くの部屋を見られる。
+# センサーごとに鮮度の目標 (freshness_seconds) を持ち、期限の近いものから読む。
+# 読み取りのたびに、前の読み取りからの経過 (読む直前の古さ) を記録する。
+
+NOTIFY_CHAR_UUID = '72c90003-57a9-4d40-b746-534e22ec9f9e'
+WRITE_CHAR_UUID = '72c90004-57a9-4d40-b746-534e22ec9f9e'
+CONNECT_TIMEOUT_SECONDS = 30.0 # 探して接続し終わるまで待つ秒数 (ブロックが見つからなくても接続を塞ぎ続けない)
+READ_TIMEOUT_SECONDS = 10.0 # 読み取り要求から通知が届くまで待つ秒数
+RETRY_SECONDS = 30.0        # 読めなかったセンサーを次に試すまでの秒数
+READ_SECONDS_INITIAL = 3.0  # 接続から切断までにかかる時間の初期見積もり (実測で更新する)
+DUE_SLACK_SECONDS = 0.001   # 期限までこれより短ければ待たずに読む
+
+class RotatingSensor:
+    def __init__(self, room, kind, serial, freshness_seconds, request, accept, on_reading=None):
+        # request: 接続後に書く1回だけの読み取り要求
+        # accept(data): 待っている通知かどうか、on_reading(data): 読めた通知を受け取る関数
+        self.room = room
+        self.kind = kind
+        self.serial = serial
+        self.freshness_seconds = freshness_seconds
+        self.request = request
+        self.accept = accept
+        self.on_reading = on_reading
+        self.last_reading = None # 最後に読めた時刻 (loop.time())
+        self.next_due = 0.0
+        self.busy = False
+        self.refresh_requested = False # 読んでいる間に refresh() された (読み終わったらすぐにもう一度読む)
+        self.staleness = mesh_metrics.Histogram() # 読む直前の古さ (秒)
+        self.failures = 0
+
+    @property
+    def name(self):
+        return f"{self.room}.{self.kind}"
+
+class ConnectionRotation:
+    def __init__(self, connect, slots=1, read_timeout=READ_TIMEOUT_SECONDS, retry_seconds=RETRY_SECONDS,
+                 connect_timeout=CONNECT_TIMEOUT_SECONDS):
+        # connect(serial): 接続して機能を有効化したクライアント (失敗なら None) を返すコルーチン関数
+        self.connect = connect
+        self.slots = slots
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retry_seconds = retry_seconds
+        self.sensors = []
+        self.tasks = []
+        self.started = None
+        self.read_seconds = READ_SECONDS_INITIAL
+        self.changed = asyncio.Event()
+        self.reads = mesh_metrics.counter("rotation.reads")
+        self.failed = mesh_metrics.counter("rotation.failures")
+        mesh_metrics.gauge("rotation.max_age", lambda: max(self.ages().values(), default=0.0))
+
+    def add(self, sensor):
+        sensor.next_due = asyncio.get_running_loop().time()
+        self.sensors.append(sensor)
+        self._wake()
+        mesh_metrics.gauge(f"rotation.{sensor.name}.age", lambda: self.age(sensor))
+        return sensor
+
+    def remove(self, sensor):
+        if sensor in self.sensors:
+            self.sensors.remove(sensor)
+
+    def refresh(self, sensor):
+        # 次の空いた接続ですぐに読む (状態が変わったらしいとき)
+        if sensor.busy:
+            sensor.refresh_requested = True # 今の読み取りの後で next_due を上書きされないよう、読み終わってから読み直す
+            return
+        sensor.next_due = asyncio.get_running_loop().time()
+        self._wake()
+
+    def start(self):
+        self.started = asyncio.get_running_loop().time()
+        self.tasks = [asyncio.create_task(self._run_slot(), name=f"rotation/{i}") for i in range(self.slots)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def age(self, sensor, now=None):
+        # 最後の読み取りからの経過秒数 (まだ読めていなければ見張りを始めてから)
+        if now is None:
+            now = asyncio.get_running_loop().time()
+        since = sensor.last_reading if sensor.last_reading is not None else self.started
+        return now - since if since is not None else 0.0
+
+    def ages(self, now=None):
+        # 部屋ごとの一番古いセンサーの経過秒数
+        ages = {}
+        for sensor in self.sensors:
+            ages[sensor.room] = max(ages.get(sensor.room, 0.0), self.age(sensor, now))
+        return ages
+
+    def report(self, now):
+        lines = [f"接続の入れ替え: {len(self.sensors)}センサー / {self.slots}接続, "
+                 f"1回 {self.read_seconds:.1f}秒, 読み取り {self.reads.value}回 (失敗 {self.failed.value}回)"]
+        for sensor in self.sensors:
+            staleness = sensor.staleness.snapshot()
+            lines.append(f"  {sensor.name}: 今 {self.age(sensor, now):.0f}秒前, 読む直前の古さ p50 {staleness['p50']:.0f}秒 "
+                         f"p99 {staleness['p99']:.0f}秒 最大 {staleness['max']:.0f}秒 (目標 {sensor.freshness_seconds:.0f}秒)")
+        return "\n".join(lines)
+
+    def _wake(self):
+        # 待っているスロットを全て起こす (待ち始めたイベントを set し、次の待ちには新しいイベントを使う)
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def _next_sensor(self):
+        idle = [sensor for sensor in self.sensors if not sensor.busy]
+        return min(idle, key=lambda sensor: sensor.next_due, default=None)
+
+    async def _run_slot(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            sensor = self._next_sensor()
+            delay = sensor.next_due - loop.time() if sensor else None
+            if delay is None or delay > DUE_SLACK_SECONDS:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            sensor.busy = True
+            sensor.refresh_requested = False
+            try:
+                ok = await self._read(sensor)
+            finally:
+                sensor.busy = False
+            if sensor.refresh_requested:
+                sensor.refresh_requested = False
+                sensor.next_due = loop.time()
+            elif ok:
+                # 目標の鮮度に間に合うよう、読むのにかかる時間だけ早めに始める
+                sensor.next_due = sensor.last_reading + max(0.0, sensor.freshness_seconds - self.read_seconds)
+            else:
+                sensor.next_due = loop.time() + self.retry_seconds
+
+    async def _read(self, sensor):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            client = await asyncio.wait_for(self.connect(sensor.serial), self.connect_timeout)
+        except Exception as e:
+            # 見つからない・接続できないブロックで接続を塞ぎ続けず、読めなかったものとして後で試し直す
+            print(f"{sensor.name}の接続エラー: {e!r}")
+            client = None
+        if client is None:
+            sensor.failures += 1
+            self.failed.inc()
+            return False
+        reading = loop.create_future()
+
+        def handler(sender, data):
+            if not reading.done() and sensor.accept(data):
+                reading.set_result(bytes(data))
+
+        try:
+            await client.start_notify(NOTIFY_CHAR_UUID, handler)
+            await client.write_gatt_char(WRITE_CHAR_UUID, sensor.request, response=True)
+            data = await asyncio.wait_for(reading, self.read_timeout)
+        except Exception as e:
+            print(f"{sensor.name}の読み取りエラー: {e!r}")
+            sensor.failures += 1
+            self.failed.inc()
+            return False
+        finally:
+            try:
+                await client.disconnect()
+            except Exception:
+                pass
+        now = loop.time()
+        sensor.staleness.record(self.age(sensor, now))
+        sensor.last_reading = now
+        self.reads.inc()
+        self.read_seconds += (now - started - self.read_seconds) * 0.2
+        if sensor.on_reading:
+            sensor.on_reading(bytearray(data))
+        return True
@@ -0,0 +1,111 @@
+import asyncio
+
+import mesh_metrics
+
+# ブロック1台の接続の見張り
+# バックグラウンドのタスクで接続し、切断されたら再接続して通知の購読とモード設定をやり直す。
+# 呼び出し側は supervisor.client を読むだけで、再接続を待たされることはない。
+# 接続していた時間を積算し、起動からの可用率として読めるようにする。
+
+RETRY_SECONDS = 5.0 # 接続・設定に失敗したときに次に試すまでの秒数
+POLL_SECONDS = 30.0 # 切断の通知が来ない場合に備えて is_connected を確かめる間隔
+
+class BlockSupervisor:
+    def __init__(self, name, connect, setup=None, retry_seconds=RETRY_SECONDS, poll_seconds=POLL_SECONDS, on_lost=None):
+        # connect(disconnected_callback): 接続して通知の購読まで済ませたクライアント (失敗なら None) を返すコルーチン関数
+        # setup(client): 接続のたびに行うモード設定などのコルーチン関数
+        # on_lost(): 接続が切れたときに呼ぶ関数 (定期要求の登録を外すなど)
+        self.name = name
+        self.connect = connect
+        self.setup = setup
+        self.on_lost = on_lost
+        self.retry_seconds = retry_seconds
+        self.poll_seconds = poll_seconds
+        self.client = None
+        self.task = None
+        self.started = None       # 見張りを始めた時刻 (loop.time())
+        self.connected_at = None  # 今の接続が使えるようになった時刻
+        self.available_seconds = 0.0
+        self.lost = asyncio.Event()
+        self.ready = asyncio.Event() # 接続して設定が終わっている間セットされる
+        self.reconnects = mesh_metrics.counter(f"{name}.reconnects")
+        mesh_metrics.gauge(f"{name}.availability", self.availability)
+
+    def start(self):
+        self.started = asyncio.get_running_loop().time()
+        self.task = asyncio.create_task(self._run(), name=f"supervisor/{self.name}")
+
+    async def stop(self):
+        # 見張りを止めて切断する
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.client and self.client.is_connected:
+            await self.client.disconnect()
+
+    def is_available(self):
+        return self.ready.is_set() and self.client is not None and self.client.is_connected
+
+    def on_disconnect(self, client):
+        # BleakClient の disconnected_callback
+        self.lost.set()
+
+    def availability(self, now=None):
+        # 見張りを始めてから接続していた時間の割合
+        if self.started is None:
+            return 0.0
+        if now is None:
+            now = asyncio.get_running_loop().time()
+        total = now - self.started
+        available = self.available_seconds
+        if self.connected_at is not None:
+            available += now - self.connected_at
+        return available / total if total > 0 else 0.0
+
+    def report(self, now):
+        hours = (now - self.started) / 3600 if self.started is not None else 0.0
+        return (f"{self.name}: 可用率 {self.availability(now):.1%} ({hours:.1f}時間中, "
+                f"再接続 {self.reconnects.value}回, {'接続中' if self.is_available() else '切断中'})")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        connected_once = False
+        while True:
+            self.lost.clear()
+            client = await self.connect(self.on_disconnect)
+            if client is None:
+                await asyncio.sleep(self.retry_seconds)
+                continue
+            try:
+                if self.setup:
+                    await self.setup(client)
+            except Exception as e:
+                print(f"{self.name}の設定エラー: {e}")
+                try:
+                    await client.disconnect()
+                except Exception:
+                    pass
+                await asyncio.sleep(self.retry_seconds)
+                continue
+
+            self.client = client
+            self.connected_at = loop.time()
+            self.ready.set()
+            if connected_once:
+                self.reconnects.inc()
+                print(f"{self.name}に再接続し、通知とモード設定を戻しました")
+            connected_once = True
+
+            # 切断の通知を待つ (通知が来ない環境に備えて poll_seconds ごとに is_connected も確かめる)
+            while client.is_connected and not self.lost.is_set():
+                try:
+                    await asyncio.wait_for(self.lost.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+            self.available_seconds += loop.time() - self.connected_at
+            self.connected_at = None
+            self.ready.clear()
+            if self.on_lost:
+                self.on_lost()
+            print(f"{self.name}との接続が切れました。バックグラウンドで再接続します...")
@@ -0,0 +1,113 @@
+import asyncio
+from collections import OrderedDict
+
+import event_log
+import mesh_metrics
+
+# ブロックごとの書き込みキュー
+# 接続中のブロック1台につき1つ作り、write_gatt_char を呼ぶのはこのキューだけにする。
+# - 同時に送信中にする書き込みは window 件まで
+# - 優先度クラス (フェーズ進行 > 操作のフィードバック > 演出) の順に送る
+# - 同じ merge_key の書き込みが送信前に残っていれば、新しい内容で上書きして1回にまとめる
+
+PRIORITY_CRITICAL = 0 # フェーズ進行に必要な表示
+PRIORITY_FEEDBACK = 1 # ボタン操作へのフィードバック
+PRIORITY_COSMETIC = 2 # 点滅などの演出
+PRIORITY_NAMES = ["critical", "feedback", "cosmetic"]
+
+WRITE_WINDOW = 2 # ブロックごとに同時に送信中にする書き込み数
+
+log = event_log.get("writer")
+
+class BlockWriter:
+    def __init__(self, client, name, window=WRITE_WINDOW, link=None):
+        self.client = client
+        self.name = name
+        self.window = window
+        self.link = link # リンク品質の計測 (LinkMonitor) があれば書き込みの完了時間を記録する
+        self.queues = [OrderedDict() for _ in PRIORITY_NAMES] # 優先度ごとの {merge_key: 書き込み}
+        self.ready = asyncio.Event()
+        self.workers = []
+        self.sequence = 0
+        self.merged = mesh_metrics.counter("write.merged")
+        self.delays = [mesh_metrics.histogram(f"write.{class_name}.queue_ms") for class_name in PRIORITY_NAMES]
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._worker(), name=f"writer/{self.name}/{i}")
+                            for i in range(self.window)]
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        for queue in self.queues:
+            for entry in queue.values():
+                self._resolve(entry, False)
+            queue.clear()
+
+    def submit(self, char_uuid, data, priority=PRIORITY_CRITICAL, merge_key=None, response=False):
+        # 書き込みをキューに入れ、送信が終わったら True (失敗なら False) になる Future を返す
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if merge_key is None:
+            self.sequence += 1
+            merge_key = ("seq", self.sequence)
+        else:
+            merge_key = (char_uuid, merge_key)
+        entry = next((queue[merge_key] for queue in self.queues if merge_key in queue), None)
+        if entry is None:
+            entry = {"enqueued": loop.time(), "futures": [], "priority": priority}
+            self.queues[priority][merge_key] = entry
+        else:
+            # 送信前の書き込みを新しい内容で置き換える (待っていた呼び出し側も新しい書き込みの完了で戻る)
+            self.merged.inc()
+            if priority < entry["priority"]:
+                # より優先度の高いクラスに移す (同じクラスなら順番はそのまま)
+                del self.queues[entry["priority"]][merge_key]
+                entry["priority"] = priority
+                self.queues[priority][merge_key] = entry
+        entry.update(char_uuid=char_uuid, data=bytes(data), response=response)
+        entry["futures"].append(future)
+        self.ready.set()
+        return future
+
+    async def write(self, char_uuid, data, priority=PRIORITY_CRITICAL, merge_key=None, response=False):
+        return await self.submit(char_uuid, data, priority, merge_key, response)
+
+    def pending_count(self):
+        return sum(len(queue) for queue in self.queues)
+
+    async def _next(self):
+        while True:
+            for priority, queue in enumerate(self.queues):
+                if queue:
+                    _, entry = queue.popitem(last=False)
+                    return priority, entry
+            self.ready.clear()
+            await self.ready.wait()
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, entry = await self._next()
+            self.delays[priority].record((loop.time() - entry["enqueued"]) * 1000)
+            ok = True
+            started = loop.time()
+            try:
+                await self.client.write_gatt_char(entry["char_uuid"], entry["data"], response=entry["response"])
+            except asyncio.CancelledError:
+                self._resolve(entry, False)
+                raise
+            except Exception as e:
+                log.error("Error writing to %s: %s", self.name, e)
+                ok = False
+            if self.link:
+                self.link.record_write((loop.time() - started) * 1000, ok)
+            self._resolve(entry, ok)
+
+    def _resolve(self, entry, ok):
+        for future in entry["futures"]:
+            if not future.done():
+                future.set_result(ok)
@@ -0,0 +1,96 @@
+import asyncio
+
+import event_log
+
+# GPIOブロックのブザーを鳴らすシーケンサ
+# 名前付きのパターン (周波数, デューティ, 時間) の並びを登録時にPWMコマンドへ変換しておき、
+# play() はバックグラウンドで再生を始めてすぐ戻る。
+# 再生中に同じ優先度以上のパターンが来たら打ち切って新しいパターンを鳴らす。
+
+# PWM出力制御コマンド
+CMD_ID_PWM_CONTROL = 0x05
+
+# 優先度 (大きいほど優先)
+PRIORITY_CUE = 0    # 操作の合図
+PRIORITY_PHASE = 1  # ターンの切り替え
+PRIORITY_RESULT = 2 # 結果発表
+
+log = event_log.get("buzzer")
+
+def encode_buzzer_frame(frequency_hz, duty_cycle_permillage, duration_ms):
+    # PWMワンショット出力のコマンドを作る (MESHはリトルエンディアン)
+    freq_bytes = frequency_hz.to_bytes(2, 'little')
+    duty_bytes = duty_cycle_permillage.to_bytes(2, 'little')
+    duration_bytes = duration_ms.to_bytes(2, 'little')
+    return bytes([
+        CMD_ID_PWM_CONTROL,
+        0x00, # Port (PWM Pin)
+        0x00, # Mode (One-shot)
+        freq_bytes[0], freq_bytes[1],
+        duty_bytes[0], duty_bytes[1],
+        duration_bytes[0], duration_bytes[1]
+    ])
+
+def encode_pattern(steps):
+    # [(周波数, デューティ, ミリ秒), ...] を [(コマンド or None, 秒), ...] に変換
+    # 周波数0の音符は休符として扱い、書き込みをせずに待つだけにする
+    frames = []
+    for frequency_hz, duty_cycle_permillage, duration_ms in steps:
+        frame = encode_buzzer_frame(frequency_hz, duty_cycle_permillage, duration_ms) if frequency_hz else None
+        frames.append((frame, duration_ms / 1000))
+    return frames
+
+class BuzzerSequencer:
+    def __init__(self, client, char_uuid, patterns=None, writer=None):
+        self.client = client
+        self.char_uuid = char_uuid
+        self.writer = writer # ブロックの書き込みキュー (BlockWriter) があればそれを通して送る
+        self.patterns = {}
+        self.task = None
+        self.priority = None
+        for name, steps in (patterns or {}).items():
+            self.define(name, steps)
+
+    def define(self, name, steps):
+        self.patterns[name] = encode_pattern(steps)
+
+    def play(self, name, priority=PRIORITY_CUE):
+        # パターンの再生を始めてすぐ戻る。優先度の高い再生中なら鳴らさずにFalseを返す
+        frames = self.patterns[name]
+        if not self.client or not self.client.is_connected:
+            log.warning("Buzzer client not connected.")
+            return False
+        if self.task and not self.task.done():
+            if self.priority > priority:
+                return False
+            self.task.cancel()
+        self.priority = priority
+        self.task = asyncio.create_task(self._play(name, frames))
+        return True
+
+    async def wait(self):
+        # 再生中のパターンが終わるまで待つ
+        if self.task:
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def stop(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+
+    async def _play(self, name, frames):
+        for frame, duration in frames:
+            if frame and self.writer:
+                # 打ち切られたパターンの送信前のフレームは新しいフレームで上書きされる
+                if not await self.writer.write(self.char_uuid, frame, merge_key="pwm"):
+                    return
+            elif frame:
+                try:
+                    # write_gatt_charのresponse=FalseはWrite Without Response
+                    await self.client.write_gatt_char(self.char_uuid, frame, response=False)
+                except Exception as e:
+                    log.error("Error playing buzzer pattern %s for %s: %s", name, self.client.address, e)
+                    return
+            await asyncio.sleep(duration)
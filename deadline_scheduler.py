@@ -0,0 +1,70 @@
+import asyncio
+
+import mesh_metrics
+
+# フェーズのタイムアウトをまとめて扱うスケジューラ
+# 締め切りは loop.time() 基準の絶対時刻で持ち、待ち合わせごとに loop.call_at を1つ登録するだけで
+# タイムアウト用のタスクは作らない。締め切りが来たら待っているタスクをキャンセルし、
+# asyncio.TimeoutError に置き換えて呼び出し側に返す。
+
+class DeadlineScheduler:
+    def __init__(self, name="deadline"):
+        self.handles = set() # 登録中の締め切り
+        self.lateness = mesh_metrics.histogram(f"{name}.lateness_ms")
+        self.timeouts = mesh_metrics.counter(f"{name}.timeouts")
+        mesh_metrics.gauge(f"{name}.outstanding", lambda: len(self.handles))
+        mesh_metrics.gauge("asyncio.tasks", self._task_count)
+
+    def deadline(self, seconds):
+        # 今から seconds 秒後の締め切り (None なら締め切りなし)
+        if seconds is None:
+            return None
+        return asyncio.get_running_loop().time() + seconds
+
+    def remaining(self, deadline):
+        if deadline is None:
+            return None
+        return max(deadline - asyncio.get_running_loop().time(), 0)
+
+    async def wait(self, awaitable, deadline):
+        # awaitable を現在のタスクのまま待つ。締め切りを過ぎたら asyncio.TimeoutError
+        if deadline is None:
+            return await awaitable
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        expired = False
+
+        def on_deadline():
+            nonlocal expired
+            expired = True
+            self.lateness.record((loop.time() - deadline) * 1000)
+            task.cancel()
+
+        handle = loop.call_at(deadline, on_deadline)
+        self.handles.add(handle)
+        try:
+            return await awaitable
+        except asyncio.CancelledError:
+            if not expired:
+                raise
+            if hasattr(task, "uncancel"):
+                task.uncancel()
+            self.timeouts.inc()
+            raise asyncio.TimeoutError() from None
+        finally:
+            handle.cancel()
+            self.handles.discard(handle)
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close() # 一度も開始されずに終わった場合の警告を防ぐ
+
+    async def sleep_until(self, deadline):
+        # 締め切りまで待つ
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(max(deadline - loop.time(), 0))
+        self.lateness.record((loop.time() - deadline) * 1000)
+
+    def _task_count(self):
+        try:
+            return len(asyncio.all_tasks())
+        except RuntimeError:
+            return 0 # イベントループの外から読んだ場合
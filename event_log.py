@@ -0,0 +1,100 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+# 構造化イベントログ
+# カテゴリごとのロガー ("mesh.<カテゴリ>") に書き、記録はキューに積むだけで戻る。
+# 文字列への整形と標準出力・ファイルへの書き込みはバックグラウンドのスレッドが行うので、
+# 通知ハンドラーなどイベントループ上の処理が出力の書き込みで止まらない。
+# レベルはカテゴリごとに設定でき、無効なレベルの記録は isEnabledFor の判定だけで捨てられる。
+# 引数は logging と同じく %s で遅延して整形し、重い変換は Lazy() で包んで無効時には呼ばない。
+
+ROOT_LOGGER_NAME = "mesh"
+DEFAULT_LEVEL = logging.INFO
+CONSOLE_FORMAT = "%(message)s" # 標準出力はこれまでの print と同じ見た目にする
+
+listener = None
+
+class Lazy:
+    # 出力するときに初めて func(*args) を呼ぶ (例: Lazy(data.hex))
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # 同じプロセス内のキューなので、整形はせずにそのままバックグラウンドのスレッドへ渡す
+        return record
+
+class JsonLinesFormatter(logging.Formatter):
+    # 1行1件のJSON {"time", "category", "level", "message", ...extra の fields}
+    def format(self, record):
+        event = {
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "category": record.name[len(ROOT_LOGGER_NAME) + 1:],
+            "level": record.levelname.lower(),
+            "message": record.getMessage(),
+        }
+        event.update(getattr(record, "fields", {}))
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+def get(category):
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{category}")
+
+def set_level(category, level):
+    # level: "debug", "info", "warning", "error" または logging のレベル値
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    get(category).setLevel(level)
+
+def parse_levels(spec):
+    # "notify=debug,select=warning" -> {"notify": "debug", "select": "warning"}
+    levels = {}
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        category, _, level = item.partition("=")
+        if not level or not isinstance(logging.getLevelName(level.upper()), int):
+            raise ValueError(f"ログレベルの指定が正しくありません: {item}")
+        levels[category] = level
+    return levels
+
+def configure(levels=None, path=None, stream=None):
+    # ログの出力を始める。levels: {カテゴリ: レベル}、path: JSON Linesで書き出すファイル
+    global listener
+    if listener:
+        shutdown()
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.setLevel(DEFAULT_LEVEL)
+    root.propagate = False
+    for category, level in (levels or {}).items():
+        set_level(category, level)
+
+    console = logging.StreamHandler(stream or sys.stdout)
+    console.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+    handlers = [console]
+    if path:
+        log_file = logging.FileHandler(path, encoding='utf-8')
+        log_file.setFormatter(JsonLinesFormatter())
+        handlers.append(log_file)
+
+    records = queue.SimpleQueue()
+    root.handlers = [DeferredQueueHandler(records)]
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+def shutdown():
+    # キューに残った記録を書き終えてからスレッドを止める
+    global listener
+    if listener:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        listener = None
@@ -1,6 +1,7 @@
 import asyncio
-from bleak import BleakClient, discover
+from bleak import BleakClient
 from struct import pack
+from mesh_advert import find_block
 
 # UUID
 CORE_INDICATE_UUID = ('72c90005-57a9-4d40-b746-534e22ec9f9e')
@@ -33,12 +34,9 @@ def on_receive_indicate(sender, data: bytearray):
     print('[indicate] ',data)
 
 async def scan(prefix='MESH-100BU1029369'):
-    while True:
-        print('scan...')
-        try:
-            return next(d for d in await discover() if d.name and d.name.startswith(prefix))
-        except StopIteration:
-            continue
+    # 共有スキャナで見つかるまで待つ (他のコルーチンの待ちとスキャンを共有する)
+    print('scan...')
+    return await find_block(prefix)
 
 async def main():
     # Scan device
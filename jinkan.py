@@ -1,8 +1,9 @@
 import asyncio
 import time
-from bleak import BleakClient, BleakScanner, discover
+from bleak import BleakClient, BleakScanner
 from collections import Counter
 from struct import pack
+from mesh_advert import find_block
 
 # UUID
 CORE_INDICATE_UUID = ('72c90005-57a9-4d40-b746-534e22ec9f9e')
@@ -71,12 +72,9 @@ def on_receive_indicate(sender, data: bytearray):
     print('[indicate] ',data)
 
 async def scan(prefix):
-    while True:
-        print('scan...')
-        try:
-            return next(d for d in await discover() if d.name and d.name.startswith(prefix))
-        except StopIteration:
-            continue
+    # 共有スキャナで見つかるまで待つ (他のコルーチンの待ちとスキャンを共有する)
+    print('scan...')
+    return await find_block(prefix)
 
 async def main():
     # Scan device
@@ -1,8 +1,24 @@
+import argparse
 import asyncio
+import json
+import os
 import random
-import time
-from bleak import BleakClient, BleakScanner
+from bleak import BleakClient
 from collections import Counter
+from block_writer import BlockWriter, PRIORITY_CRITICAL, PRIORITY_FEEDBACK, PRIORITY_COSMETIC
+from buzzer_sequencer import BuzzerSequencer, PRIORITY_CUE, PRIORITY_PHASE, PRIORITY_RESULT, encode_buzzer_frame
+from deadline_scheduler import DeadlineScheduler
+import event_log
+from event_log import Lazy
+from jinro_outcome import determine_outcome
+from led_animator import LedAnimator
+from link_monitor import LinkMonitor, PROFILE_BALANCED, PROFILE_LOW_LATENCY, PROFILE_POWER_SAVING
+import link_monitor
+from loop_lag import THRESHOLD_MS, LoopLagMonitor
+from mesh_advert import BLOCK_TYPE_NAMES, MESH_SERVICE_UUID, discover_blocks
+from mesh_broker import SOCKET_PATH, BrokerClient
+import mesh_metrics
+from task_registry import TaskRegistry
 
 # このサービスに属する特性UUID群
 # コマンド送信 (Write Without Response)
@@ -33,8 +49,20 @@ ORIENTATION_BACK = 0x04 # 裏
 
 # ゲーム設定
 PLAYER_COUNT = 4
+MAX_PLAYER_COUNT = 12 # 設定ファイルで指定できる最大人数
 DISCUSSION_TIME_SECONDS = 60
 PHASE_TIMEOUT_SECONDS = 10 # 夜の活動時間の各フェーズのタイムアウト
+VOTE_TIMEOUT_SECONDS = 60 # 投票のタイムアウト (長押ししなかったプレイヤーは投票なし)
+SELECTION_DEBOUNCE_SECONDS = 0.5 # 選択中の短押しを受け付ける間隔
+TASK_TRACE = False # Trueにするとフェーズごとのタスクの数・所要時間・取り残しを表示する
+LED_NATIVE_BLINK = True # 点滅はLEDブロックの点滅フラグで行う (Falseならソフトウェアで点滅)
+# ブロックの種類ごとに希望する接続間隔 (入力を受けるブロックは短く、たまにしか書かないブロックは長く)
+BLOCK_LINK_PROFILES = {
+    "button": PROFILE_LOW_LATENCY,
+    "motion": PROFILE_LOW_LATENCY,
+    "led": PROFILE_BALANCED,
+    "gpio": PROFILE_POWER_SAVING,
+}
 
 # ブロックのシリアルナンバー (ハードコード)
 # 実際のブロックのComplete Local Nameに含まれる識別子に合わせてください。
@@ -51,6 +79,7 @@ PLAYER_BUTTON_SN = { # 各プレイヤーのボタンブロックのシリアル
     "player3": "BTN_P3_SN", 
     "player4": "BTN_P4_SN", 
 }
+PLAYER_IDS = list(PLAYER_LED_SN.keys()) # 座席順のプレイヤーID
 GPIO_BLOCK_SN = "GPIO_SN" # GPIOブロックのシリアルナンバーサフィックス
 MOTION_BLOCK_SN = "MOTION_SN" # 動きブロックのシリアルナンバーサフィックス
 
@@ -65,6 +94,21 @@ COLOR_ORANGE = (255, 165, 0)
 COLOR_PURPLE = (128, 0, 128)
 COLOR_OFF = (0, 0, 0)
 
+# プレイヤーの色 (設定ファイルで色を指定しない場合は座席順にこのパレットから割り当てる)
+PLAYER_COLOR_PALETTE = [
+    COLOR_RED, COLOR_GREEN, COLOR_BLUE, COLOR_YELLOW,
+    (0, 255, 255), (255, 0, 255), COLOR_ORANGE, COLOR_PURPLE,
+    (255, 105, 180), (0, 128, 128), (128, 128, 0), COLOR_WHITE,
+]
+PLAYER_COLORS = {player_id: PLAYER_COLOR_PALETTE[i] for i, player_id in enumerate(PLAYER_IDS)}
+
+# 設定ファイル (存在すれば起動時に読み込み、上記のハードコード値を上書き)
+CONFIG_FILE_NAME = "jinro_config.json"
+# 進行中のゲームのチェックポイント (フェーズが終わるたびに書き込み、ゲーム終了で削除)
+CHECKPOINT_FILE_NAME = "jinro_checkpoint.json"
+# ゲームのフェーズ (この順に進行し、チェックポイントには最後に終わったフェーズを記録する)
+GAME_PHASES = ["リセット", "役職配布", "夜の活動時間", "昼の議論時間", "投票時間", "勝敗判定"]
+
 # 役職と対応するLED表示
 ROLES = ["占い師", "怪盗", "市民", "市民", "人狼", "人狼"] # 6枚の役職カード
 ROLE_LED_MAP = {
@@ -74,6 +118,14 @@ ROLE_LED_MAP = {
     "占い師": {"color": COLOR_PURPLE, "blink": False},
 }
 
+# ブザーのパターン [(周波数Hz, デューティ‰, ミリ秒), ...] (周波数0は休符)
+BUZZER_PATTERNS = {
+    "ready": [(440, 500, 200)],   # リセット (短く1回)
+    "turn": [(440, 500, 1000)],   # ターンの切り替え (長く1回)
+    "wake": [(440, 500, 1500)],   # 夜明け (長めに1回)
+    "result": [(440, 500, 2000)], # 勝敗発表 (長く1回)
+}
+
 # グローバル変数 (ゲームの状態を管理)
 # 各プレイヤーのLEDとボタンクライアントを個別に管理
 player_clients = {} # {player_id: {"led": led_client, "button": button_client}}
@@ -81,7 +133,22 @@ player_roles = {}   # プレイヤーごとの役職 {player_id: role}
 player_votes = {}   # 投票結果 {voter_id: voted_id}
 gpio_client = None
 motion_client = None
+buzzer = BuzzerSequencer(None, COMMAND_CHAR_UUID, BUZZER_PATTERNS) # GPIOブロック接続後にclientを設定
+phase_deadlines = DeadlineScheduler("phase_deadline") # 卓全体のフェーズの締め切り
+table_tasks = TaskRegistry("table", trace=TASK_TRACE) # フェーズ内で作るタスクの管理
 current_turn = "リセット"
+led_states = {}     # 各LEDに最後に書き込んだ状態 {led_client: (color, blink)}
+block_writers = {}  # 接続中のブロックごとの書き込みキュー {client: BlockWriter}
+block_notify_handlers = {} # 通知を購読中のブロックとハンドラー {client: handler} (再接続時に購読し直す)
+block_links = {}    # 接続中のブロックごとのリンク品質の計測 {client: LinkMonitor}
+broker = None       # ブローカー経由で遊ぶときの BrokerClient (None なら直接接続する)
+lag_monitor = None  # イベントループの遅れと、ループを止めていたコードの記録 (LoopLagMonitor)
+session_scores = Counter() # セッション中の勝利数 {player_id: 勝利数}
+
+# イベントログ (カテゴリごとにレベルを設定できる。--log-level notify=debug など)
+notify_log = event_log.get("notify") # ブロックからの通知
+input_log = event_log.get("input")   # ボタン・動きブロックの操作と選択
+block_log = event_log.get("block")   # ブロックへの書き込み
 
 # 通知イベントキュー
 # ボタンイベントキュー: {player_id: asyncio.Queue()}
@@ -91,13 +158,72 @@ motion_orientation_event_queue = asyncio.Queue()
 
 # ヘルパー関数
 
-async def connect_to_mesh_block(address, block_id):
+def load_config(path):
+    # 設定ファイルから卓の人数・ブロック・役職カードを読み込む
+    # {
+    #   "players": [{"id": "player1", "led_sn": "...", "button_sn": "...", "color": [255, 0, 0]}, ...],
+    #   "deck": ["占い師", "怪盗", "市民", "市民", "人狼", "人狼"],
+    #   "roles": {"市民": {"color": [255, 255, 255], "blink": false}, ...},
+    #   "gpio_sn": "...", "motion_sn": "...",
+    #   "discussion_time_seconds": 60, "phase_timeout_seconds": 10, "vote_timeout_seconds": 60
+    # }
+    global PLAYER_COUNT, PLAYER_IDS, PLAYER_LED_SN, PLAYER_BUTTON_SN, PLAYER_COLORS
+    global ROLES, GPIO_BLOCK_SN, MOTION_BLOCK_SN, DISCUSSION_TIME_SECONDS, PHASE_TIMEOUT_SECONDS, VOTE_TIMEOUT_SECONDS
+
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+
+    for role, led in config.get("roles", {}).items():
+        ROLE_LED_MAP[role] = {"color": tuple(led["color"]), "blink": bool(led.get("blink", False))}
+
+    players = config.get("players")
+    if players is not None:
+        if not 1 <= len(players) <= MAX_PLAYER_COUNT:
+            raise ValueError(f"プレイヤー数は1〜{MAX_PLAYER_COUNT}人で指定してください: {len(players)}人")
+        PLAYER_IDS = [p.get("id", f"player{i}") for i, p in enumerate(players, start=1)]
+        if len(set(PLAYER_IDS)) != len(PLAYER_IDS):
+            raise ValueError("プレイヤーIDが重複しています。")
+        PLAYER_LED_SN = {p_id: p["led_sn"] for p_id, p in zip(PLAYER_IDS, players)}
+        PLAYER_BUTTON_SN = {p_id: p["button_sn"] for p_id, p in zip(PLAYER_IDS, players)}
+        PLAYER_COLORS = {
+            p_id: tuple(p["color"]) if "color" in p else PLAYER_COLOR_PALETTE[i % len(PLAYER_COLOR_PALETTE)]
+            for i, (p_id, p) in enumerate(zip(PLAYER_IDS, players))
+        }
+        PLAYER_COUNT = len(PLAYER_IDS)
+
+    ROLES = list(config.get("deck", ROLES))
+    if len(ROLES) < PLAYER_COUNT:
+        raise ValueError(f"役職カードが足りません: {len(ROLES)}枚 / {PLAYER_COUNT}人")
+    unknown_roles = sorted(set(ROLES) - set(ROLE_LED_MAP))
+    if unknown_roles:
+        raise ValueError(f"LED表示が定義されていない役職があります: {', '.join(unknown_roles)}")
+
+    GPIO_BLOCK_SN = config.get("gpio_sn", GPIO_BLOCK_SN)
+    MOTION_BLOCK_SN = config.get("motion_sn", MOTION_BLOCK_SN)
+    DISCUSSION_TIME_SECONDS = config.get("discussion_time_seconds", DISCUSSION_TIME_SECONDS)
+    PHASE_TIMEOUT_SECONDS = config.get("phase_timeout_seconds", PHASE_TIMEOUT_SECONDS)
+    VOTE_TIMEOUT_SECONDS = config.get("vote_timeout_seconds", VOTE_TIMEOUT_SECONDS)
+    print(f"設定ファイルを読み込みました: {path} ({PLAYER_COUNT}人, 役職カード{len(ROLES)}枚)")
+
+async def connect_to_mesh_block(address, block_id, kind, rssi=None):
     # 指定されたアドレスのMESHブロックに接続
+    # kind: "led", "button", "gpio", "motion" (接続間隔の方針を決める)
+    link = LinkMonitor(block_id, BLOCK_LINK_PROFILES[kind])
+    link.record_advert(rssi)
     try:
-        client = BleakClient(address)
+        if broker:
+            # ブローカーが接続を持っているので、address にはシリアルナンバーが入っている
+            client = broker.block(address, disconnected_callback=link.on_disconnect)
+        else:
+            client = BleakClient(address, disconnected_callback=link.on_disconnect)
         print(f"Connecting to {block_id} ({address})...")
         await client.connect()
         print(f"Connected to {block_id}!")
+        block_links[client] = link
+        link.apply(client)
+        # このブロックへの書き込みは全て専用の書き込みキューを通す
+        block_writers[client] = BlockWriter(client, block_id, link=link)
+        block_writers[client].start()
 
         try:
             services = await client.get_services()
@@ -121,46 +247,91 @@ async def connect_to_mesh_block(address, block_id):
         print(f"Failed to connect to {block_id} ({address}): {e}")
         return None
 
-async def set_led_state(client, color, blink=False):
+def encode_led_frame(color, blink=False):
+    # LED制御コマンドを作る [コマンドID, R, G, B, 点滅フラグ]
+    blink_flag = 0x01 if blink else 0x00
+    return bytearray([CMD_ID_LED_CONTROL, color[0], color[1], color[2], blink_flag])
+
+async def set_led_state(client, color, blink=False, priority=PRIORITY_CRITICAL):
     # LEDの色を設定し、点滅させるかどうかを制御
+    # 送信前の古いLED書き込みは新しい状態で上書きされる (merge_key="led")
     if not client or not client.is_connected:
-        print("LED client not connected.")
+        block_log.warning("LED client not connected.")
         return
     
-    blink_flag = 0x01 if blink else 0x00
-    led_data = bytearray([CMD_ID_LED_CONTROL, color[0], color[1], color[2], blink_flag])
+    led_data = encode_led_frame(color, blink)
+    led_states[client] = (color, blink)
+    writer = block_writers.get(client)
+    if writer:
+        await writer.write(COMMAND_CHAR_UUID, led_data, priority, merge_key="led")
+        return
     try:
         # write_gatt_charのresponse=FalseはWrite Without Response
         await client.write_gatt_char(COMMAND_CHAR_UUID, led_data, response=False)
         # print(f"Set LED to {color} (blink={blink}) for {client.address}")
     except Exception as e:
-        print(f"Error setting LED state for {client.address}: {e}")
+        block_log.error("Error setting LED state for %s: %s", client.address, e)
 
 async def play_buzzer_sound(client, duration_ms, frequency_hz=440, duty_cycle_permillage=500):
     # GPIOブロックのブザーを鳴らす
     if not client or not client.is_connected:
-        print("Buzzer client not connected.")
+        block_log.warning("Buzzer client not connected.")
         return
     
     # 周波数、デューティサイクル、持続時間をバイト配列に変換
-    freq_bytes = frequency_hz.to_bytes(2, 'little') # MESHはリトルエンディアン
-    duty_bytes = duty_cycle_permillage.to_bytes(2, 'little')
-    duration_bytes = duration_ms.to_bytes(2, 'little')
-
-    buzzer_data = bytearray([
-        CMD_ID_PWM_CONTROL,
-        0x00, # Port (PWM Pin)
-        0x00, # Mode (One-shot)
-        freq_bytes[0], freq_bytes[1],
-        duty_bytes[0], duty_bytes[1],
-        duration_bytes[0], duration_bytes[1]
-    ])
+    buzzer_data = encode_buzzer_frame(frequency_hz, duty_cycle_permillage, duration_ms)
+    writer = block_writers.get(client)
+    if writer:
+        await writer.write(COMMAND_CHAR_UUID, buzzer_data, merge_key="pwm")
+        return
     try:
         # write_gatt_charのresponse=FalseはWrite Without Response
         await client.write_gatt_char(COMMAND_CHAR_UUID, buzzer_data, response=False)
         # print(f"Played buzzer for {duration_ms}ms at {frequency_hz}Hz")
     except Exception as e:
-        print(f"Error playing buzzer for {client.address}: {e}")
+        block_log.error("Error playing buzzer for %s: %s", client.address, e)
+
+def get_led_state(client):
+    # LEDに最後に書き込んだ状態 (未書き込みなら消灯)
+    return led_states.get(client, (COLOR_OFF, False))
+
+# 卓全体のLEDアニメーションを1本のループで動かすスケジューラ
+# (演出として書き込み、フェーズ進行の表示や操作のフィードバックより後に送る)
+led_animator = LedAnimator(set_led_state, get_led_state, native_blink=LED_NATIVE_BLINK, default_priority=PRIORITY_COSMETIC)
+
+async def show_selection(clients, previous_id, target_id):
+    # 選択中のプレイヤーのLEDだけを切り替える
+    # 前の選択を消灯し新しい選択を点灯するだけなので、人数に関係なく最大2回の書き込みで済む
+    # 新しい選択の点灯を先に出して、押下からフィードバックまでの時間を短くする
+    writes = []
+    if clients[target_id]["led"]:
+        writes.append(set_led_state(clients[target_id]["led"], PLAYER_COLORS[target_id], priority=PRIORITY_FEEDBACK))
+    if previous_id and previous_id != target_id and clients[previous_id]["led"]:
+        writes.append(set_led_state(clients[previous_id]["led"], COLOR_OFF, priority=PRIORITY_FEEDBACK))
+    await asyncio.gather(*writes)
+
+async def select_target(clients, chooser_id, role_name):
+    # 短押しで対象を順番に選び、長押しで決定する (決定したプレイヤーIDを返す)
+    player_list = list(clients.keys())
+    current_target_index = 0
+    # 最初の短押しで選択者自身のLED (役職表示) も消灯する
+    lit_player_id = chooser_id
+    while True:
+        # ボタンイベントを待つ
+        button_state = await player_button_event_queues[chooser_id].get()
+
+        if button_state == 0x01: # 短押し
+            current_target_index = (current_target_index + 1) % len(player_list)
+            target_player_id = player_list[current_target_index] # 更新
+            input_log.info("%sが %s を選択中...", role_name, target_player_id)
+            # 選択中のプレイヤーのLEDをそのプレイヤーの色で点灯
+            await show_selection(clients, lit_player_id, target_player_id)
+            lit_player_id = target_player_id
+            await asyncio.sleep(SELECTION_DEBOUNCE_SECONDS) # 次の短押しまで少し待つ
+        elif button_state == 0x02: # 長押しで決定
+            target_player_id = player_list[current_target_index]
+            input_log.info("%sが %s を長押しで決定しました。", role_name, target_player_id)
+            return target_player_id
 
 # 通知ハンドラー
 def button_notification_handler_factory(player_id):
@@ -169,7 +340,7 @@ def button_notification_handler_factory(player_id):
         # data: [通知ID (0x01), ボタン状態 (0x00:離, 0x01:押, 0x02:長押)]
         if len(data) >= 2 and data[0] == NOTIF_ID_BUTTON_EVENT:
             button_state = data[1]
-            # print(f"Button event from {player_id}: State={button_state}")
+            input_log.debug("Button event from %s: State=%s", player_id, button_state)
             await player_button_event_queues[player_id].put(button_state)
     return handler
 
@@ -179,7 +350,7 @@ def motion_notification_handler(sender, data):
     # 向きの値はデータ位置2 (0-indexed)
     if len(data) >= 3 and data[0] == NOTIF_ID_MOTION_ORIENTATION:
         orientation = data[2] # 向きの値はデータ位置2
-        # print(f"Motion event: Orientation={orientation}")
+        input_log.debug("Motion event: Orientation=%s", orientation)
         # 最新の向きのみを保持するためにキューをクリアしてから追加
         while not motion_orientation_event_queue.empty():
             try:
@@ -190,70 +361,69 @@ def motion_notification_handler(sender, data):
 
 def handle_state_indication(sender, data):
     # STATE_INDICATION_CHAR_UUID からの通知を処理するハンドラー
-    print(f"Received state indication from {sender}: {data.hex()}")
+    # 16進表記への変換は notify カテゴリが debug のときだけ行う
+    notify_log.debug("Received state indication from %s: %s", sender, Lazy(data.hex))
 
 # ボタン/動きセンサー待機関数
-async def wait_for_button_press(button_client, timeout=None):
-    # ボタンが押されるまで待機
+async def wait_for_button_press(button_client, timeout=None, deadline=None):
+    # ボタンが押されるまで待機 (timeout秒後、または締め切りdeadlineを過ぎたらFalse)
     player_id = next((p_id for p_id, data in player_clients.items() if data["button"] == button_client), None)
     if not player_id:
-        print("Error: Could not find player_id for button client.")
+        input_log.error("Could not find player_id for button client.")
         return False
 
-    start_time = time.time()
+    if deadline is None:
+        deadline = phase_deadlines.deadline(timeout)
     while True:
         try:
             # ボタンが押された (0x01) または長押しされた (0x02) イベントを待つ
-            button_state = await asyncio.wait_for(player_button_event_queues[player_id].get(), timeout=timeout)
-            
+            button_state = await phase_deadlines.wait(player_button_event_queues[player_id].get(), deadline)
+
             if button_state == 0x01 or button_state == 0x02: # 押された、または長押し
                 # MESHの通知はPressとRelease両方送るので、Releaseを待つのが確実
                 # ただし、ここでは単一のプレスイベントを検出する
                 return True
-            
+
         except asyncio.TimeoutError:
             return False # タイムアウト
         except Exception as e:
-            print(f"Error waiting for button press: {e}")
-            return False
-        
-        # タイムアウトが設定されていて、時間が経過した場合
-        if timeout and (time.time() - start_time > timeout):
+            input_log.error("Error waiting for button press: %s", e)
             return False
 
 async def wait_for_long_press(button_client, long_press_duration=1.5):
     # ボタンが長押しされるまで待機
     player_id = next((p_id for p_id, data in player_clients.items() if data["button"] == button_client), None)
     if not player_id:
-        print("Error: Could not find player_id for button client.")
+        input_log.error("Could not find player_id for button client.")
         return False
 
-    start_time = time.time()
+    deadline = phase_deadlines.deadline(PHASE_TIMEOUT_SECONDS)
     while True:
         try:
             # 長押し (0x02) イベントを待つ
-            button_state = await asyncio.wait_for(player_button_event_queues[player_id].get(), timeout=PHASE_TIMEOUT_SECONDS)
+            button_state = await phase_deadlines.wait(player_button_event_queues[player_id].get(), deadline)
             if button_state == 0x02: # 長押しイベントを直接検出
                 return True
         except asyncio.TimeoutError:
             return False # タイムアウト
         except Exception as e:
-            print(f"Error waiting for long press: {e}")
-            return False
-        
-        if (time.time() - start_time > PHASE_TIMEOUT_SECONDS):
+            input_log.error("Error waiting for long press: %s", e)
             return False
 
-async def wait_for_motion_orientation(motion_client, target_orientation_value):
-    # 動きブロックが特定の向きになるまで待機
+async def wait_for_motion_orientation(motion_client, target_orientation_value, timeout=None):
+    # 動きブロックが特定の向きになるまで待機 (timeoutを指定した場合は時間切れでFalse)
+    deadline = phase_deadlines.deadline(timeout)
     while True:
         try:
-            current_orientation = await asyncio.wait_for(motion_orientation_event_queue.get(), timeout=None) # タイムアウトなしで永久に待つ
+            current_orientation = await phase_deadlines.wait(motion_orientation_event_queue.get(), deadline)
             if current_orientation == target_orientation_value:
-                print(f"Motion block is now in target orientation: {target_orientation_value}")
+                input_log.info("Motion block is now in target orientation: %s", target_orientation_value)
                 return True
+        except asyncio.TimeoutError:
+            input_log.info("Motion block did not reach target orientation: %s", target_orientation_value)
+            return False
         except Exception as e:
-            print(f"Error waiting for motion orientation: {e}")
+            input_log.error("Error waiting for motion orientation: %s", e)
             await asyncio.sleep(0.1) # エラー時の待機
 
 # ゲームフェーズ関数
@@ -269,12 +439,14 @@ async def reset_game(clients):
         if player_data["led"]:
             await set_led_state(player_data["led"], COLOR_OFF)
     
-    # ブザーを短く1回鳴らす
-    await play_buzzer_sound(gpio_client, 200) # 200ms
+    # ブザーを短く1回鳴らす (鳴らし終わりを待たずに次へ進む)
+    buzzer.play("ready", PRIORITY_CUE)
 
     print("ゲーム開始準備ができました。各プレイヤーのボタンを押してください。")
     # 全てのプレイヤーのボタンが押されるまで待機
-    await asyncio.gather(*[wait_for_button_press(player_data["button"]) for player_data in clients.values() if player_data["button"]])
+    async with table_tasks.phase(current_turn) as scope:
+        await asyncio.gather(*[scope.spawn(wait_for_button_press(player_data["button"]), f"ready:{p_id}")
+                               for p_id, player_data in clients.items() if player_data["button"]])
     print("全てのプレイヤーが準備完了しました。")
 
 async def distribute_roles(clients):
@@ -288,7 +460,7 @@ async def distribute_roles(clients):
     await wait_for_motion_orientation(motion_client, ORIENTATION_LEFT)
 
     # ブザーを長く1回鳴らす
-    await play_buzzer_sound(gpio_client, 1000) # 1000ms
+    buzzer.play("turn", PRIORITY_PHASE)
 
     # 役職のランダム割り当て
     assigned_roles = random.sample(ROLES, PLAYER_COUNT)
@@ -307,7 +479,9 @@ async def distribute_roles(clients):
 
     print("各プレイヤーは自分の役職を確認し、ボタンを押してください。")
     # 全てのプレイヤーが自分の役職を確認し、ボタンを押すまで待機
-    await asyncio.gather(*[wait_for_button_press(player_data["button"]) for player_data in clients.values() if player_data["button"]])
+    async with table_tasks.phase(current_turn) as scope:
+        await asyncio.gather(*[scope.spawn(wait_for_button_press(player_data["button"]), f"confirm:{p_id}")
+                               for p_id, player_data in clients.items() if player_data["button"]])
     print("全てのプレイヤーが役職を確認しました。")
 
 async def night_activity_phase(clients):
@@ -321,11 +495,13 @@ async def night_activity_phase(clients):
     await wait_for_motion_orientation(motion_client, ORIENTATION_UP)
 
     # ブザーを長く1回鳴らす
-    await play_buzzer_sound(gpio_client, 1000) # 1000ms
+    buzzer.play("turn", PRIORITY_PHASE)
 
     print("夜の活動時間です。各プレイヤーはうつ伏せになり、ボタンを押してください。")
     # 全てのプレイヤーのボタンが「うつ伏せになったことを示す」ために押されるのを待つ
-    await asyncio.gather(*[wait_for_button_press(player_data["button"]) for player_data in clients.values() if player_data["button"]])
+    async with table_tasks.phase(current_turn) as scope:
+        await asyncio.gather(*[scope.spawn(wait_for_button_press(player_data["button"]), f"sleep:{p_id}")
+                               for p_id, player_data in clients.items() if player_data["button"]])
     print("全員うつ伏せになりました。夜の活動を開始します。")
 
     # フェーズの順次進行 (ブザーなし)
@@ -339,69 +515,38 @@ async def night_activity_phase(clients):
     await run_thief_phase(clients)
 
     # 怪盗の操作後、ブザーを鳴らし全員を起こす
-    await play_buzzer_sound(gpio_client, 1500) # 長めに鳴らす
+    buzzer.play("wake", PRIORITY_PHASE) # 長めに鳴らす
 
 async def run_seer_phase(clients):
     # 占い師の活動フェーズ
     seer_id = next((p_id for p_id, role in player_roles.items() if role == "占い師"), None)
-    
+    deadline = phase_deadlines.deadline(PHASE_TIMEOUT_SECONDS)
+
     if seer_id and clients[seer_id]["led"] and clients[seer_id]["button"]:
         seer_led_client = clients[seer_id]["led"]
         seer_button_client = clients[seer_id]["button"]
         print(f"占い師 ({seer_id}) の活動時間です。")
+        # 選択中の表示は差分だけ書き込むので、最初に占い師以外のLEDを消灯しておく
+        await asyncio.gather(*[set_led_state(pdata["led"], COLOR_OFF) for pid, pdata in clients.items()
+                               if pid != seer_id and pdata["led"]])
         await set_led_state(seer_led_client, ROLE_LED_MAP["占い師"]["color"]) # 紫点灯
 
-        target_player_id = None
-        player_list = list(clients.keys())
-        current_target_index = 0
-
-        async def select_target_logic():
-            nonlocal target_player_id, current_target_index
-            while True:
-                # ボタンイベントを待つ
-                button_state = await asyncio.wait_for(player_button_event_queues[seer_id].get(), timeout=None) # 無限に待つ
-
-                if button_state == 0x01: # 短押し
-                    current_target_index = (current_target_index + 1) % PLAYER_COUNT
-                    target_player_id = player_list[current_target_index] # 更新
-                    print(f"占い師が {target_player_id} を選択中...")
-                    # 選択中のプレイヤーのLEDをそのプレイヤーの色で点灯
-                    for pid, pdata in clients.items():
-                        if pdata["led"]:
-                            if pid == target_player_id:
-                                await set_led_state(pdata["led"], PLAYER_COLORS[pid])
-                            else:
-                                await set_led_state(pdata["led"], COLOR_OFF)
-                    await asyncio.sleep(0.5) # 次の短押しまで少し待つ
-                elif button_state == 0x02: # 長押しで決定
-                    target_player_id = player_list[current_target_index]
-                    print(f"占い師が {target_player_id} を長押しで決定しました。")
-                    return True # 長押しで決定
-                
         try:
-            # ターゲット選択とタイムアウト
-            select_task = asyncio.create_task(select_target_logic())
-            timeout_task = asyncio.create_task(asyncio.sleep(PHASE_TIMEOUT_SECONDS))
-            
-            done, pending = await asyncio.wait([select_task, timeout_task], return_when=asyncio.FIRST_COMPLETED)
-
-            if select_task in done and select_task.result(): # 長押しで決定された場合
-                # 占った人の陣営の色を表示
-                target_role = player_roles[target_player_id]
-                config = ROLE_LED_MAP[target_role]
-                print(f"{target_player_id} の役職は {target_role} です。")
-                await set_led_state(seer_led_client, config["color"], config["blink"]) # 占い師のLEDに表示
-                
-                print("占い師は確認後、ボタンを押してください。")
-                # 確認ボタンが押されるまで待つ
-                await asyncio.wait_for(wait_for_button_press(seer_button_client), timeout=PHASE_TIMEOUT_SECONDS)
-            else: # タイムアウトした場合
-                print("占い師は時間内に操作を行いませんでした。")
-            
-            # 残りのタスクをキャンセル
-            for task in pending:
-                task.cancel()
-
+            # ターゲット選択 (長押しで決定するか、締め切りでタイムアウト)
+            target_player_id = await phase_deadlines.wait(select_target(clients, seer_id, "占い師"), deadline)
+
+            # 占った人の陣営の色を表示
+            target_role = player_roles[target_player_id]
+            config = ROLE_LED_MAP[target_role]
+            print(f"{target_player_id} の役職は {target_role} です。")
+            await set_led_state(seer_led_client, config["color"], config["blink"]) # 占い師のLEDに表示
+
+            print("占い師は確認後、ボタンを押してください。")
+            # 確認ボタンが押されるまで待つ (ターゲット選択と同じフェーズの締め切りまで)
+            if not await wait_for_button_press(seer_button_client, deadline=deadline):
+                print("占い師は時間内に確認のボタンを押しませんでした。")
+        except asyncio.TimeoutError:
+            print("占い師は時間内に操作を行いませんでした。")
         except asyncio.CancelledError:
             print("占い師フェーズがキャンセルされました。")
         finally:
@@ -411,13 +556,14 @@ async def run_seer_phase(clients):
                 if pdata["led"]:
                     await set_led_state(pdata["led"], COLOR_OFF)
     else:
-        print("占い師はいません、またはブロックが接続されていません。10秒間待機します。")
-        await asyncio.sleep(PHASE_TIMEOUT_SECONDS)
+        print(f"占い師はいません、またはブロックが接続されていません。{PHASE_TIMEOUT_SECONDS}秒間待機します。")
+        await phase_deadlines.sleep_until(deadline)
 
 async def run_werewolf_phase(clients):
     # 人狼の活動フェーズ
     werewolf_ids = [p_id for p_id, role in player_roles.items() if role == "人狼"]
-    
+    deadline = phase_deadlines.deadline(PHASE_TIMEOUT_SECONDS)
+
     if werewolf_ids:
         print(f"人狼 ({', '.join(werewolf_ids)}) の活動時間です。")
         button_clients_to_wait = []
@@ -429,24 +575,17 @@ async def run_werewolf_phase(clients):
 
 
         print("人狼は確認後、ボタンを押してください。")
-        
-        button_press_tasks = [wait_for_button_press(btn_client) for btn_client in button_clients_to_wait]
-        
+
         try:
-            # 全ての人狼のボタンが押されるか、タイムアウト
-            done, pending = await asyncio.wait(
-                button_press_tasks + [asyncio.sleep(PHASE_TIMEOUT_SECONDS)],
-                return_when=asyncio.FIRST_COMPLETED if len(werewolf_ids) == 1 else asyncio.ALL_COMPLETED
-            )
+            # 全ての人狼のボタンが押されるか、締め切りまで待つ (各待ち合わせは締め切りでFalseを返す)
+            async with table_tasks.phase("人狼フェーズ") as scope:
+                pressed = await asyncio.gather(*[scope.spawn(wait_for_button_press(btn_client, deadline=deadline), f"werewolf:{i}")
+                                                 for i, btn_client in enumerate(button_clients_to_wait)])
 
-            if asyncio.sleep(PHASE_TIMEOUT_SECONDS) in done: # タイムアウトした場合
+            if not all(pressed): # タイムアウトした場合
                 print("人狼は時間内に操作を行いませんでした。")
             else:
                 print("人狼が確認しました。")
-            
-            # 残りのタスクをキャンセル
-            for task in pending:
-                task.cancel()
 
         except asyncio.CancelledError:
             print("人狼フェーズがキャンセルされました。")
@@ -455,78 +594,44 @@ async def run_werewolf_phase(clients):
                 if clients[w_id]["led"]:
                     await set_led_state(clients[w_id]["led"], COLOR_OFF) # 人狼のLEDを消灯
     else:
-        print("人狼はいません。10秒間待機します。")
-        await asyncio.sleep(PHASE_TIMEOUT_SECONDS)
+        print(f"人狼はいません。{PHASE_TIMEOUT_SECONDS}秒間待機します。")
+        await phase_deadlines.sleep_until(deadline)
 
 async def run_thief_phase(clients):
     # 怪盗の活動フェーズ
     thief_id = next((p_id for p_id, role in player_roles.items() if role == "怪盗"), None)
-    
+    deadline = phase_deadlines.deadline(PHASE_TIMEOUT_SECONDS)
+
     if thief_id and clients[thief_id]["led"] and clients[thief_id]["button"]:
         thief_led_client = clients[thief_id]["led"]
         thief_button_client = clients[thief_id]["button"]
         print(f"怪盗 ({thief_id}) の活動時間です。")
         await set_led_state(thief_led_client, ROLE_LED_MAP["怪盗"]["color"]) # オレンジ点灯
 
-        target_player_id = None
-        player_list = list(clients.keys())
-        current_target_index = 0
-
-        async def select_target_and_swap_logic():
-            nonlocal target_player_id, current_target_index
-            while True:
-                # ボタンイベントを待つ
-                button_state = await asyncio.wait_for(player_button_event_queues[thief_id].get(), timeout=None) # 無限に待つ
-
-                if button_state == 0x01: # 短押し
-                    current_target_index = (current_target_index + 1) % PLAYER_COUNT
-                    target_player_id = player_list[current_target_index] # 更新
-                    print(f"怪盗が {target_player_id} を選択中...")
-                    # 選択中のプレイヤーのLEDをそのプレイヤーの色で点灯
-                    for pid, pdata in clients.items():
-                        if pdata["led"]:
-                            if pid == target_player_id:
-                                await set_led_state(pdata["led"], PLAYER_COLORS[pid])
-                            else:
-                                await set_led_state(pdata["led"], COLOR_OFF)
-                    await asyncio.sleep(0.5) # 次の短押しまで少し待つ
-                elif button_state == 0x02: # 長押しで決定
-                    target_player_id = player_list[current_target_index]
-                    print(f"怪盗が {target_player_id} を長押しで決定しました。")
-                    
-                    # 役職の交換
-                    original_thief_role = player_roles[thief_id] # 怪盗自身の元の役職
-                    target_original_role = player_roles[target_player_id] # ターゲットの元の役職
-                    
-                    player_roles[thief_id] = target_original_role # 怪盗はターゲットの役職に
-                    player_roles[target_player_id] = original_thief_role # ターゲットは怪盗の役職に (怪盗カードは場からなくなる)
-
-                    print(f"怪盗が {target_player_id} と役職を交換しました。")
-                    print(f"怪盗の新しい役職: {player_roles[thief_id]}")
-
-                    # 交換後の怪盗の役職の色を点灯/点滅
-                    new_thief_role_config = ROLE_LED_MAP[player_roles[thief_id]]
-                    await set_led_state(thief_led_client, new_thief_role_config["color"], new_thief_role_config["blink"])
-                    return True # 長押しで決定
-                
         try:
-            # ターゲット選択と役職交換、タイムアウト
-            select_task = asyncio.create_task(select_target_and_swap_logic())
-            timeout_task = asyncio.create_task(asyncio.sleep(PHASE_TIMEOUT_SECONDS))
-            
-            done, pending = await asyncio.wait([select_task, timeout_task], return_when=asyncio.FIRST_COMPLETED)
-
-            if select_task in done and select_task.result(): # 長押しで決定された場合
-                print("怪盗は確認後、ボタンを押してください。")
-                # 確認ボタンが押されるまで待つ
-                await asyncio.wait_for(wait_for_button_press(thief_button_client), timeout=PHASE_TIMEOUT_SECONDS)
-            else: # タイムアウトした場合
-                print("怪盗は時間内に操作を行いませんでした。役職は交換されません。")
-            
-            # 残りのタスクをキャンセル
-            for task in pending:
-                task.cancel()
+            # ターゲット選択 (長押しで決定するか、締め切りでタイムアウト)
+            target_player_id = await phase_deadlines.wait(select_target(clients, thief_id, "怪盗"), deadline)
+
+            # 役職の交換
+            original_thief_role = player_roles[thief_id] # 怪盗自身の元の役職
+            target_original_role = player_roles[target_player_id] # ターゲットの元の役職
+
+            player_roles[thief_id] = target_original_role # 怪盗はターゲットの役職に
+            player_roles[target_player_id] = original_thief_role # ターゲットは怪盗の役職に (怪盗カードは場からなくなる)
+
+            print(f"怪盗が {target_player_id} と役職を交換しました。")
+            print(f"怪盗の新しい役職: {player_roles[thief_id]}")
 
+            # 交換後の怪盗の役職の色を点灯/点滅
+            new_thief_role_config = ROLE_LED_MAP[player_roles[thief_id]]
+            await set_led_state(thief_led_client, new_thief_role_config["color"], new_thief_role_config["blink"])
+
+            print("怪盗は確認後、ボタンを押してください。")
+            # 確認ボタンが押されるまで待つ (ターゲット選択と同じフェーズの締め切りまで)
+            if not await wait_for_button_press(thief_button_client, deadline=deadline):
+                print("怪盗は時間内に確認のボタンを押しませんでした。")
+        except asyncio.TimeoutError:
+            print("怪盗は時間内に操作を行いませんでした。役職は交換されません。")
         except asyncio.CancelledError:
             print("怪盗フェーズがキャンセルされました。")
         finally:
@@ -536,8 +641,8 @@ async def run_thief_phase(clients):
                 if pdata["led"]:
                     await set_led_state(pdata["led"], COLOR_OFF)
     else:
-        print("怪盗はいません、またはブロックが接続されていません。10秒間待機します。")
-        await asyncio.sleep(PHASE_TIMEOUT_SECONDS)
+        print(f"怪盗はいません、またはブロックが接続されていません。{PHASE_TIMEOUT_SECONDS}秒間待機します。")
+        await phase_deadlines.sleep_until(deadline)
 
 
 async def day_discussion_phase(clients):
@@ -551,14 +656,14 @@ async def day_discussion_phase(clients):
     await wait_for_motion_orientation(motion_client, ORIENTATION_RIGHT)
 
     # ブザーを長く1回鳴らす
-    await play_buzzer_sound(gpio_client, 1000) # 1000ms
+    buzzer.play("turn", PRIORITY_PHASE)
 
     print(f"議論時間開始！ ({DISCUSSION_TIME_SECONDS}秒)")
     await asyncio.sleep(DISCUSSION_TIME_SECONDS)
     print("議論時間終了！")
 
     # ブザーを長く1回鳴らす
-    await play_buzzer_sound(gpio_client, 1000) # 1000ms
+    buzzer.play("turn", PRIORITY_PHASE)
 
     print("動きブロックを「裏」の向きにしてください。") # ブザー音のみで促す
 
@@ -574,50 +679,57 @@ async def voting_phase(clients):
     await wait_for_motion_orientation(motion_client, ORIENTATION_BACK)
 
     # ブザーを長く1回鳴らす
-    await play_buzzer_sound(gpio_client, 1000) # 1000ms
+    buzzer.play("turn", PRIORITY_PHASE)
 
     print("投票を開始します。各プレイヤーは投票相手を選んで長押しで確定してください。")
 
-    vote_tasks = []
-    for voter_id, player_data in clients.items():
-        if player_data["button"] and player_data["led"]:
-            async def get_vote(voter_id, voter_button_client, voter_led_client):
-                target_player_id = None
-                player_list = list(clients.keys())
-                current_target_index = 0
-
-                # 自分のLEDを点灯（投票中であることを示す）
-                await set_led_state(voter_led_client, PLAYER_COLORS[voter_id])
-
-                while True:
-                    # ボタンイベントを待つ
-                    button_state = await asyncio.wait_for(player_button_event_queues[voter_id].get(), timeout=None) # 無限に待つ
-
-                    if button_state == 0x01: # 短押し
-                        current_target_index = (current_target_index + 1) % PLAYER_COUNT
-                        target_player_id = player_list[current_target_index] # 更新
+    # 投票の待ち合わせはフェーズを抜けるときに必ず回収する
+    # (締め切りまでに長押ししなかったプレイヤーの待ち合わせは、フェーズを抜けるときにキャンセルされる)
+    deadline = phase_deadlines.deadline(VOTE_TIMEOUT_SECONDS)
+    async with table_tasks.phase(current_turn) as scope:
+        vote_tasks = []
+        for voter_id, player_data in clients.items():
+            if player_data["button"] and player_data["led"]:
+                async def get_vote(voter_id, voter_button_client, voter_led_client):
+                    target_player_id = None
+                    player_list = list(clients.keys())
+                    current_target_index = 0
+
+                    # 自分のLEDを点灯（投票中であることを示す）
+                    await led_animator.set_state(voter_led_client, PLAYER_COLORS[voter_id], priority=PRIORITY_CRITICAL)
+
+                    while True:
+                        # ボタンイベントを待つ
+                        button_state = await player_button_event_queues[voter_id].get() # 無限に待つ
+
+                        if button_state == 0x01: # 短押し
+                            current_target_index = (current_target_index + 1) % len(player_list)
+                            target_player_id = player_list[current_target_index] # 更新
                         
-                        # 選択中のプレイヤーのLEDをそのプレイヤーの色で点灯（一時的に）
-                        # 他のプレイヤーのLEDは触らない
-                        temp_target_led_client = clients[target_player_id]["led"]
-                        if temp_target_led_client:
-                            await set_led_state(temp_target_led_client, PLAYER_COLORS[target_player_id])
-                            await asyncio.sleep(0.3) # 短く点灯
-                            await set_led_state(temp_target_led_client, COLOR_OFF) # 消灯
-
-                    elif button_state == 0x02: # 長押しで確定
-                        target_player_id = player_list[current_target_index]
-                        player_votes[voter_id] = target_player_id
-                        print(f"{voter_id} が {target_player_id} に投票しました。")
-                        await set_led_state(voter_led_client, COLOR_OFF) # 投票完了でLEDを消灯
-                        return # 投票完了
-            vote_tasks.append(asyncio.create_task(get_vote(voter_id, player_data["button"], player_data["led"])))
-
-    await asyncio.gather(*vote_tasks)
-    print("全ての投票が完了しました。")
+                            # 選択中のプレイヤーのLEDをそのプレイヤーの色で点灯（一時的に）
+                            # 点灯と元に戻す処理はアニメーションに任せ、次の押下をすぐ受け付ける
+                            temp_target_led_client = clients[target_player_id]["led"]
+                            if temp_target_led_client:
+                                led_animator.pulse(temp_target_led_client, PLAYER_COLORS[target_player_id], 0.3, priority=PRIORITY_FEEDBACK)
+
+                        elif button_state == 0x02: # 長押しで確定
+                            target_player_id = player_list[current_target_index]
+                            player_votes[voter_id] = target_player_id
+                            input_log.info("%s が %s に投票しました。", voter_id, target_player_id)
+                            await led_animator.set_state(voter_led_client, COLOR_OFF, priority=PRIORITY_CRITICAL) # 投票完了でLEDを消灯
+                            return # 投票完了
+                vote_tasks.append(scope.spawn(get_vote(voter_id, player_data["button"], player_data["led"]), f"vote:{voter_id}"))
+
+        try:
+            await phase_deadlines.wait(asyncio.gather(*vote_tasks), deadline)
+            print("全ての投票が完了しました。")
+        except asyncio.TimeoutError:
+            missing = [voter_id for voter_id, player_data in clients.items()
+                       if player_data["button"] and player_data["led"] and voter_id not in player_votes]
+            print(f"投票の時間切れです。投票しなかったプレイヤー: {', '.join(missing)}")
 
     # ブザーを鳴らす
-    await play_buzzer_sound(gpio_client, 1000)
+    buzzer.play("turn", PRIORITY_PHASE)
 
     # 投票結果の表示
     if not player_votes:
@@ -633,15 +745,11 @@ async def voting_phase(clients):
 
     print(f"最も多く投票されたプレイヤー: {', '.join(most_voted_players)} ({max_votes}票)")
 
-    # 最も多く投票されたプレイヤーのLEDを5回点滅
+    # 最も多く投票されたプレイヤーのLEDを5回点滅 (同数票の場合は全員同時に)
     for p_id in most_voted_players:
         if clients[p_id]["led"]:
-            client = clients[p_id]["led"]
-            for _ in range(5):
-                await set_led_state(client, PLAYER_COLORS[p_id])
-                await asyncio.sleep(0.2)
-                await set_led_state(client, COLOR_OFF)
-                await asyncio.sleep(0.2)
+            led_animator.flash(clients[p_id]["led"], PLAYER_COLORS[p_id], times=5, interval=0.2, end_state=(COLOR_OFF, False))
+    await led_animator.wait_idle()
     await asyncio.sleep(1) # 点滅後少し待つ
 
     return most_voted_players
@@ -659,46 +767,12 @@ async def determine_and_display_winner(clients, most_voted_players):
     
     print(f"処刑されたプレイヤー: {', '.join(executed_players) if executed_players else 'なし'}")
 
-    # 処刑後の人狼の数を数える
-    remaining_werewolves = 0
-    for p_id, role in player_roles.items():
-        if role == "人狼" and p_id not in executed_players:
-            remaining_werewolves += 1
-
-    winning_team = None
-    if not executed_players: # 処刑される人がいない場合
-        if remaining_werewolves == 0:
-            winning_team = "全員" # 人狼が1人もいない場合は、プレイヤー全員の勝利
-        else:
-            winning_team = "人狼チーム" # 人狼が1人でも残っていた場合は、人狼チームの勝利
-    else: # 処刑された人がいる場合
-        werewolf_executed = any(player_roles[p_id] == "人狼" for p_id in executed_players)
-        if werewolf_executed:
-            winning_team = "市民チーム" # 処刑された2人のどちらかに人狼がいれば人間チームの勝利
-        else:
-            winning_team = "人狼チーム" # 両方とも市民だった場合、人狼チームの勝利
+    # 座席マスクに変換して事前計算テーブルから勝敗を引く
+    winning_team, winning_players, losing_players = determine_outcome(
+        list(clients.keys()), player_roles, executed_players)
 
     print(f"勝利チーム: {winning_team}")
 
-    # LED表示
-    winning_players = []
-    losing_players = []
-
-    if winning_team == "全員":
-        winning_players = list(clients.keys())
-    elif winning_team == "市民チーム":
-        for p_id, role in player_roles.items():
-            if role in ["市民", "占い師", "怪盗"]:
-                winning_players.append(p_id)
-            elif role == "人狼":
-                losing_players.append(p_id)
-    elif winning_team == "人狼チーム":
-        for p_id, role in player_roles.items():
-            if role == "人狼":
-                winning_players.append(p_id)
-            else:
-                losing_players.append(p_id)
-
     print("勝敗結果表示")
     for p_id, player_data in clients.items():
         if player_data["led"]:
@@ -712,7 +786,7 @@ async def determine_and_display_winner(clients, most_voted_players):
                 await set_led_state(player_data["led"], COLOR_OFF)
 
 
-    await play_buzzer_sound(gpio_client, 2000) # 長く鳴らす
+    buzzer.play("result", PRIORITY_RESULT) # 長く鳴らす
     await asyncio.sleep(5) # 結果表示のために5秒間待機
     
     # 全てのLEDを消灯して終了
@@ -720,45 +794,185 @@ async def determine_and_display_winner(clients, most_voted_players):
         if player_data["led"]:
             await set_led_state(player_data["led"], COLOR_OFF)
 
-# メイン関数
-async def main():
-    global player_clients, gpio_client, motion_client
+    return winning_players
+
+# チェックポイント
+def save_checkpoint(path, completed_phase, clients, most_voted):
+    # フェーズ終了時点のゲーム状態を書き出す
+    # 一時ファイルに書いてfsyncしてから置き換えるので、途中で落ちても前のチェックポイントが残る
+    checkpoint = {
+        "completed_phase": completed_phase,
+        "current_turn": current_turn,
+        "seats": list(clients.keys()),
+        "player_roles": player_roles, # 怪盗の交換後の役職
+        "player_votes": player_votes,
+        "most_voted": most_voted,
+        "led_states": {
+            p_id: {"color": list(get_led_state(p_data["led"])[0]), "blink": get_led_state(p_data["led"])[1]}
+            for p_id, p_data in clients.items() if p_data["led"]
+        },
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path, seats):
+    # 同じ卓のチェックポイントがあれば読み込む (なければNone)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: チェックポイントを読み込めませんでした ({path}): {e}")
+        return None
+    if checkpoint.get("seats") != list(seats) or checkpoint.get("completed_phase") not in GAME_PHASES:
+        print(f"Warning: チェックポイントが現在の卓の設定と一致しないため、最初から始めます ({path})")
+        return None
+    return checkpoint
+
+def remove_checkpoint(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+async def restore_checkpoint(checkpoint, clients):
+    # チェックポイントのゲーム状態とLED表示を復元する
+    global current_turn, player_roles, player_votes
+    current_turn = checkpoint["current_turn"]
+    player_roles = dict(checkpoint["player_roles"])
+    player_votes = dict(checkpoint["player_votes"])
+    await asyncio.gather(*[
+        set_led_state(clients[p_id]["led"], tuple(state["color"]), state["blink"])
+        for p_id, state in checkpoint["led_states"].items() if clients[p_id]["led"]
+    ])
+    print(f"チェックポイントから再開します: 「{checkpoint['completed_phase']}」まで完了")
+
+async def run_game(clients, checkpoint=None, checkpoint_path=CHECKPOINT_FILE_NAME):
+    # ゲームの各ターンを順番に実行し、ターンが終わるたびにチェックポイントを書く
+    # 勝利したプレイヤーのリストを返す (勝敗判定をしなかった場合はNone)
+    most_voted = None
+    winning_players = None
+    start_index = 0
+    if checkpoint:
+        await restore_checkpoint(checkpoint, clients)
+        most_voted = checkpoint["most_voted"]
+        start_index = GAME_PHASES.index(checkpoint["completed_phase"]) + 1
+
+    for phase in GAME_PHASES[start_index:]:
+        if phase == "リセット":
+            await reset_game(clients)
+        elif phase == "役職配布":
+            await distribute_roles(clients)
+        elif phase == "夜の活動時間":
+            await night_activity_phase(clients)
+        elif phase == "昼の議論時間":
+            await day_discussion_phase(clients)
+        elif phase == "投票時間":
+            most_voted = await voting_phase(clients)
+        elif phase == "勝敗判定":
+            if most_voted is not None:
+                winning_players = await determine_and_display_winner(clients, most_voted)
+            else:
+                print("投票が正常に行われなかったため、勝敗判定をスキップします。")
+        save_checkpoint(checkpoint_path, phase, clients, most_voted)
 
-    print("MESHブロックをスキャン中...")
-    devices = await BleakScanner.discover(timeout=5.0)
+    # ゲームが最後まで終わったのでチェックポイントは不要
+    remove_checkpoint(checkpoint_path)
+    return winning_players
+
+# セッション (同じ接続のまま複数ゲームを続けて遊ぶ)
+def all_blocks(clients):
+    # 卓の全ブロック [(block_id, client), ...]
+    blocks = []
+    for player_id, player_data in clients.items():
+        blocks.append((f"{player_id}_LED", player_data["led"]))
+        blocks.append((f"{player_id}_BUTTON", player_data["button"]))
+    blocks.append(("gpio_block", gpio_client))
+    blocks.append(("motion_block", motion_client))
+    return [(block_id, client) for block_id, client in blocks if client]
+
+async def disconnect_block(client):
+    # ブロックから切断する (リンク品質の計測には予期しない切断として数えない)
+    if client in block_links:
+        await block_links[client].disconnect(client)
+    else:
+        await client.disconnect()
+
+async def check_block_health(clients):
+    # ゲームの合間に全ブロックの接続を確認し、切れていれば同じクライアントで再接続して通知を購読し直す
+    healthy = True
+    for block_id, client in all_blocks(clients):
+        if client.is_connected:
+            continue
+        print(f"{block_id} との接続が切れています。再接続します...")
+        try:
+            await client.connect()
+            if client in block_links:
+                block_links[client].apply(client)
+            await client.start_notify(STATE_INDICATION_CHAR_UUID, handle_state_indication)
+            if client in block_notify_handlers:
+                await client.start_notify(NOTIFICATION_CHAR_UUID, block_notify_handlers[client])
+            print(f"{block_id} に再接続しました。")
+        except Exception as e:
+            print(f"Error: {block_id} に再接続できませんでした: {e}")
+            healthy = False
+    return healthy
+
+def reset_event_queues():
+    # 前のゲームで読まれずに残ったボタン・動きのイベントを捨てる
+    for queue in list(player_button_event_queues.values()) + [motion_orientation_event_queue]:
+        while not queue.empty():
+            queue.get_nowait()
+
+def record_round(round_number, winning_players):
+    # セッションの累計スコアを更新して表示する
+    for p_id in winning_players or []:
+        session_scores[p_id] += 1
+    print(f"\n第{round_number}ゲーム終了時点の勝利数:")
+    for p_id in player_clients:
+        print(f"  {p_id}: {session_scores[p_id]}勝")
+
+# メイン関数
+async def main(resume=True, checkpoint_path=CHECKPOINT_FILE_NAME, rounds=1, broker_path=None, lag_threshold_ms=None):
+    # rounds: 続けて遊ぶゲーム数 (0ならCtrl-Cで止めるまで)。ゲームの間も接続と通知の購読は維持する
+    # broker_path: mesh_broker のソケット。指定するとスキャン・接続をせずにブローカーの接続を使う
+    # lag_threshold_ms: 指定するとイベントループの遅れを計り、これ以上止めたコードを記録する
+    global player_clients, gpio_client, motion_client, broker, lag_monitor
+
+    if lag_threshold_ms:
+        lag_monitor = LoopLagMonitor(lag_threshold_ms)
+        lag_monitor.start()
+
+    if broker_path:
+        print(f"MESHブローカーに接続中... ({broker_path})")
+        broker = await BrokerClient.connect(broker_path)
+        serials = [sn for sn in [*PLAYER_LED_SN.values(), *PLAYER_BUTTON_SN.values(), GPIO_BLOCK_SN, MOTION_BLOCK_SN] if sn]
+        blocks = await broker.discover_blocks(serials)
+    else:
+        print("MESHブロックをスキャン中...")
+        # MESHブロックだけを {シリアルナンバー: (種別, device, adv)} で受け取る
+        blocks = await discover_blocks(timeout=5.0)
     
     # 検出されたMESHブロックを識別子でマッピングするための辞書
     # {シリアルナンバーSuffix: BleakDeviceオブジェクト}
     discovered_mesh_devices_by_sn_suffix = {}
+    discovered_rssi = {} # {アドレス: アドバタイズのRSSI}
     
     print("検出されたデバイス:")
-    for d in devices:
-        if d.name and d.name.startswith("MESH-"):
-            print(f"  Name: {d.name}, Address: {d.address}")
-            # MESH-100BU, MESH-100LE, MESH-100AC, MESH-100GP
-            # 最後の 'U', 'E', 'C', 'P' の後から最後までがシリアルナンバーのサフィックス
-            sn_suffix = None
-            if 'U' in d.name: # Button Block
-                sn_suffix = d.name[d.name.rfind('U')+1:]
-            elif 'E' in d.name: # LED Block
-                sn_suffix = d.name[d.name.rfind('E')+1:]
-            elif 'C' in d.name: # Motion Block (AC)
-                sn_suffix = d.name[d.name.rfind('C')+1:]
-            elif 'P' in d.name: # GPIO Block (GP)
-                sn_suffix = d.name[d.name.rfind('P')+1:]
-            
-            if sn_suffix:
-                discovered_mesh_devices_by_sn_suffix[sn_suffix] = d
-                print(f"    -> シリアルナンバー識別子: {sn_suffix}")
-            else:
-                print(f"    -> シリアルナンバー識別子を抽出できませんでした。")
+    for serial, (block_type, d, adv) in blocks.items():
+        print(f"  Name: {d.name}, Address: {d.address}, RSSI: {adv.rssi}")
+        print(f"    -> {BLOCK_TYPE_NAMES[block_type]}ブロック, シリアルナンバー識別子: {serial}")
+        discovered_rssi[d.address] = adv.rssi
+        discovered_mesh_devices_by_sn_suffix[serial] = d
 
 
     print("\nMESHブロックに接続中...")
     
     # プレイヤーブロックの接続 (LEDとボタンを個別に)
-    for i in range(1, PLAYER_COUNT + 1):
-        player_id = f"player{i}"
+    for player_id in PLAYER_IDS:
         player_clients[player_id] = {"led": None, "button": None} # 初期化
         player_button_event_queues[player_id] = asyncio.Queue() # 各プレイヤーのボタンイベントキューを初期化
 
@@ -766,7 +980,8 @@ async def main():
         led_sn = PLAYER_LED_SN.get(player_id)
         if led_sn and led_sn in discovered_mesh_devices_by_sn_suffix:
             led_device = discovered_mesh_devices_by_sn_suffix[led_sn]
-            led_client = await connect_to_mesh_block(led_device.address, f"{player_id}_LED")
+            led_client = await connect_to_mesh_block(led_device.address, f"{player_id}_LED", "led",
+                                               discovered_rssi.get(led_device.address))
             if led_client:
                 player_clients[player_id]["led"] = led_client
             else:
@@ -778,12 +993,15 @@ async def main():
         button_sn = PLAYER_BUTTON_SN.get(player_id)
         if button_sn and button_sn in discovered_mesh_devices_by_sn_suffix:
             button_device = discovered_mesh_devices_by_sn_suffix[button_sn]
-            button_client = await connect_to_mesh_block(button_device.address, f"{player_id}_BUTTON")
+            button_client = await connect_to_mesh_block(button_device.address, f"{player_id}_BUTTON", "button",
+                                                  discovered_rssi.get(button_device.address))
             if button_client:
                 player_clients[player_id]["button"] = button_client
                 # ボタン通知を開始
                 try:
-                    await button_client.start_notify(NOTIFICATION_CHAR_UUID, button_notification_handler_factory(player_id))
+                    handler = block_links[button_client].wrap(button_notification_handler_factory(player_id))
+                    await button_client.start_notify(NOTIFICATION_CHAR_UUID, handler)
+                    block_notify_handlers[button_client] = handler
                     print(f"Started button notifications for {player_id}")
                 except Exception as e:
                     print(f"Error starting button notifications for {player_id}: {e}")
@@ -795,22 +1013,28 @@ async def main():
     # GPIOブロックの接続
     gpio_device = discovered_mesh_devices_by_sn_suffix.get(GPIO_BLOCK_SN)
     if gpio_device:
-        gpio_client = await connect_to_mesh_block(gpio_device.address, "gpio_block")
+        gpio_client = await connect_to_mesh_block(gpio_device.address, "gpio_block", "gpio",
+                                            discovered_rssi.get(gpio_device.address))
         if not gpio_client:
             print("Warning: GPIOブロックに接続できませんでした。ブザーは機能しません。")
+        buzzer.client = gpio_client
+        buzzer.writer = block_writers.get(gpio_client)
     else:
         print(f"Warning: GPIOブロック (SN: {GPIO_BLOCK_SN}) が見つかりませんでした。")
 
     # 動きブロックの接続
     motion_device = discovered_mesh_devices_by_sn_suffix.get(MOTION_BLOCK_SN)
     if motion_device:
-        motion_client = await connect_to_mesh_block(motion_device.address, "motion_block")
+        motion_client = await connect_to_mesh_block(motion_device.address, "motion_block", "motion",
+                                              discovered_rssi.get(motion_device.address))
         if not motion_client:
             print("Warning: 動きブロックに接続できませんでした。ターンの遷移は機能しません。")
         else:
             # 動きセンサー通知を開始
             try:
-                await motion_client.start_notify(NOTIFICATION_CHAR_UUID, motion_notification_handler)
+                handler = block_links[motion_client].wrap(motion_notification_handler)
+                await motion_client.start_notify(NOTIFICATION_CHAR_UUID, handler)
+                block_notify_handlers[motion_client] = handler
                 print("Started motion notifications.")
             except Exception as e:
                 print(f"Error starting motion notifications: {e}")
@@ -830,28 +1054,38 @@ async def main():
         # 接続できなかったクライアントをクローズ
         for player_id, clients_data in player_clients.items():
             if clients_data["led"] and clients_data["led"].is_connected:
-                await clients_data["led"].disconnect()
+                await disconnect_block(clients_data["led"])
             if clients_data["button"] and clients_data["button"].is_connected:
-                await clients_data["button"].disconnect()
+                await disconnect_block(clients_data["button"])
         if gpio_client and gpio_client.is_connected:
-            await gpio_client.disconnect()
+            await disconnect_block(gpio_client)
         if motion_client and motion_client.is_connected:
-            await motion_client.disconnect()
+            await disconnect_block(motion_client)
         return
 
     print("\n全てのMESHブロックに接続しました。ゲームを開始します。")
 
+    checkpoint = load_checkpoint(checkpoint_path, player_clients.keys()) if resume else None
+    if not resume:
+        remove_checkpoint(checkpoint_path)
+
     try:
-        # ゲームの各ターンを順番に実行
-        await reset_game(player_clients)
-        await distribute_roles(player_clients)
-        await night_activity_phase(player_clients)
-        await day_discussion_phase(player_clients)
-        most_voted = await voting_phase(player_clients)
-        if most_voted is not None:
-            await determine_and_display_winner(player_clients, most_voted)
-        else:
-            print("投票が正常に行われなかったため、勝敗判定をスキップします。")
+        round_number = 0
+        while True:
+            round_number += 1
+            if rounds != 1:
+                print(f"\n===== 第{round_number}ゲーム =====")
+            winning_players = await run_game(player_clients, checkpoint, checkpoint_path)
+            checkpoint = None
+            if rounds != 1:
+                record_round(round_number, winning_players)
+            if rounds and round_number >= rounds:
+                break
+            # 次のゲームの前にブロックの状態を確認し、残ったイベントを捨てて reset_game から始める
+            if not await check_block_health(player_clients):
+                print("再接続できないブロックがあるため、セッションを終了します。")
+                break
+            reset_event_queues()
 
     except Exception as e:
         print(f"ゲーム中にエラーが発生しました: {e}")
@@ -859,22 +1093,26 @@ async def main():
         print("\nゲーム終了。全てのMESHブロックから切断します。")
         # 全てのクライアントを切断
         for player_id, clients_data in player_clients.items():
-            if clients and clients_data["led"] and clients_data["led"].is_connected:
+            if clients_data["led"] and clients_data["led"].is_connected:
                 # 通知を停止 (LEDブロックは通常Notify/Indicateを送信しないが、念のため)
                 try:
                     await clients_data["led"].stop_notify(NOTIFICATION_CHAR_UUID)
                     await clients_data["led"].stop_notify(STATE_INDICATION_CHAR_UUID)
                 except Exception:
                     pass # エラーを無視
-                await clients_data["led"].disconnect()
-            if clients and clients_data["button"] and clients_data["button"].is_connected:
+                await disconnect_block(clients_data["led"])
+            if clients_data["button"] and clients_data["button"].is_connected:
                 # 通知を停止
                 try:
                     await clients_data["button"].stop_notify(NOTIFICATION_CHAR_UUID)
                     await clients_data["button"].stop_notify(STATE_INDICATION_CHAR_UUID)
                 except Exception as e:
                     print(f"Error stopping button notifications for {player_id}: {e}")
-                await clients_data["button"].disconnect()
+                await disconnect_block(clients_data["button"])
+        buzzer.stop()
+        # 書き込みキューを止める (送信前の書き込みは破棄)
+        await asyncio.gather(*[writer.close() for writer in block_writers.values()])
+        block_writers.clear()
         if gpio_client and gpio_client.is_connected:
             # 通知を停止 (GPIOブロックは通常Notify/Indicateを送信しないが、念のため)
             try:
@@ -882,7 +1120,7 @@ async def main():
                 await gpio_client.stop_notify(STATE_INDICATION_CHAR_UUID)
             except Exception:
                 pass # エラーを無視
-            await gpio_client.disconnect()
+            await disconnect_block(gpio_client)
         if motion_client and motion_client.is_connected:
             # 通知を停止
             try:
@@ -890,16 +1128,44 @@ async def main():
                 await motion_client.stop_notify(STATE_INDICATION_CHAR_UUID)
             except Exception as e:
                 print(f"Error stopping motion notifications: {e}")
-            await motion_client.disconnect()
+            await disconnect_block(motion_client)
         print("切断完了。")
+        print("リンク品質:")
+        print(link_monitor.report(block_links.values()))
+        if lag_monitor:
+            await lag_monitor.stop()
+            print(lag_monitor.report())
+        print("計測値:")
+        print(mesh_metrics.summary())
+        if broker:
+            await broker.close()
 
 if __name__ == "__main__":
-    # プレイヤーの色のマッピングを初期化
-    # プレイヤーIDと色の対応を定義
-    PLAYER_COLORS = {
-        "player1": COLOR_RED,
-        "player2": COLOR_GREEN,
-        "player3": COLOR_BLUE,
-        "player4": COLOR_YELLOW,
-    }
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="MESHブロックで遊ぶワンナイト人狼")
+    parser.add_argument("--config", default=CONFIG_FILE_NAME, help="卓の人数・ブロック・役職カードの設定ファイル (JSON)")
+    parser.add_argument("--trace-tasks", action="store_true", help="フェーズごとのタスクの数・所要時間・取り残しを表示する")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE_NAME, help="進行中のゲームのチェックポイントファイル")
+    parser.add_argument("--no-resume", action="store_true", help="チェックポイントがあっても最初から始める")
+    parser.add_argument("--rounds", type=int, default=1, help="接続したまま続けて遊ぶゲーム数 (0ならCtrl-Cで止めるまで)")
+    parser.add_argument("--log-level", default="", help="カテゴリごとのログレベル (例: notify=debug,input=warning)")
+    parser.add_argument("--log-file", help="イベントログをJSON Linesで書き出すファイル")
+    parser.add_argument("--broker", nargs="?", const=SOCKET_PATH, metavar="SOCKET",
+                        help="mesh_broker デーモンの接続を使う (スキャンと接続を待たずに始められる)")
+    parser.add_argument("--lag-threshold", type=float, default=THRESHOLD_MS, metavar="MS",
+                        help="イベントループをこのミリ秒以上止めたコードを記録する (0で監視しない)")
+    args = parser.parse_args()
+    try:
+        log_levels = event_log.parse_levels(args.log_level)
+    except ValueError as e:
+        parser.error(str(e))
+    table_tasks.trace = TASK_TRACE or args.trace_tasks
+    if os.path.exists(args.config):
+        load_config(args.config)
+    elif args.config != CONFIG_FILE_NAME:
+        parser.error(f"設定ファイルが見つかりません: {args.config}")
+    event_log.configure(log_levels, args.log_file)
+    try:
+        asyncio.run(main(resume=not args.no_resume, checkpoint_path=args.checkpoint, rounds=args.rounds,
+                         broker_path=args.broker, lag_threshold_ms=args.lag_threshold))
+    finally:
+        event_log.shutdown()
\ No newline at end of file
@@ -0,0 +1,144 @@
+import itertools
+
+# 勝敗判定の事前計算テーブル
+# 座席i (プレイヤーの並び順) をビットiとするビットマスクで
+# 「人狼の座席」と「処刑された座席」を表し、勝敗をテーブル引きで求める。
+
+TEAM_ALL = "全員"
+TEAM_VILLAGE = "市民チーム"
+TEAM_WEREWOLF = "人狼チーム"
+
+WEREWOLF_ROLE = "人狼"
+VILLAGE_ROLES = ["市民", "占い師", "怪盗"]
+
+# 勝者・敗者の座席マスクの選び方
+SELECT_NONE = 0      # 誰もいない
+SELECT_ALL = 1       # 全座席
+SELECT_WOLF = 2      # 人狼の座席
+SELECT_NON_WOLF = 3  # 人狼以外の座席
+
+# キーのビット
+# bit0: 処刑された人がいる
+# bit1: 処刑されずに残った人狼がいる
+# bit2: 処刑された人狼がいる
+KEY_EXECUTED = 0x01
+KEY_WOLF_REMAINING = 0x02
+KEY_WOLF_EXECUTED = 0x04
+
+def _build_outcome_table():
+    # 8通りのキーに対する (勝利チーム, 勝者の選び方, 敗者の選び方)
+    table = [None] * 8
+    for key in range(8):
+        executed = key & KEY_EXECUTED
+        if not executed:
+            if key & KEY_WOLF_EXECUTED:
+                continue # 処刑なしで人狼が処刑されることはない
+            if key & KEY_WOLF_REMAINING:
+                table[key] = (TEAM_WEREWOLF, SELECT_WOLF, SELECT_NON_WOLF)
+            else:
+                table[key] = (TEAM_ALL, SELECT_ALL, SELECT_NONE)
+        elif key & KEY_WOLF_EXECUTED:
+            table[key] = (TEAM_VILLAGE, SELECT_NON_WOLF, SELECT_WOLF)
+        else:
+            table[key] = (TEAM_WEREWOLF, SELECT_WOLF, SELECT_NON_WOLF)
+    return tuple(table)
+
+OUTCOME_TABLE = _build_outcome_table()
+
+def encode_roles(seats, roles):
+    # 役職の割り当てを人狼の座席マスクに変換
+    wolf_mask = 0
+    for bit, p_id in enumerate(seats):
+        if roles.get(p_id) == WEREWOLF_ROLE:
+            wolf_mask |= 1 << bit
+    return wolf_mask
+
+def encode_players(seats, player_ids):
+    # プレイヤーIDのリストを座席マスクに変換
+    mask = 0
+    for bit, p_id in enumerate(seats):
+        if p_id in player_ids:
+            mask |= 1 << bit
+    return mask
+
+def decode_players(seats, mask):
+    # 座席マスクをプレイヤーIDのリストに戻す
+    return [p_id for bit, p_id in enumerate(seats) if mask >> bit & 1]
+
+def lookup_outcome(seat_count, wolf_mask, executed_mask):
+    # (勝利チーム, 勝者マスク, 敗者マスク) をテーブルから引く
+    key = (
+        (KEY_EXECUTED if executed_mask else 0)
+        | (KEY_WOLF_REMAINING if wolf_mask & ~executed_mask else 0)
+        | (KEY_WOLF_EXECUTED if wolf_mask & executed_mask else 0)
+    )
+    team, win_select, lose_select = OUTCOME_TABLE[key]
+    all_mask = (1 << seat_count) - 1
+    masks = (0, all_mask, wolf_mask, all_mask & ~wolf_mask)
+    return team, masks[win_select], masks[lose_select]
+
+def determine_outcome(seats, roles, executed_players):
+    # 座席順・役職・処刑者から (勝利チーム, 勝者リスト, 敗者リスト) を求める
+    team, win_mask, lose_mask = lookup_outcome(
+        len(seats), encode_roles(seats, roles), encode_players(seats, executed_players))
+    return team, decode_players(seats, win_mask), decode_players(seats, lose_mask)
+
+def determine_outcome_by_branches(seats, roles, executed_players):
+    # テーブル導入前の分岐による勝敗判定 (検証用の基準実装)
+    remaining_werewolves = 0
+    for p_id, role in roles.items():
+        if role == WEREWOLF_ROLE and p_id not in executed_players:
+            remaining_werewolves += 1
+
+    if not executed_players:
+        if remaining_werewolves == 0:
+            winning_team = TEAM_ALL
+        else:
+            winning_team = TEAM_WEREWOLF
+    else:
+        werewolf_executed = any(roles[p_id] == WEREWOLF_ROLE for p_id in executed_players)
+        if werewolf_executed:
+            winning_team = TEAM_VILLAGE
+        else:
+            winning_team = TEAM_WEREWOLF
+
+    winning_players = []
+    losing_players = []
+    if winning_team == TEAM_ALL:
+        winning_players = list(seats)
+    elif winning_team == TEAM_VILLAGE:
+        for p_id, role in roles.items():
+            if role in VILLAGE_ROLES:
+                winning_players.append(p_id)
+            elif role == WEREWOLF_ROLE:
+                losing_players.append(p_id)
+    elif winning_team == TEAM_WEREWOLF:
+        for p_id, role in roles.items():
+            if role == WEREWOLF_ROLE:
+                winning_players.append(p_id)
+            else:
+                losing_players.append(p_id)
+    return winning_team, winning_players, losing_players
+
+def verify_outcome_table(deck, player_count):
+    # 山札から配りうる全ての役職割り当てと、全ての処刑者の組み合わせ
+    # (処刑なし・同数票による複数処刑を含む) で基準実装と一致するか確認する
+    seats = [f"player{i}" for i in range(1, player_count + 1)]
+    checked = 0
+    for assigned in set(itertools.permutations(deck, player_count)):
+        roles = dict(zip(seats, assigned))
+        for executed_mask in range(1 << player_count):
+            executed = decode_players(seats, executed_mask)
+            expected_team, expected_win, expected_lose = determine_outcome_by_branches(seats, roles, executed)
+            team, win, lose = determine_outcome(seats, roles, executed)
+            if (team, set(win), set(lose)) != (expected_team, set(expected_win), set(expected_lose)):
+                raise AssertionError(f"勝敗判定の不一致: roles={roles} executed={executed} "
+                                     f"expected={expected_team, expected_win, expected_lose} "
+                                     f"actual={team, win, lose}")
+            checked += 1
+    return checked
+
+if __name__ == "__main__":
+    deck = ["占い師", "怪盗", "市民", "市民", "人狼", "人狼"]
+    checked = verify_outcome_table(deck, 4)
+    print(f"勝敗判定テーブルを検証しました: {checked}通り一致")
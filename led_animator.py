@@ -0,0 +1,142 @@
+import asyncio
+import math
+
+# LEDアニメーションのスケジューラ
+# 卓に1つだけ置き、動いている全てのアニメーションを1本のループで進める。
+# 各LEDに書き込むのは「今表示すべき状態が変わったとき」だけで、
+# 同じ時刻に切り替わるフレームは1回の起床でまとめて書き込む。
+# 呼び出し側はアニメーションを登録したらすぐ戻るので、入力処理を待たせない。
+
+TICK_SECONDS = 0.02 # フレームの切り替え時刻をこの刻みにそろえて起床回数を減らす
+NATIVE_BLINK_PERIOD_SECONDS = 0.4 # ブロックの点滅フラグでの点滅1回 (点灯+消灯) の長さ
+
+class LedAnimator:
+    def __init__(self, write_led, read_led, native_blink=True, tick_seconds=TICK_SECONDS, default_priority=None,
+                 native_blink_period=NATIVE_BLINK_PERIOD_SECONDS):
+        # write_led(client, color, blink, priority): LEDへ書き込むコルーチン関数
+        # read_led(client): 現在LEDに表示している (color, blink)
+        # priority はそのまま write_led に渡す (書き込みキューの優先度クラスなど)
+        self.write_led = write_led
+        self.read_led = read_led
+        self.default_priority = default_priority
+        self.native_blink = native_blink # ブロック側の点滅フラグを使えるか
+        self.native_blink_period = native_blink_period
+        self.tick_seconds = tick_seconds
+        self.animations = {} # {client: [アニメーション, ...]} 後から登録したものが優先
+        self.bases = {}      # {client: (color, blink)} アニメーション終了後に戻す状態
+        self.priorities = {} # {client: priority} 元に戻す書き込みの優先度 (最後の play() か set_state() のもの)
+        self.ticker = None
+        self.wakeup = asyncio.Event() # アニメーションが変わった (書き込み中に変わっても次の待ちですぐ起きる)
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.write_count = 0
+
+    def play(self, client, frames, end_state=None, priority=None):
+        # frames: [(color, blink, 秒数), ...] を順に表示する
+        # end_state を省略すると、アニメーション開始前の状態に戻す
+        if not client or not frames:
+            return
+        loop = asyncio.get_running_loop()
+        if client not in self.animations:
+            self.animations[client] = []
+            self.bases[client] = self.read_led(client)
+        if end_state is not None:
+            self.bases[client] = end_state
+        if priority is None:
+            priority = self.default_priority
+        self.priorities[client] = priority
+        start = loop.time()
+        boundaries = []
+        elapsed = 0
+        for _, _, duration in frames:
+            elapsed += duration
+            boundaries.append(start + elapsed)
+        self.animations[client].append({"frames": frames, "boundaries": boundaries, "end": start + elapsed,
+                                        "priority": priority})
+        self.idle.clear()
+        if self.ticker is None:
+            self.ticker = asyncio.create_task(self._run())
+        else:
+            self._wake()
+
+    def flash(self, client, color, times=5, interval=0.2, end_state=None, priority=None):
+        # times 回点滅させる。可能ならブロックの点滅フラグを使い、書き込みを2回で済ませる
+        # (点滅の速さはブロックが決めるので、interval ではなくブロックの点滅 times 回分で止める)
+        if self.native_blink:
+            frames = [(color, True, times * self.native_blink_period)]
+        else:
+            frames = [(color, False, interval), ((0, 0, 0), False, interval)] * times
+        self.play(client, frames, end_state, priority)
+
+    def pulse(self, client, color, duration, end_state=None, priority=None):
+        # 一定時間だけ点灯して元に戻す
+        self.play(client, [(color, False, duration)], end_state, priority)
+
+    async def set_state(self, client, color, blink=False, priority=None):
+        # アニメーション中のLEDは終了後の状態 (と、それを書き込む優先度) だけ更新し、それ以外はすぐ書き込む
+        if priority is None:
+            priority = self.default_priority
+        if client in self.animations:
+            self.bases[client] = (color, blink)
+            self.priorities[client] = priority
+        else:
+            await self.write_led(client, color, blink, priority)
+
+    def cancel(self, client):
+        # LEDのアニメーションを打ち切り、戻すべき状態を次の起床で書き込む
+        for animation in self.animations.get(client, []):
+            animation["end"] = 0
+        self._wake()
+
+    async def wait_idle(self):
+        # 全てのアニメーションが終わるまで待つ
+        await self.idle.wait()
+
+    def _wake(self):
+        self.wakeup.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.animations:
+                # ここから後の play()・cancel() は次の待ちを起こす (この周回の書き込みを待っている間も含む)
+                self.wakeup.clear()
+                now = loop.time()
+                writes = []
+                next_wake = None
+                for client in list(self.animations):
+                    animations = [a for a in self.animations[client] if a["end"] > now]
+                    if animations:
+                        self.animations[client] = animations
+                        state, boundary = self._frame_at(animations[-1], now)
+                        priority = animations[-1]["priority"]
+                        next_wake = boundary if next_wake is None else min(next_wake, boundary)
+                    else:
+                        del self.animations[client]
+                        state = self.bases.pop(client)
+                        priority = self.priorities.pop(client)
+                    if self.read_led(client) != state:
+                        writes.append(self.write_led(client, *state, priority))
+                if writes:
+                    self.write_count += len(writes)
+                    await asyncio.gather(*writes)
+                if next_wake is None:
+                    continue
+                # 切り替え時刻を刻みにそろえ、近いフレームを1回の起床にまとめる
+                next_wake = math.ceil(next_wake / self.tick_seconds) * self.tick_seconds
+                handle = loop.call_at(next_wake, self._wake)
+                try:
+                    await self.wakeup.wait()
+                finally:
+                    handle.cancel()
+        finally:
+            self.ticker = None
+            if not self.animations:
+                self.idle.set()
+
+    def _frame_at(self, animation, now):
+        for (color, blink, _), boundary in zip(animation["frames"], animation["boundaries"]):
+            if now < boundary:
+                return (color, blink), boundary
+        color, blink, _ = animation["frames"][-1]
+        return (color, blink), animation["end"]
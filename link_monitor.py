@@ -0,0 +1,165 @@
+import asyncio
+import importlib.metadata
+import sys
+
+import event_log
+import mesh_metrics
+
+# ブロックごとのリンク品質の計測と接続間隔の方針
+# 接続中のブロック1台につき1つ作り、アドバタイズのRSSI・書き込みの完了時間・
+# 通知の到着間隔の揺らぎ (ジッタ)・切断回数を mesh_metrics に記録する。
+# あわせてブロックの種類ごとに希望する接続間隔を決め、対応しているバックエンドなら要求する。
+# - ボタン・動きなど入力を受けるブロックは短い間隔 (入力の遅延を減らす)
+# - たまにしか書き込まないブロックは長い間隔 (アダプタの送信枠を入力用に空ける)
+# 短い間隔で切断が続くブロックは、中くらいの間隔に戻す。
+
+PROFILE_LOW_LATENCY = "low_latency"
+PROFILE_BALANCED = "balanced"
+PROFILE_POWER_SAVING = "power_saving"
+# 方針ごとの接続間隔の目安 (最小ms, 最大ms)
+CONNECTION_INTERVALS_MS = {
+    PROFILE_LOW_LATENCY: (7.5, 15),
+    PROFILE_BALANCED: (30, 50),
+    PROFILE_POWER_SAVING: (100, 200),
+}
+FALLBACK_DISCONNECTS = 2 # 短い間隔でこの回数切断されたら中くらいの間隔に戻す
+# 接続間隔の要求は bleak の公開APIにないため、WinRTバックエンドの内部 (client._backend._requester) を使う。
+# 内部の形を確かめた bleak のバージョンの範囲 (最小, 最大) の (メジャー, マイナー)。範囲外では要求しない
+BLEAK_TESTED_VERSIONS = ((0, 19), (0, 22))
+
+log = event_log.get("link")
+bleak_supported = None # 使っている bleak が確認済みの範囲か (最初の要求のときに調べる)
+
+def bleak_supports_connection_parameters():
+    global bleak_supported
+    if bleak_supported is None:
+        try:
+            version = importlib.metadata.version("bleak")
+            major_minor = tuple(int(part) for part in version.split(".")[:2])
+        except (importlib.metadata.PackageNotFoundError, ValueError):
+            version, major_minor = "(不明)", None
+        low, high = BLEAK_TESTED_VERSIONS
+        bleak_supported = major_minor is not None and low <= major_minor <= high
+        if not bleak_supported:
+            log.warning("bleak %s は接続間隔の要求を確認したバージョン (%d.%d〜%d.%d) ではないため、接続間隔はOSに任せます。",
+                        version, *low, *high)
+    return bleak_supported
+
+def winrt_bluetooth():
+    # bleak の WinRT バックエンドが使っている Bluetooth のモジュール
+    # bleak 0.21 までは bleak_winrt、0.22 からは winrt パッケージにある
+    try:
+        from bleak_winrt.windows.devices import bluetooth
+    except ImportError:
+        from winrt.windows.devices import bluetooth
+    return bluetooth
+
+def request_connection_profile(client, profile):
+    # 接続パラメータの変更を要求し、要求オブジェクト (なければ None) を返す
+    # 接続ごとに要求できるのは Windows (WinRT) のみ。BlueZ・CoreBluetooth では OS に任せる
+    if sys.platform != "win32" or not bleak_supports_connection_parameters():
+        return None
+    requester = getattr(getattr(client, "_backend", None), "_requester", None)
+    if requester is None:
+        log.warning("%s: bleak の内部 (_backend._requester) が見つからないため、接続間隔を要求できません。", client.address)
+        return None
+    try:
+        bluetooth = winrt_bluetooth()
+        preferred = bluetooth.BluetoothLEPreferredConnectionParameters
+        parameters = {
+            PROFILE_LOW_LATENCY: preferred.throughput_optimized,
+            PROFILE_BALANCED: preferred.balanced,
+            PROFILE_POWER_SAVING: preferred.power_optimized,
+        }[profile]
+        request = requester.request_preferred_connection_parameters(parameters)
+        if request.status != bluetooth.BluetoothLEPreferredConnectionParametersRequestStatus.SUCCESS:
+            log.warning("%s: 接続間隔 (%s) の要求が受け付けられませんでした (%s)", client.address, profile, request.status)
+            return None
+        return request
+    except Exception as e:
+        log.warning("%s: 接続間隔 (%s) を要求できませんでした: %s", client.address, profile, e)
+        return None
+
+class LinkMonitor:
+    def __init__(self, name, profile=PROFILE_BALANCED):
+        self.name = name
+        self.profile = profile
+        self.rssi = None
+        self.last_notify = None   # 前回の通知の到着時刻
+        self.last_interval = None # 前回の通知の到着間隔
+        self.request = None       # 接続パラメータの要求 (破棄すると取り消されるため保持する)
+        self.closing = False      # 自分から切断するところ (この切断は切断回数に数えない)
+        self.writes = mesh_metrics.histogram(f"link.{name}.write_ms")
+        self.write_errors = mesh_metrics.counter(f"link.{name}.write_errors")
+        self.jitter = mesh_metrics.histogram(f"link.{name}.notify_jitter_ms")
+        self.disconnects = mesh_metrics.counter(f"link.{name}.disconnects")
+        mesh_metrics.gauge(f"link.{name}.rssi", lambda: self.rssi)
+        mesh_metrics.gauge(f"link.{name}.profile", lambda: self.profile)
+
+    def record_advert(self, rssi):
+        self.rssi = rssi
+
+    def record_write(self, elapsed_ms, ok):
+        self.writes.record(elapsed_ms)
+        if not ok:
+            self.write_errors.inc()
+
+    def record_notify(self):
+        # 到着間隔の変化量をジッタとして記録する
+        now = asyncio.get_running_loop().time()
+        if self.last_notify is not None:
+            interval = now - self.last_notify
+            if self.last_interval is not None:
+                self.jitter.record(abs(interval - self.last_interval) * 1000)
+            self.last_interval = interval
+        self.last_notify = now
+
+    def wrap(self, handler):
+        # 通知ハンドラーを包んで到着時刻を記録する (コルーチン関数ならコルーチン関数のまま)
+        if asyncio.iscoroutinefunction(handler):
+            async def monitored(sender, data):
+                self.record_notify()
+                await handler(sender, data)
+        else:
+            def monitored(sender, data):
+                self.record_notify()
+                handler(sender, data)
+        return monitored
+
+    def on_disconnect(self, client):
+        # BleakClient の disconnected_callback
+        self.last_notify = None
+        self.last_interval = None
+        self.request = None
+        if self.closing:
+            return
+        self.disconnects.inc()
+        log.warning("%s が切断されました (累計%d回)", self.name, self.disconnects.value)
+
+    async def disconnect(self, client):
+        # 終了時などに自分から切断する (予期しない切断だけを数えるため、先に印を付ける)
+        self.closing = True
+        await client.disconnect()
+
+    def apply(self, client):
+        # 接続・再接続のたびに呼び、方針に沿った接続間隔を要求する
+        if self.profile == PROFILE_LOW_LATENCY and self.disconnects.value >= FALLBACK_DISCONNECTS:
+            log.warning("%s の切断が続いているため、接続間隔を %s に戻します。", self.name, PROFILE_BALANCED)
+            self.profile = PROFILE_BALANCED
+        self.request = request_connection_profile(client, self.profile)
+        return self.request is not None
+
+def report(monitors):
+    # 人が読むためのブロックごとの1行表示
+    lines = []
+    for monitor in monitors:
+        write = monitor.writes.snapshot()
+        jitter = monitor.jitter.snapshot()
+        low, high = CONNECTION_INTERVALS_MS[monitor.profile]
+        lines.append(
+            f"  {monitor.name}: RSSI={monitor.rssi} 方針={monitor.profile} ({low}〜{high}ms"
+            f"{', 要求済み' if monitor.request is not None else ''}) "
+            f"書き込みp99={write['p99']:.1f}ms 通知ジッタp99={jitter['p99']:.1f}ms "
+            f"切断={monitor.disconnects.value}回"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,152 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+import event_log
+import mesh_metrics
+from event_log import Lazy
+
+# イベントループの遅れ (ラグ) の監視
+# INTERVAL_SECONDS ごとに起きるタスクを動かし、予定より遅れて起きた時間をラグとして記録する。
+# イベントループのスレッドで同期的な処理 (ファイルの書き込み、大量の print など) が続くと、その間は
+# ブロックからの通知も処理されないので、ラグがそのまま通知の遅れになる。
+# 別のスレッドが SAMPLE_SECONDS ごとに起床の遅れを見て、遅れている間はイベントループのスレッドの
+# スタックを sys._current_frames() で取る。ラグが THRESHOLD_MS を超えたら、取ったスタックで一番多かったもの
+# (ループを止めていたコード) を犯人として mesh_metrics とイベントログ (カテゴリ "loop") に書く。
+
+INTERVAL_SECONDS = 0.05    # ラグを計る間隔
+THRESHOLD_MS = 100         # これ以上のラグを「ループが止まった」として犯人を記録する
+SAMPLE_SECONDS = 0.01      # スタックを取るスレッドの確認間隔
+SAMPLE_START_RATIO = 0.5   # 遅れが閾値のこの割合を超えたらスタックを取り始める
+MAX_SAMPLES = 100          # 1回の停止で取るスタックの数の上限
+LOG_INTERVAL_SECONDS = 60  # 同じ犯人のスタックをログに書く最短の間隔
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+log = event_log.get("loop")
+
+class Offender:
+    def __init__(self, name, stack):
+        self.name = name
+        self.stack = stack # 最後に取ったスタック (traceback.StackSummary)
+        self.stalls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.logged = None # 最後にスタックをログに書いた時刻 (time.monotonic())
+        self.counter = mesh_metrics.counter(f"loop.blocked.{name}")
+
+def offender_name(stack):
+    # スタックの内側から見て最初のこのリポジトリのコード ("モジュール.関数")。なければ一番内側
+    for frame in reversed(stack):
+        if os.path.dirname(os.path.abspath(frame.filename)) == PROJECT_DIR:
+            return f"{os.path.splitext(os.path.basename(frame.filename))[0]}.{frame.name}"
+    frame = stack[-1]
+    return f"{os.path.splitext(os.path.basename(frame.filename))[0]}.{frame.name}"
+
+class LoopLagMonitor:
+    def __init__(self, threshold_ms=THRESHOLD_MS, interval_seconds=INTERVAL_SECONDS):
+        self.threshold_ms = threshold_ms
+        self.interval_seconds = interval_seconds
+        self.offenders = {} # {犯人の名前: Offender}
+        self.task = None
+        self.sampler = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.loop_thread_id = None
+        self.due = None          # ラグを計るタスクが次に起きる予定の時刻 (time.monotonic())
+        self.samples = Counter() # 今の遅れの間に取ったスタック {((ファイル, 行, 関数), ...): 回数}
+        self.frames = {}         # {スタックのキー: traceback.StackSummary}
+        self.lag = mesh_metrics.histogram("loop.lag_ms")
+        self.stalls = mesh_metrics.counter("loop.stalls")
+        self.stall_ms = mesh_metrics.histogram("loop.stall_ms")
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.stopping.clear()
+        self.task = asyncio.create_task(self._measure(), name="loop_lag")
+        self.sampler = threading.Thread(target=self._sample_loop, name="loop-lag-sampler", daemon=True)
+        self.sampler.start()
+
+    async def stop(self):
+        self.stopping.set()
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.sampler:
+            self.sampler.join()
+            self.sampler = None
+
+    async def _measure(self):
+        while True:
+            self.due = time.monotonic() + self.interval_seconds
+            await asyncio.sleep(self.interval_seconds)
+            lag_ms = max(0.0, (time.monotonic() - self.due) * 1000)
+            self.lag.record(lag_ms)
+            with self.lock:
+                self.due = None
+                samples, self.samples = self.samples, Counter()
+                frames, self.frames = self.frames, {}
+            if lag_ms >= self.threshold_ms:
+                self._record_stall(lag_ms, samples, frames)
+
+    def _sample_loop(self):
+        # イベントループのスレッドが遅れている間だけスタックを取る
+        start_seconds = self.threshold_ms * SAMPLE_START_RATIO / 1000
+        while not self.stopping.wait(SAMPLE_SECONDS):
+            due = self.due
+            if due is None or time.monotonic() - due < start_seconds:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            key = tuple((entry.filename, entry.lineno, entry.name) for entry in stack)
+            with self.lock:
+                if due == self.due and sum(self.samples.values()) < MAX_SAMPLES:
+                    self.samples[key] += 1
+                    self.frames[key] = stack
+
+    def _record_stall(self, lag_ms, samples, frames):
+        self.stalls.inc()
+        self.stall_ms.record(lag_ms)
+        if samples:
+            key, count = samples.most_common(1)[0]
+            stack = frames[key]
+            name = offender_name(stack)
+        else:
+            # 取る前に終わった (スレッドが GIL を取れなかった場合も含む)
+            count, stack, name = 0, None, "unknown"
+        offender = self.offenders.get(name)
+        if offender is None:
+            offender = self.offenders[name] = Offender(name, stack)
+        offender.stack = stack or offender.stack
+        offender.stalls += 1
+        offender.total_ms += lag_ms
+        offender.max_ms = max(offender.max_ms, lag_ms)
+        offender.counter.inc()
+        now = time.monotonic()
+        fields = {"lag_ms": round(lag_ms, 1), "offender": name, "samples": sum(samples.values()), "offender_samples": count}
+        if stack and (offender.logged is None or now - offender.logged >= LOG_INTERVAL_SECONDS):
+            offender.logged = now
+            fields["stack"] = [f"{entry.filename}:{entry.lineno} {entry.name}" for entry in stack]
+            log.warning("イベントループが%.0fms止まりました: %s\n%s", lag_ms, name, Lazy(format_stack, stack),
+                        extra={"fields": fields})
+        else:
+            log.info("イベントループが%.0fms止まりました: %s", lag_ms, name, extra={"fields": fields})
+
+    def report(self):
+        lag = self.lag.snapshot()
+        lines = [f"イベントループの遅れ: p50 {lag['p50']:.1f}ms p99 {lag['p99']:.1f}ms 最大 {lag['max']:.0f}ms, "
+                 f"{self.threshold_ms:.0f}ms以上の停止 {self.stalls.value}回"]
+        for offender in sorted(self.offenders.values(), key=lambda offender: offender.total_ms, reverse=True):
+            lines.append(f"  {offender.name}: {offender.stalls}回, 合計 {offender.total_ms:.0f}ms, 最大 {offender.max_ms:.0f}ms")
+        return "\n".join(lines)
+
+def format_stack(stack):
+    # 一番内側のフレームから数個だけ表示する
+    return "".join(traceback.format_list(stack[-8:])).rstrip()
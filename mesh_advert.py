@@ -0,0 +1,190 @@
+import asyncio
+from collections import OrderedDict
+from bleak import BleakScanner
+
+import mesh_metrics
+
+# MESHブロックのアドバタイズの判別
+# MESHブロックの名前は "MESH-100" + 種別2文字 + シリアルナンバー (例: "MESH-100BU1234567")。
+# スキャンはMESHのサービスUUIDで絞り込み (BlueZ・CoreBluetoothではOS側で捨てられる)、
+# 名前の解析はアドレスごとに1回だけ行って結果をキャッシュする。
+
+MESH_SERVICE_UUID = "72c90001-57a9-4d40-b746-534e22ec9f9e"
+MESH_NAME_PREFIX = "MESH-100"
+# 判別結果をキャッシュするアドレスの数の上限 (スマートフォンなどはアドレスを変え続けるので、古いものから捨てる)
+CLASSIFY_CACHE_SIZE = 1024
+
+# 種別コードと表示名
+BLOCK_TYPE_NAMES = {
+    "LE": "LED",
+    "BU": "ボタン",
+    "AC": "動き",
+    "GP": "GPIO",
+    "MD": "人感",
+    "TH": "温度・湿度",
+    "BR": "明るさ",
+}
+
+def parse_block_name(name):
+    # "MESH-100BU1234567" -> ("BU", "1234567") (MESHブロックの名前でなければ None)
+    if not name or not name.startswith(MESH_NAME_PREFIX):
+        return None
+    block_type = name[len(MESH_NAME_PREFIX):len(MESH_NAME_PREFIX) + 2]
+    serial = name[len(MESH_NAME_PREFIX) + 2:]
+    if block_type not in BLOCK_TYPE_NAMES or not serial:
+        return None
+    return block_type, serial
+
+class AdvertClassifier:
+    def __init__(self, cache_size=CLASSIFY_CACHE_SIZE):
+        self.cache = OrderedDict() # {アドレス: (種別, シリアル) または None} 最近見たものほど後ろ
+        self.cache_size = cache_size
+        self.parsed = mesh_metrics.counter("advert.parsed")
+        self.ignored = mesh_metrics.counter("advert.ignored")
+
+    def classify(self, device, adv=None):
+        # (種別, シリアル) を返す。MESHブロックでなければ None
+        address = device.address
+        if address in self.cache:
+            self.cache.move_to_end(address)
+            return self.cache[address]
+        if adv is not None and adv.service_uuids and MESH_SERVICE_UUID not in adv.service_uuids:
+            self.ignored.inc()
+            self._remember(address, None)
+            return None
+        name = (adv.local_name if adv is not None else None) or device.name
+        if not name:
+            return None # 名前はスキャン応答で後から届くことがあるので、まだ決めない
+        self.parsed.inc()
+        block = parse_block_name(name)
+        if block is None:
+            self.ignored.inc()
+        self._remember(address, block)
+        return block
+
+    def _remember(self, address, block):
+        self.cache[address] = block
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+classifier = AdvertClassifier()
+
+async def discover_blocks(timeout=5.0):
+    # MESHブロックだけをスキャンして {シリアル: (種別, device, adv)} を返す
+    found = await BleakScanner.discover(timeout=timeout, return_adv=True, service_uuids=[MESH_SERVICE_UUID])
+    blocks = {}
+    for device, adv in found.values():
+        block = classifier.classify(device, adv)
+        if block:
+            block_type, serial = block
+            blocks[serial] = (block_type, device, adv)
+    return blocks
+
+# 共有スキャナ
+# 「シリアルナンバーXのブロックが見つかるまで待つ」を多数のコルーチンから同時に受け付け、
+# 1本のアドバタイズの流れからまとめて解決する。待っているものがなければスキャンを止め、
+# 長く見つからないときは SCAN_WINDOW_SECONDS ごとに SCAN_PAUSE_SECONDS 休んでアダプタを空ける。
+SCAN_WINDOW_SECONDS = 5.0    # 1回のスキャンの長さ
+SCAN_PAUSE_SECONDS = 5.0     # 長く見つからないときのスキャンの間の休止
+FULL_DUTY_SECONDS = 30.0     # 待ち始めてからこの秒数は休まずにスキャンする
+SEEN_TTL_SECONDS = 10.0      # この秒数以内に見えたブロックはスキャンせずに返す
+
+class ScannerService:
+    def __init__(self):
+        self.pending = {}   # {シリアル: [Future, ...]}
+        self.seen = {}      # {シリアル: (device, 見えた時刻)}
+        self.scanner = None
+        self.task = None
+        self.wakeup = None  # 待ちが増えたときにセット
+        self.idle = None    # 待ちがなくなったときにセット
+        self.pending_since = None
+        self.resolved = mesh_metrics.counter("scanner.resolved")
+        self.windows = mesh_metrics.counter("scanner.windows")
+        mesh_metrics.gauge("scanner.pending", lambda: sum(len(waiters) for waiters in self.pending.values()))
+
+    async def wait_for(self, name, timeout=None):
+        # name: "MESH-100BU1234567" またはシリアルナンバー "1234567"
+        loop = asyncio.get_running_loop()
+        block = parse_block_name(name)
+        serial = block[1] if block else name
+        seen = self.seen.get(serial)
+        if seen and loop.time() - seen[1] < SEEN_TTL_SECONDS:
+            return seen[0]
+        self._ensure_running()
+        future = loop.create_future()
+        if not self.pending:
+            self.pending_since = loop.time()
+        self.pending.setdefault(serial, []).append(future)
+        self.idle.clear()
+        self.wakeup.set()
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            waiters = self.pending.get(serial)
+            if waiters and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self.pending[serial]
+            if not self.pending:
+                self.idle.set()
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def _ensure_running(self):
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.idle = asyncio.Event()
+            self.idle.set()
+            self.task = asyncio.create_task(self._run(), name="scanner")
+
+    def _on_advert(self, device, adv):
+        block = classifier.classify(device, adv)
+        if not block:
+            return
+        serial = block[1]
+        self.seen[serial] = (device, asyncio.get_running_loop().time())
+        for future in self.pending.pop(serial, []):
+            if not future.done():
+                future.set_result(device)
+                self.resolved.inc()
+        if not self.pending:
+            self.idle.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        if self.scanner is None:
+            self.scanner = BleakScanner(detection_callback=self._on_advert, service_uuids=[MESH_SERVICE_UUID])
+        while True:
+            if not self.pending:
+                # 待っているものがなければスキャンしない
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            self.windows.inc()
+            try:
+                await self.scanner.start()
+                try:
+                    await asyncio.wait_for(self.idle.wait(), SCAN_WINDOW_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    await self.scanner.stop()
+            except Exception as e:
+                print(f"スキャンエラー: {e}")
+            if self.pending and loop.time() - self.pending_since >= FULL_DUTY_SECONDS:
+                # 長く見つからないので休む (新しい待ちが来たらすぐ再開する)
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), SCAN_PAUSE_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+
+scanner = ScannerService()
+
+async def find_block(name, timeout=None):
+    # 共有スキャナでブロックが見つかるまで待って BLEDevice を返す (timeout秒で asyncio.TimeoutError)
+    return await scanner.wait_for(name, timeout)
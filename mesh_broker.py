@@ -0,0 +1,446 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import tempfile
+from types import SimpleNamespace
+from bleak import BleakClient
+from struct import pack
+
+from block_supervisor import BlockSupervisor
+from block_writer import PRIORITY_NAMES, BlockWriter
+from mesh_advert import MESH_SERVICE_UUID, find_block, parse_block_name
+import mesh_metrics
+
+# MESHブロックの接続を持ち続けるローカルのブローカー
+# デーモンとして起動しておくと、ブロックへの接続をスクリプトをまたいで使い回せる。
+# スクリプトはUnixソケットでつなぎ、ブロックを開いてコマンドを送り、デコード済みの通知を受け取る。
+# プロトコルは1行1件のJSON。
+#   要求: {"id": 1, "op": "open", "serials": ["1234567"], "timeout": 30}
+#         {"id": 2, "op": "write", "serial": "1234567", "char": <UUID>, "data": <16進>, "response": false}
+#         {"id": 3, "op": "subscribe", "serial": "1234567", "char": <UUID>} ("unsubscribe" で解除)
+#         {"id": 4, "op": "status"}
+#   応答: {"id": 1, "ok": true, ...} または {"id": 1, "ok": false, "error": "..."}
+#   通知: {"event": "notify", "serial": ..., "char": <UUID>, "data": <16進>, "decoded": {...}}
+#         {"event": "connection", "serial": ..., "connected": true/false}
+
+SOCKET_PATH = os.path.join(tempfile.gettempdir(), "mesh_broker.sock")
+OPEN_TIMEOUT_SECONDS = 30.0
+SESSION_QUEUE_SIZE = 1024 # 読み出しが追いつかないクライアントへの未送信の行の上限 (超えたら捨てる)
+
+COMMAND_CHAR_UUID = "72c90002-57a9-4d40-b746-534e22ec9f9e"
+NOTIFY_CHAR_UUID = "72c90003-57a9-4d40-b746-534e22ec9f9e"
+WRITE_CHAR_UUID = "72c90004-57a9-4d40-b746-534e22ec9f9e"
+INDICATE_CHAR_UUID = "72c90005-57a9-4d40-b746-534e22ec9f9e"
+ENABLE_COMMAND = pack('<BBBB', 0x00, 0x02, 0x01, 0x03) # 機能有効化コマンド
+
+BUTTON_PRESSES = {1: "single", 2: "long", 3: "double"}
+
+class BrokerError(Exception):
+    pass
+
+def decode_notification(block_type, data):
+    # 種別ごとに通知をデコードする (わからないものは空の辞書)
+    if len(data) < 3 or data[0] != 0x01:
+        return {}
+    if block_type == "BU" and data[1] == 0x00:
+        return {"press": BUTTON_PRESSES.get(data[2], data[2])}
+    if block_type == "AC" and data[1] == 0x03:
+        return {"orientation": data[2]}
+    if block_type == "MD" and data[1] == 0x00 and len(data) >= 4:
+        return {"motion": data[3] == 0x01}
+    if block_type == "TH" and data[1] == 0x00 and len(data) >= 8:
+        temperature = int.from_bytes(data[4:6], byteorder='little', signed=True) / 10.0
+        humidity = int.from_bytes(data[6:8], byteorder='little', signed=True)
+        return {"temperature": temperature, "humidity": humidity}
+    return {}
+
+# ブローカー (デーモン側)
+class BrokeredBlock:
+    def __init__(self, serial):
+        self.serial = serial
+        self.name = None
+        self.block_type = None
+        self.supervisor = None
+        self.writer = None
+        self.sessions = set()    # このブロックを開いているセッション (接続・切断を知らせる)
+        self.subscribers = {} # {特性UUID: set(Session)}
+
+class Session:
+    # ソケットでつながったクライアント1つ
+    def __init__(self, stream_writer, dropped):
+        self.stream_writer = stream_writer
+        self.lines = asyncio.Queue(SESSION_QUEUE_SIZE)
+        self.dropped = dropped
+        self.sender = asyncio.create_task(self._send())
+
+    def send(self, message):
+        try:
+            self.lines.put_nowait(json.dumps(message, ensure_ascii=False).encode('utf-8') + b"\n")
+        except asyncio.QueueFull:
+            self.dropped.inc()
+
+    async def _send(self):
+        while True:
+            line = await self.lines.get()
+            self.stream_writer.write(line)
+            if self.lines.empty():
+                await self.stream_writer.drain()
+
+    async def close(self):
+        self.sender.cancel()
+        await asyncio.gather(self.sender, return_exceptions=True)
+        self.stream_writer.close()
+
+class Broker:
+    def __init__(self, connect=None):
+        # connect(serial, disconnected_callback): (クライアント, ブロック名) を返すコルーチン関数
+        # テスト用に接続方法を差し替える (省略時はスキャンして接続)
+        self.connect = connect or self._connect_ble
+        self.blocks = {}     # {シリアル: BrokeredBlock}
+        self.sessions = set()
+        self.server = None
+        self.commands = mesh_metrics.counter("broker.commands")
+        self.notifications = mesh_metrics.counter("broker.notifications")
+        self.dropped = mesh_metrics.counter("broker.dropped")
+        mesh_metrics.gauge("broker.sessions", lambda: len(self.sessions))
+
+    async def serve(self, path=SOCKET_PATH):
+        if os.path.exists(path):
+            # つながれば別のブローカーが動いている。つながらなければ前回のデーモンが残したソケットなので消す
+            try:
+                _, stream_writer = await asyncio.open_unix_connection(path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                stream_writer.close()
+                raise BrokerError(f"ブローカーはすでに起動しています: {path}")
+        self.server = await asyncio.start_unix_server(self._on_session, path=path)
+        os.chmod(path, 0o600) # 他のユーザーからブロックを操作されないように、起動したユーザーだけに絞る
+        return self.server
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        for session in list(self.sessions):
+            await session.close()
+        for block in self.blocks.values():
+            if block.writer:
+                await block.writer.close()
+            await block.supervisor.stop()
+
+    def ensure(self, serial):
+        # ブロックの見張りを始める (開いたことのあるブロックはそのまま使う)
+        block = self.blocks.get(serial)
+        if block is None:
+            block = BrokeredBlock(serial)
+            block.supervisor = BlockSupervisor(
+                f"broker.{serial}",
+                lambda disconnected_callback: self._connect_block(block, disconnected_callback),
+                lambda client: self._setup_block(block, client))
+            block.supervisor.start()
+            self.blocks[serial] = block
+        return block
+
+    async def _connect_ble(self, serial, disconnected_callback):
+        device = await find_block(serial)
+        client = BleakClient(device, timeout=None, disconnected_callback=disconnected_callback)
+        await client.connect()
+        return client, device.name
+
+    async def _connect_block(self, block, disconnected_callback):
+        def on_disconnect(client):
+            disconnected_callback(client)
+            self._broadcast(block, {"event": "connection", "serial": block.serial, "connected": False})
+        try:
+            client, name = await self.connect(block.serial, on_disconnect)
+        except Exception as e:
+            print(f"{block.serial}への接続エラー: {e}")
+            return None
+        parsed = parse_block_name(name)
+        if parsed:
+            block.name = name
+            block.block_type = parsed[0]
+        return client
+
+    async def _setup_block(self, block, client):
+        # 接続・再接続のたびに機能を有効化して通知を購読し、書き込みキューを作り直す
+        await client.write_gatt_char(WRITE_CHAR_UUID, ENABLE_COMMAND, response=True)
+        for char_uuid in (NOTIFY_CHAR_UUID, INDICATE_CHAR_UUID):
+            await client.start_notify(char_uuid, self._notify_handler(block, char_uuid))
+        if block.writer:
+            await block.writer.close()
+        block.writer = BlockWriter(client, f"broker.{block.serial}")
+        block.writer.start()
+        self._broadcast(block, {"event": "connection", "serial": block.serial, "connected": True})
+
+    def _notify_handler(self, block, char_uuid):
+        def handler(sender, data):
+            self.notifications.inc()
+            message = {"event": "notify", "serial": block.serial, "char": char_uuid, "data": bytes(data).hex(),
+                       "decoded": decode_notification(block.block_type, data)}
+            for session in block.subscribers.get(char_uuid, ()):
+                session.send(message)
+        return handler
+
+    def _broadcast(self, block, message):
+        for session in block.sessions:
+            session.send(message)
+
+    def _status(self, block):
+        return {"serial": block.serial, "name": block.name, "type": block.block_type,
+                "connected": block.supervisor.is_available(), "availability": block.supervisor.availability()}
+
+    async def _on_session(self, reader, stream_writer):
+        session = Session(stream_writer, self.dropped)
+        self.sessions.add(session)
+        requests = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # 要求ごとにタスクにして、書き込みの完了を待つ間も次の要求を受け付ける
+                task = asyncio.create_task(self._dispatch(session, line))
+                requests.add(task)
+                task.add_done_callback(requests.discard)
+        finally:
+            for task in requests:
+                task.cancel()
+            for block in self.blocks.values():
+                block.sessions.discard(session)
+                for subscribers in block.subscribers.values():
+                    subscribers.discard(session)
+            self.sessions.discard(session)
+            await session.close()
+
+    async def _dispatch(self, session, line):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            reply = await self._handle(session, request)
+            session.send({"id": request_id, "ok": True, **reply})
+        except Exception as e:
+            session.send({"id": request_id, "ok": False, "error": str(e)})
+
+    async def _handle(self, session, request):
+        op = request.get("op")
+        if op == "write":
+            block = self.blocks.get(request["serial"])
+            if not block or not block.supervisor.is_available():
+                raise BrokerError(f"ブロックに接続していません: {request['serial']}")
+            # 優先度はブロックを共有する全セッションの書き込みキューに効くので、範囲外は受け付けない
+            priority = request.get("priority", 0)
+            if type(priority) is not int or not 0 <= priority < len(PRIORITY_NAMES):
+                raise BrokerError(f"優先度は0〜{len(PRIORITY_NAMES) - 1}の整数で指定してください: {priority!r}")
+            self.commands.inc()
+            ok = await block.writer.write(request["char"], bytes.fromhex(request["data"]),
+                                          priority=priority, merge_key=request.get("merge_key"),
+                                          response=request.get("response", False))
+            if not ok:
+                raise BrokerError("書き込みに失敗しました")
+            return {}
+        if op == "open":
+            blocks = [self.ensure(serial) for serial in request["serials"]]
+            for block in blocks:
+                block.sessions.add(session)
+            try:
+                await asyncio.wait_for(asyncio.gather(*[block.supervisor.ready.wait() for block in blocks]),
+                                       request.get("timeout", OPEN_TIMEOUT_SECONDS))
+            except asyncio.TimeoutError:
+                pass # 接続できていないブロックは connected: false で返す (バックグラウンドで接続を続ける)
+            return {"blocks": [self._status(block) for block in blocks]}
+        if op in ("subscribe", "unsubscribe"):
+            block = self.ensure(request["serial"])
+            block.sessions.add(session)
+            subscribers = block.subscribers.setdefault(request["char"], set())
+            if op == "subscribe":
+                subscribers.add(session)
+            else:
+                subscribers.discard(session)
+            return {}
+        if op == "status":
+            return {"blocks": [self._status(block) for block in self.blocks.values()],
+                    "metrics": {"commands": self.commands.value, "notifications": self.notifications.value,
+                                "dropped": self.dropped.value, "sessions": len(self.sessions)}}
+        raise BrokerError(f"不明な要求: {op}")
+
+# クライアント (スクリプト側)
+class BrokerClient:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.ids = itertools.count(1)
+        self.replies = {}  # {要求ID: Future}
+        self.handlers = {} # {(シリアル, 特性UUID): handler(serial, data, decoded)}
+        self.connection_handlers = {} # {シリアル: handler(connected)}
+        self.handler_tasks = set()    # コルーチンの通知ハンドラー (参照を持っておかないと途中で回収される)
+        self.receiver = asyncio.create_task(self._receive())
+
+    @classmethod
+    async def connect(cls, path=SOCKET_PATH):
+        reader, writer = await asyncio.open_unix_connection(path, limit=1 << 20)
+        return cls(reader, writer)
+
+    async def close(self):
+        self.receiver.cancel()
+        for task in self.handler_tasks:
+            task.cancel()
+        await asyncio.gather(self.receiver, *self.handler_tasks, return_exceptions=True)
+        self.writer.close()
+
+    async def request(self, op, **fields):
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.replies[request_id] = future
+        self.writer.write(json.dumps({"id": request_id, "op": op, **fields}).encode('utf-8') + b"\n")
+        try:
+            reply = await future
+        finally:
+            self.replies.pop(request_id, None)
+        if not reply.get("ok"):
+            raise BrokerError(reply.get("error"))
+        return reply
+
+    async def open(self, serials, timeout=OPEN_TIMEOUT_SECONDS):
+        # ブロックを開いて (接続していなければ接続して) 状態の一覧を返す
+        return (await self.request("open", serials=list(serials), timeout=timeout))["blocks"]
+
+    async def write(self, serial, char_uuid, data, response=False, priority=0, merge_key=None):
+        await self.request("write", serial=serial, char=char_uuid, data=bytes(data).hex(),
+                           response=response, priority=priority, merge_key=merge_key)
+
+    async def subscribe(self, serial, char_uuid, handler):
+        self.handlers[(serial, char_uuid)] = handler
+        await self.request("subscribe", serial=serial, char=char_uuid)
+
+    async def unsubscribe(self, serial, char_uuid):
+        self.handlers.pop((serial, char_uuid), None)
+        await self.request("unsubscribe", serial=serial, char=char_uuid)
+
+    async def status(self):
+        return await self.request("status")
+
+    def block(self, serial, disconnected_callback=None):
+        return BrokerBlock(self, serial, disconnected_callback)
+
+    async def discover_blocks(self, serials, timeout=OPEN_TIMEOUT_SECONDS):
+        # mesh_advert.discover_blocks と同じ形 {シリアル: (種別, device, adv)} で接続済みのブロックを返す
+        # device.address にはシリアルナンバーが入るので、そのまま block() に渡せる
+        blocks = {}
+        for status in await self.open(serials, timeout):
+            if status["connected"]:
+                device = SimpleNamespace(address=status["serial"], name=status["name"])
+                blocks[status["serial"]] = (status["type"], device, SimpleNamespace(rssi=None))
+        return blocks
+
+    def _handler_done(self, task):
+        self.handler_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            print(f"通知ハンドラーでエラーが発生しました: {task.exception()!r}")
+
+    async def _receive(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                for future in self.replies.values():
+                    if not future.done():
+                        future.set_exception(BrokerError("ブローカーとの接続が切れました"))
+                return
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue # 壊れた行は読み飛ばす (受信を止めない)
+            if "id" in message:
+                future = self.replies.get(message["id"])
+                if future and not future.done():
+                    future.set_result(message)
+            elif message.get("event") == "notify":
+                handler = self.handlers.get((message["serial"], message["char"]))
+                if handler:
+                    result = handler(message["serial"], bytearray.fromhex(message["data"]), message["decoded"])
+                    if asyncio.iscoroutine(result):
+                        task = asyncio.create_task(result)
+                        self.handler_tasks.add(task)
+                        task.add_done_callback(self._handler_done)
+            elif message.get("event") == "connection":
+                handler = self.connection_handlers.get(message["serial"])
+                if handler:
+                    handler(message["connected"])
+
+class BrokerBlock:
+    # ブローカー越しのブロック (BleakClient と同じ呼び方で使える)
+    # disconnect() は購読を解除するだけで、ブローカーの接続はそのまま残す
+    def __init__(self, broker, serial, disconnected_callback=None):
+        self.broker = broker
+        self.serial = serial
+        self.address = serial
+        self.is_connected = False
+        self.disconnected_callback = disconnected_callback
+        self.subscriptions = set()
+        broker.connection_handlers[serial] = self._on_connection
+
+    def _on_connection(self, connected):
+        was_connected = self.is_connected
+        self.is_connected = connected
+        if was_connected and not connected and self.disconnected_callback:
+            self.disconnected_callback(self)
+
+    async def connect(self):
+        status = (await self.broker.open([self.serial]))[0]
+        if not status["connected"]:
+            raise BrokerError(f"ブローカーがブロックに接続できていません: {self.serial}")
+        self.is_connected = True
+
+    async def disconnect(self):
+        for char_uuid in list(self.subscriptions):
+            await self.stop_notify(char_uuid)
+        self.is_connected = False
+
+    async def get_services(self):
+        characteristics = [SimpleNamespace(uuid=uuid) for uuid in
+                           (COMMAND_CHAR_UUID, NOTIFY_CHAR_UUID, WRITE_CHAR_UUID, INDICATE_CHAR_UUID)]
+        return [SimpleNamespace(uuid=MESH_SERVICE_UUID, characteristics=characteristics)]
+
+    async def write_gatt_char(self, char_uuid, data, response=False):
+        await self.broker.write(self.serial, char_uuid, data, response=response)
+
+    async def start_notify(self, char_uuid, handler):
+        # handler(sender, data) は BleakClient の通知ハンドラーと同じ形で呼ばれる
+        self.subscriptions.add(char_uuid)
+        await self.broker.subscribe(self.serial, char_uuid, lambda serial, data, decoded: handler(self, data))
+
+    async def stop_notify(self, char_uuid):
+        self.subscriptions.discard(char_uuid)
+        await self.broker.unsubscribe(self.serial, char_uuid)
+
+async def main(path, serials):
+    broker = Broker()
+    await broker.serve(path)
+    print(f"MESHブローカーを起動しました: {path}")
+    for serial in serials:
+        broker.ensure(serial) # 先に接続しておくブロック
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for block in broker.blocks.values():
+            print(block.supervisor.report(asyncio.get_running_loop().time()))
+        await broker.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MESHブロックの接続を持ち続けるローカルのブローカー")
+    parser.add_argument("--socket", default=SOCKET_PATH, help="Unixソケットのパス")
+    parser.add_argument("serials", nargs="*", help="起動時に接続しておくブロックのシリアルナンバー")
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args.socket, args.serials))
+    except BrokerError as e:
+        print(e)
+    except KeyboardInterrupt:
+        print("ブローカーを停止しました。")
@@ -0,0 +1,85 @@
+import json
+import os
+from collections import deque
+
+# 計測値の集計
+# 名前ごとにカウンタ・ヒストグラム・ゲージを登録し、snapshot() でまとめて取り出す。
+
+HISTOGRAM_SAMPLES = 1024 # パーセンタイル計算に残す直近のサンプル数
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+class Histogram:
+    def __init__(self, samples=HISTOGRAM_SAMPLES):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=samples)
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self.samples.append(value)
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+class Gauge:
+    def __init__(self, read):
+        self.read = read # 取り出すときに呼ぶ関数
+
+    def snapshot(self):
+        return self.read()
+
+registry = {}
+
+def counter(name):
+    return registry.setdefault(name, Counter())
+
+def histogram(name):
+    return registry.setdefault(name, Histogram())
+
+def gauge(name, read):
+    registry[name] = Gauge(read)
+    return registry[name]
+
+def snapshot():
+    return {name: metric.snapshot() for name, metric in sorted(registry.items())}
+
+def summary():
+    # 人が読むための1行1項目の表示
+    lines = []
+    for name, value in snapshot().items():
+        if isinstance(value, dict):
+            value = " ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in value.items())
+        lines.append(f"  {name}: {value}")
+    return "\n".join(lines)
+
+def dump(path):
+    # JSONで書き出す (書きかけのファイルが残らないよう置き換えで書く)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot(), f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
@@ -1,9 +1,23 @@
+import argparse
 import asyncio
 from datetime import datetime
-from bleak import BleakClient, discover
+from bleak import BleakClient
 from struct import pack
 import csv
 import os
+import socket
+import time
+from block_rotation import ConnectionRotation, RotatingSensor
+from block_supervisor import BlockSupervisor
+import event_log
+from loop_lag import THRESHOLD_MS, LoopLagMonitor
+from mesh_advert import find_block
+from mesh_broker import SOCKET_PATH, BrokerClient
+from poll_scheduler import PollScheduler
+from room_collector import RoomPublisher, parse_address
+from room_history import HISTORY_FILE_NAME, HistoryStore
+from room_mqtt import MQTT_PORT, MqttRoomPublisher
+from sample_archive import ARCHIVE_DIR_NAME, open_room_archives
 
 # 定数
 SN_TH = "MESH-100TH1026989"
@@ -15,6 +29,25 @@ CORE_WRITE_UUID = '72c90004-57a9-4d40-b746-534e22ec9f9e'
 CSV_FILE_NAME = 'room_status.csv'
 CSV_HEADERS = ["部屋ID", "空室状況", "温度", "湿度", "入室開始時刻"]
 
+# 人感ブロックの通知モード
+MD_MODE_ONCE = 0x10       # 現在の状態を1回だけ通知
+MD_MODE_CONTINUOUS = 0x20 # 一定間隔で通知し続ける
+# 人感ブロックの通知間隔 (部屋の状態に合わせて切り替える)
+MD_INTERVAL_FAST_MS = 500       # 在室状況が変わった直後
+MD_INTERVAL_OCCUPIED_MS = 2000  # 在室中
+MD_INTERVAL_EMPTY_MS = 10000    # 空室・退席中
+MD_FAST_HOLD_SECONDS = 60       # 変化のあとこの秒数は短い間隔のまま
+MD_RESPONSE_MS = 500
+MD_FIXED_INTERVAL_MS = 500      # 以前の固定モードの間隔 (削減量の比較用)
+SETUP_TIMEOUT_SECONDS = 60      # 起動時に全ブロックの接続を待つ秒数 (過ぎたらバックグラウンドで接続を続ける)
+# 接続の入れ替えモード (--rotate) で温湿度・人感ブロックを読む間隔 (鮮度の目標)
+TH_FRESHNESS_SECONDS = 300
+MD_FRESHNESS_SECONDS = 60
+ROTATION_SLOTS = 1              # 入れ替えに使う接続の数 (動きブロックの常時接続とは別)
+TH_REQUEST = pack('<BBBB', 0x00, 0x03, 0x00, 0x03) # 温湿度ブロックへの1回だけのデータ要求
+TH_POLL_SECONDS = 60            # 常時接続の温湿度ブロックにデータを要求する周期
+ARCHIVE_FLUSH_SECONDS = 300     # 生のサンプルのアーカイブをこの秒数ごとに書き出す (止まったときに失う分を抑える)
+
 # 部屋の状態
 room_status = {
     'id': 'Room-A',
@@ -28,6 +61,34 @@ room_status = {
 motion_detected = False
 away_mode = False
 
+# ブロックごとの接続の見張り (BlockSupervisor)
+th_block = None
+md_block = None
+ac_block = None
+# 接続の入れ替えモードでは温湿度・人感ブロックを常時接続せず、順番に読む (ConnectionRotation)
+rotation = None
+th_sensor = None
+md_sensor = None
+# 常時接続のブロックへの定期的な要求 (PollScheduler)。部屋が増えても要求が同じ時刻に重ならないようにずらす
+poller = PollScheduler(TH_POLL_SECONDS)
+th_reading = None          # 定期要求に応えた温湿度の通知を待つ Future
+publisher = None           # 集約サーバに部屋の状態の変化を送る (RoomPublisher、--collector 指定時)
+history = None             # 在室状況の変化と温湿度の履歴 (HistoryStore、--history 指定時)
+th_archive = None          # 温湿度・人感の生のサンプル (SampleArchive、--archive 指定時)
+md_archive = None
+mqtt = None                # ビルのシステムに部屋の状態をMQTTで送る (MqttRoomPublisher、--mqtt 指定時)
+lag_monitor = None         # イベントループの遅れと、ループを止めていたコードの記録 (LoopLagMonitor)
+broker = None              # ブローカー経由で読むときの BrokerClient (None なら直接接続する)
+
+# 人感ブロックの通知間隔の制御
+md_interval_ms = None      # 今設定している通知間隔
+md_last_change = 0.0       # 最後に在室状況 (人感・退席) が変わった時刻 (loop.time())
+md_query_pending = False   # 次の起床で1回だけの状態通知を要求する
+md_rate_event = asyncio.Event()
+md_frame_count = 0         # 受信した人感ブロックの通知数
+th_frame_count = 0         # 受信した温湿度ブロックの通知数
+md_started = None          # 通知数の集計を始めた時刻 (loop.time())
+
 def update_csv():
     # CSVファイル更新
     with open(CSV_FILE_NAME, 'w', newline='', encoding='utf-8') as f:
@@ -56,34 +117,131 @@ def parse_th_data(data):
 
 def on_receive_th_notify(sender, data: bytearray):
     # 温湿度ブロックからの通知
-    global room_status
+    global room_status, th_frame_count
     if len(data) >= 8 and data[0] == 0x01 and data[1] == 0x00:
+        th_frame_count += 1
         temp, hum = parse_th_data(data)
         room_status['temperature'] = f"{temp} ℃"
         room_status['humidity'] = f"{hum} %"
+        if history:
+            history.record_sample(room_status['id'], temp, hum)
+        if th_archive:
+            th_archive.append(time.time(), round(temp * 10), hum)
+        if mqtt:
+            mqtt.publish_sensor(room_status['id'], "temperature", temp)
+            mqtt.publish_sensor(room_status['id'], "humidity", hum)
+        if th_reading and not th_reading.done():
+            th_reading.set_result(None)
 
 def on_receive_md_notify(sender, data: bytearray):
     # 人感ブロックからの通知
-    global motion_detected
+    global motion_detected, md_frame_count
     if len(data) >= 4 and data[0] == 0x01 and data[1] == 0x00:
-        motion_detected = data[3] == 0x01
+        md_frame_count += 1
+        detected = data[3] == 0x01
+        if md_archive:
+            md_archive.append(time.time(), 1 if detected else 0)
+        if mqtt:
+            mqtt.publish_sensor(room_status['id'], "presence", detected)
+        if detected != motion_detected:
+            mark_presence_change()
+        motion_detected = detected
 
 def on_receive_ac_notify(sender, data: bytearray):
     # 動きブロックからの通知
-    global away_mode
+    global away_mode, md_query_pending
     if len(data) >= 3 and data[0] == 0x01 and data[1] == 0x03:
         orientation = data[2]
+        if (orientation == 0x04) != away_mode:
+            # 向きが変わったら人感ブロックの今の状態をすぐ確かめる
+            md_query_pending = True
+            mark_presence_change()
         away_mode = orientation == 0x04
 
-async def connect_and_setup(serial_number, notify_handler=None):
+def mark_presence_change():
+    # 在室状況が変わったので人感ブロックを短い間隔に切り替える
+    global md_last_change
+    md_last_change = asyncio.get_running_loop().time()
+    md_rate_event.set()
+
+def encode_md_mode(mode, interval_ms=MD_INTERVAL_FAST_MS, response_ms=MD_RESPONSE_MS, request_id=0x00):
+    # 人感ブロックの通知モード設定コマンド (末尾にチェックサム)
+    command = pack('<BBBBHH', 0x01, 0x00, request_id, mode, interval_ms, response_ms)
+    return command + pack('B', checksum(command))
+
+def md_target_interval(now):
+    # 今の部屋の状態で使う人感ブロックの通知間隔
+    if now - md_last_change < MD_FAST_HOLD_SECONDS:
+        return MD_INTERVAL_FAST_MS
+    if motion_detected and not away_mode:
+        return MD_INTERVAL_OCCUPIED_MS
+    return MD_INTERVAL_EMPTY_MS
+
+async def set_md_interval(client, interval_ms):
+    global md_interval_ms
+    await client.write_gatt_char(CORE_WRITE_UUID, encode_md_mode(MD_MODE_CONTINUOUS, interval_ms), response=True)
+    md_interval_ms = interval_ms
+    print(f"人感ブロックの通知間隔を{interval_ms}msに設定しました")
+
+async def md_rate_control():
+    # 人感ブロックの通知間隔を部屋の状態に合わせて切り替える
+    # 在室状況が変わったら短い間隔にし、MD_FAST_HOLD_SECONDS 変化がなければ在室中・空室の間隔に戻す
+    global md_query_pending
+    loop = asyncio.get_running_loop()
+    while True:
+        fast_remaining = md_last_change + MD_FAST_HOLD_SECONDS - loop.time()
+        try:
+            await asyncio.wait_for(md_rate_event.wait(), fast_remaining if fast_remaining > 0 else None)
+        except asyncio.TimeoutError:
+            pass
+        md_rate_event.clear()
+        if md_sensor:
+            # 入れ替えモードでは通知間隔を設定せず、向きが変わったら次の空いた接続ですぐ読む
+            if md_query_pending:
+                md_query_pending = False
+                rotation.refresh(md_sensor)
+            continue
+        md_client = md_block.client if md_block else None
+        if not md_client or not md_client.is_connected:
+            continue
+        try:
+            if md_query_pending:
+                md_query_pending = False
+                await md_client.write_gatt_char(CORE_WRITE_UUID, encode_md_mode(MD_MODE_ONCE, request_id=0x01), response=True)
+            interval_ms = md_target_interval(loop.time())
+            if interval_ms != md_interval_ms:
+                await set_md_interval(md_client, interval_ms)
+        except Exception as e:
+            print(f"人感ブロックの通知間隔の設定エラー: {e}")
+
+def md_frames_report(now):
+    # 人感ブロックの1時間あたりの通知数を、以前の固定モードと比べる
+    if md_started is None or now <= md_started:
+        return "人感ブロックの通知数: 集計なし"
+    hours = (now - md_started) / 3600
+    per_hour = md_frame_count / hours
+    fixed_per_hour = 3600 * 1000 / MD_FIXED_INTERVAL_MS
+    return (f"人感ブロックの通知数: {per_hour:.0f}件/時 (固定モード {fixed_per_hour:.0f}件/時, "
+            f"{fixed_per_hour - per_hour:.0f}件/時 削減, 集計 {hours:.1f}時間)")
+
+def mqtt_report(now):
+    # MQTTの1分あたりの送信数を、ブロックからの通知数と並べる
+    return mqtt.report((now - md_started) / 60, {"温湿度": th_frame_count, "人感": md_frame_count})
+
+async def connect_and_setup(serial_number, notify_handler=None, disconnected_callback=None):
     # ブロックに接続して設定
     print(f"{serial_number}に接続中...")
-    device = await find_device_by_serial(serial_number)
-    if not device:
-        print(f"デバイスが見つかりません: {serial_number}")
-        return None
+    if not broker:
+        device = await find_device_by_serial(serial_number)
+        if not device:
+            print(f"デバイスが見つかりません: {serial_number}")
+            return None
     try:
-        client = BleakClient(device, timeout=None)
+        if broker:
+            # ブローカーが接続を持っているので、スキャンせずにシリアルナンバーで開く
+            client = broker.block(serial_number, disconnected_callback=disconnected_callback)
+        else:
+            client = BleakClient(device, timeout=None, disconnected_callback=disconnected_callback)
         await client.connect()
         print(f"{serial_number}に接続完了")
         # 機能有効化コマンドを送信
@@ -98,65 +256,158 @@ async def connect_and_setup(serial_number, notify_handler=None):
         return None
 
 async def find_device_by_serial(serial_number):
-    # シリアルナンバーでデバイスを検索
-    while True:
-        devices = await discover()
-        device = next((d for d in devices if d.name and d.name.startswith(serial_number)), None)
-        if device:
-            return device
-        print(f"デバイス {serial_number} が見つかりませんでした。再スキャンします...")
-        await asyncio.sleep(2)
-
-async def setup_all_blocks():
-    # 全ブロックの接続と初期設定
-    global th_client, md_client, ac_client
+    # シリアルナンバーでデバイスを検索 (共有スキャナで他のブロックの検索とスキャンをまとめる)
+    return await find_block(serial_number)
+
+# ブロックごとの設定 (接続・再接続のたびに行う)
+async def setup_th(client):
+    await client.write_gatt_char(CORE_WRITE_UUID, TH_REQUEST, response=True)
+    print("温湿度ブロックに初期データ要求を送信しました")
+    # 以後は定期要求で読む (切断されたら登録を外し、再接続でまた登録する)
+    poller.add(f"{room_status['id']}.TH", lambda: poll_th(client))
+
+async def poll_th(client):
+    # 温湿度ブロックにデータを要求し、通知が届くまで待つ
+    global th_reading
+    th_reading = asyncio.get_running_loop().create_future()
+    await client.write_gatt_char(CORE_WRITE_UUID, TH_REQUEST, response=True)
+    await th_reading
+
+async def setup_md(client):
+    # 人感ブロックを定期通知モードに設定 (状態がわかるまでは短い間隔)
+    mark_presence_change()
+    await set_md_interval(client, MD_INTERVAL_FAST_MS)
+    print("人感ブロックを定期通知モードに設定しました")
+    # 人感ブロックに現在の状態を1回通知要求
+    await client.write_gatt_char(CORE_WRITE_UUID, encode_md_mode(MD_MODE_ONCE, request_id=0x01), response=True)
+    print("人感ブロックに初期状態要求を送信しました")
+
+async def setup_ac(client):
+    # 動きブロックのオリエンテーションイベントを設定
+    ac_mode_setting = pack('<BBB', 0x01, 0x03, 0x00)
+    await client.write_gatt_char(CORE_WRITE_UUID, ac_mode_setting + pack('B', checksum(ac_mode_setting)), response=True)
+    print("動きブロックを向き変化通知モードに設定しました")
+
+def supervise(serial_number, notify_handler, setup, on_lost=None):
+    supervisor = BlockSupervisor(
+        serial_number,
+        lambda disconnected_callback: connect_and_setup(serial_number, notify_handler, disconnected_callback),
+        setup, on_lost=on_lost)
+    supervisor.start()
+    return supervisor
+
+def is_th_reading(data):
+    return len(data) >= 8 and data[0] == 0x01 and data[1] == 0x00
+
+def is_md_reading(data):
+    return len(data) >= 4 and data[0] == 0x01 and data[1] == 0x00
+
+def start_rotation(slots):
+    # 温湿度・人感ブロックを接続の入れ替えで読む (動きブロックはイベントを逃さないよう常時接続のまま)
+    global rotation, th_sensor, md_sensor
+    rotation = ConnectionRotation(lambda serial_number: connect_and_setup(serial_number), slots)
+    th_sensor = rotation.add(RotatingSensor(room_status['id'], "TH", SN_TH, TH_FRESHNESS_SECONDS,
+                                            TH_REQUEST, is_th_reading, lambda data: on_receive_th_notify(None, data)))
+    md_sensor = rotation.add(RotatingSensor(room_status['id'], "MD", SN_MD, MD_FRESHNESS_SECONDS,
+                                            encode_md_mode(MD_MODE_ONCE, request_id=0x01), is_md_reading,
+                                            lambda data: on_receive_md_notify(None, data)))
+    rotation.start()
+
+async def setup_all_blocks(rotate=False, slots=ROTATION_SLOTS):
+    # 全ブロックの見張りを始め、起動時は SETUP_TIMEOUT_SECONDS まで全ブロックの接続を待つ
+    # 接続できなかったブロックはバックグラウンドで接続を続け、その間も部屋の監視は進める
+    # rotate: 温湿度・人感ブロックを常時接続せず、接続の入れ替えで読む
+    global th_block, md_block, ac_block
     print("--- MESHブロックのセットアップを開始します ---")
-    th_client = await connect_and_setup(SN_TH, on_receive_th_notify)
-    md_client = await connect_and_setup(SN_MD, on_receive_md_notify)
-    if md_client:
-        # 人感ブロックの通知モードを設定
-        md_mode_setting = pack('<BBBB', 0x01, 0x00, 0x00, 0x20)
-        await md_client.write_gatt_char(CORE_WRITE_UUID, md_mode_setting + pack('B', checksum(md_mode_setting)), response=True)
-        print("人感ブロックを定期通知モードに設定しました")
-    ac_client = await connect_and_setup(SN_AC, on_receive_ac_notify)
-    if ac_client:
-        # 動きブロックのオリエンテーションイベントを設定
-        ac_mode_setting = pack('<BBB', 0x01, 0x03, 0x00)
-        await ac_client.write_gatt_char(CORE_WRITE_UUID, ac_mode_setting + pack('B', checksum(ac_mode_setting)), response=True)
-        print("動きブロックを向き変化通知モードに設定しました")
-    if not all([th_client, md_client, ac_client]):
-        print("エラー: 全てのブロックに接続できませんでした。終了します。")
-        return False
-    print("--- セットアップ完了 ---")
-    return True
-
-async def reconnect(client, serial_number):
-    # クライアントが切断されているか確認
-    if not client or not client.is_connected:
-        print(f"{serial_number}との接続が切れました。再接続を試みます...")
-        client = await connect_and_setup(serial_number)
-    return client
-
-async def main_loop():
+    poller.start()
+    if rotate:
+        start_rotation(slots)
+    else:
+        th_block = supervise(SN_TH, on_receive_th_notify, setup_th,
+                             on_lost=lambda: poller.remove(f"{room_status['id']}.TH"))
+        md_block = supervise(SN_MD, on_receive_md_notify, setup_md)
+    ac_block = supervise(SN_AC, on_receive_ac_notify, setup_ac)
+    blocks = [block for block in (th_block, md_block, ac_block) if block]
+    try:
+        await asyncio.wait_for(asyncio.gather(*[block.ready.wait() for block in blocks]), SETUP_TIMEOUT_SECONDS)
+        print("--- セットアップ完了 ---")
+    except asyncio.TimeoutError:
+        missing = ", ".join(block.name for block in blocks if not block.is_available())
+        print(f"警告: 接続できていないブロックがあります ({missing})。バックグラウンドで接続を続けます。")
+
+async def stop_all_blocks():
+    # 見張りを止めて全ブロックから切断する
+    if rotation:
+        await rotation.stop()
+    await poller.stop()
+    await asyncio.gather(*[block.stop() for block in (th_block, md_block, ac_block) if block],
+                         return_exceptions=True)
+
+def availability_report(now):
+    lines = [block.report(now) for block in (th_block, md_block, ac_block) if block]
+    if rotation:
+        lines.append(rotation.report(now))
+    if poller.entries:
+        lines.append(poller.report())
+    if lag_monitor:
+        lines.append(lag_monitor.report())
+    return "\n".join(lines)
+
+async def main_loop(rotate=False, slots=ROTATION_SLOTS, collector=None, host_id=None, history_path=None, archive_dir=None,
+                    mqtt_broker=None, lag_threshold_ms=None, broker_path=None):
     # メインループ
-    global room_status, motion_detected, away_mode
-    if not await setup_all_blocks():
-        return
-    if th_client:
-        await th_client.write_gatt_char(CORE_WRITE_UUID, pack('<BBBB', 0x00, 0x03, 0x00, 0x03), response=True)
-        print("温湿度ブロックに初期データ要求を送信しました")
-    if md_client:
-        # 人感ブロックに現在の状態を1回通知要求
-        md_onetime_request = pack('<BBBBHH', 0x01, 0x00, 0x01, 0x10, 500, 500)
-        await md_client.write_gatt_char(CORE_WRITE_UUID, md_onetime_request + pack('B', checksum(md_onetime_request)), response=True)
-        print("人感ブロックに初期状態要求を送信しました")
+    # collector: 集約サーバのアドレス (host, port)。指定すると部屋の状態の変化を送る
+    # history_path: 履歴を書くSQLiteファイル、archive_dir: 生のサンプルを書くディレクトリ
+    # mqtt_broker: MQTTブローカーのアドレス (host, port)。指定すると部屋の状態とセンサーの値を送る
+    # lag_threshold_ms: 指定するとイベントループの遅れを計り、これ以上止めたコードを記録する
+    # broker_path: mesh_broker のソケット。指定するとブロックへの接続はブローカーのものを使う
+    global room_status, motion_detected, away_mode, md_started, publisher, history, th_archive, md_archive, mqtt, lag_monitor
+    global broker
+    if lag_threshold_ms:
+        lag_monitor = LoopLagMonitor(lag_threshold_ms)
+        lag_monitor.start()
+    if collector:
+        publisher = await RoomPublisher.connect(host_id or socket.gethostname(), collector)
+    if history_path:
+        history = HistoryStore(history_path)
+        # 前回止まったときに在室中のままだった区間は、起動した時刻で閉じる
+        history.record_occupancy(room_status['id'], room_status['occupancy'])
+    if archive_dir:
+        th_archive, md_archive = open_room_archives(archive_dir)
+    if mqtt_broker:
+        mqtt = MqttRoomPublisher().connect(*mqtt_broker, client_id=host_id)
+    if broker_path:
+        print(f"MESHブローカーに接続中... ({broker_path})")
+        broker = await BrokerClient.connect(broker_path)
+    await setup_all_blocks(rotate, slots)
+    loop = asyncio.get_running_loop()
+    md_started = loop.time()
+    last_report = md_started
+    rate_control = asyncio.create_task(md_rate_control())
     if not os.path.exists(CSV_FILE_NAME):
         update_csv()
+    try:
+        await monitor_room(loop, last_report)
+    finally:
+        rate_control.cancel()
+        if publisher:
+            publisher.close()
+        if history:
+            history.close()
+        if th_archive:
+            th_archive.close()
+            md_archive.close()
+        if mqtt:
+            print(mqtt_report(loop.time()))
+            mqtt.close()
+        if lag_monitor:
+            await lag_monitor.stop()
+
+async def monitor_room(loop, last_report):
+    # 15秒ごとに部屋の状態を判定してCSVに書く (ブロックの再接続は見張りのタスクに任せて待たない)
+    last_archive_flush = loop.time()
     while True:
         try:
-            th_client = await reconnect(th_client, SN_TH)
-            md_client = await reconnect(md_client, SN_MD)
-            ac_client = await reconnect(ac_client, SN_AC)
             current_occupancy = room_status['occupancy']
             if away_mode:
                 if current_occupancy != '退席中':
@@ -172,22 +423,65 @@ async def main_loop():
                         room_status['occupancy'] = '空室'
                         room_status['entry_start_time'] = ''
             update_csv()
+            if history and room_status['occupancy'] != current_occupancy:
+                history.record_occupancy(room_status['id'], room_status['occupancy'])
+            if publisher:
+                publisher.publish(room_status['id'], room_status)
+            if mqtt:
+                mqtt.publish_state(room_status['id'], room_status)
+            if th_archive and loop.time() - last_archive_flush >= ARCHIVE_FLUSH_SECONDS:
+                last_archive_flush = loop.time()
+                th_archive.flush()
+                md_archive.flush()
+            if loop.time() - last_report >= 3600:
+                last_report = loop.time()
+                print(md_frames_report(last_report))
+                print(availability_report(last_report))
+                if mqtt:
+                    print(mqtt_report(last_report))
         except Exception as e:
             print(f"メインループでエラーが発生しました: {e}")
             break
         await asyncio.sleep(15)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MESHブロックで部屋の在室状況・温湿度をCSVに書く")
+    parser.add_argument("--rotate", action="store_true",
+                        help="温湿度・人感ブロックを常時接続せず、接続を入れ替えながら読む")
+    parser.add_argument("--slots", type=int, default=ROTATION_SLOTS, help="入れ替えに使う接続の数")
+    parser.add_argument("--collector", type=parse_address, metavar="HOST:PORT",
+                        help="部屋の状態の変化を送る集約サーバ (room_collector.py)")
+    parser.add_argument("--host-id", help="集約サーバに名乗るホストID (省略時はホスト名)")
+    parser.add_argument("--history", nargs="?", const=HISTORY_FILE_NAME, metavar="DB",
+                        help="在室状況の変化と温湿度をSQLiteに記録する")
+    parser.add_argument("--archive", nargs="?", const=ARCHIVE_DIR_NAME, metavar="DIR", help="温湿度・人感の生のサンプルを列ごとのアーカイブに記録する")
+    parser.add_argument("--mqtt", type=lambda text: parse_address(text, MQTT_PORT), metavar="HOST[:PORT]",
+                        help="部屋の状態とセンサーの値を送るMQTTブローカー (retain 付き、要 paho-mqtt)")
+    parser.add_argument("--lag-threshold", type=float, default=THRESHOLD_MS, metavar="MS",
+                        help="イベントループをこのミリ秒以上止めたコードを記録する (0で監視しない)")
+    parser.add_argument("--log-file", help="イベントログをJSON Linesで書き出すファイル")
+    parser.add_argument("--broker", nargs="?", const=SOCKET_PATH, metavar="SOCKET",
+                        help="mesh_broker デーモンの接続を使う (他のスクリプトとブロックの接続を共有する)")
+    args = parser.parse_args()
+    if args.broker and args.rotate:
+        parser.error("--broker では接続はブローカーが持ち続けるため、--rotate とは一緒に使えません")
+    event_log.configure(path=args.log_file)
     loop = asyncio.get_event_loop()
+    main_task = loop.create_task(main_loop(args.rotate, args.slots, args.collector, args.host_id, args.history, args.archive,
+                                           args.mqtt, args.lag_threshold, args.broker))
     try:
-        loop.run_until_complete(main_loop())
+        loop.run_until_complete(main_task)
     except KeyboardInterrupt:
         print("ユーザーによってプログラムが停止されました。")
+        # main_loop の後始末 (履歴・アーカイブの書き出し、MQTTの切断など) を済ませる
+        main_task.cancel()
+        loop.run_until_complete(asyncio.gather(main_task, return_exceptions=True))
     finally:
+        print(md_frames_report(loop.time()))
+        print(availability_report(loop.time()))
         print("MESHブロックから切断します...")
-        if th_client and th_client.is_connected:
-            loop.run_until_complete(th_client.disconnect())
-        if md_client and md_client.is_connected:
-            loop.run_until_complete(md_client.disconnect())
-        if ac_client and ac_client.is_connected:
-            loop.run_until_complete(ac_client.disconnect())
\ No newline at end of file
+        loop.run_until_complete(stop_all_blocks())
+        if broker:
+            # 購読の解除を送り終えてからブローカーとの接続を閉じる
+            loop.run_until_complete(broker.close())
+        event_log.shutdown()
\ No newline at end of file
@@ -0,0 +1,128 @@
+import asyncio
+import zlib
+
+import mesh_metrics
+
+# 定期的な読み取り要求の時刻をずらすスケジューラ
+# 同じ周期の要求が一斉に出るとアダプタと電波を取り合うので、周期の中で等間隔にずらして出す。
+# ずらし方 (位相) は名前の crc32 の順に並べて決めるので、起動し直しても同じブロックは同じ位置になる。
+# ブロックが増減したら並べ直し、それぞれ次の自分の位相から続ける。
+# 要求ごとに、出してから完了する (通知が届く) までの時間を記録する。
+
+POLL_TIMEOUT_RATIO = 0.5 # 周期に対するこの割合まで完了を待つ
+DUE_SLACK_SECONDS = 0.001 # 予定までこれより短ければ待たずに出す
+
+class PollEntry:
+    def __init__(self, name, poll):
+        # poll(): 要求を出し、完了するまで待つコルーチン関数
+        self.name = name
+        self.poll = poll
+        self.offset = 0.0
+        self.next_time = None
+        self.running = None # 実行中の要求のタスク
+        self.latency = mesh_metrics.histogram(f"poll.{name}.latency_ms")
+
+class PollScheduler:
+    def __init__(self, period_seconds, stagger=True):
+        # stagger=False なら全て同じ位相で出す (ずらさない場合との比較用)
+        self.period_seconds = period_seconds
+        self.stagger = stagger
+        self.entries = {} # {名前: PollEntry}
+        self.epoch = None # 位相の基準の時刻 (loop.time())
+        self.task = None
+        self.changed = asyncio.Event()
+        self.latency = mesh_metrics.histogram("poll.latency_ms")
+        self.completed = mesh_metrics.counter("poll.completed")
+        self.failed = mesh_metrics.counter("poll.failed")
+        self.skipped = mesh_metrics.counter("poll.skipped") # 前の要求が終わっていなかったので出さなかった回数
+
+    def add(self, name, poll):
+        # 同じ名前で呼び直すと poll だけ置き換える
+        if name in self.entries:
+            self.entries[name].poll = poll
+            return self.entries[name]
+        self.entries[name] = PollEntry(name, poll)
+        self._rebalance()
+        return self.entries[name]
+
+    def remove(self, name):
+        entry = self.entries.pop(name, None)
+        if entry:
+            self._rebalance()
+
+    def offset(self, name):
+        return self.entries[name].offset
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self.epoch is None:
+            self.epoch = loop.time()
+            self._rebalance()
+        self.task = asyncio.create_task(self._run(), name="poll_scheduler")
+
+    async def stop(self):
+        tasks = [entry.running for entry in self.entries.values() if entry.running]
+        if self.task:
+            tasks.append(self.task)
+            self.task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def report(self):
+        lines = [f"定期要求: {len(self.entries)}件 / {self.period_seconds:.0f}秒周期, "
+                 f"完了 {self.completed.value}回 (失敗 {self.failed.value}回, 前回未完了で見送り {self.skipped.value}回)"]
+        for entry in self.entries.values():
+            latency = entry.latency.snapshot()
+            lines.append(f"  {entry.name}: 位相 {entry.offset:.1f}秒, 完了まで p50 {latency['p50']:.0f}ms "
+                         f"p99 {latency['p99']:.0f}ms 最大 {latency['max']:.0f}ms")
+        return "\n".join(lines)
+
+    def _rebalance(self):
+        # 名前の crc32 の順に並べ、周期を等分した位相を割り当てる
+        ordered = sorted(self.entries.values(), key=lambda entry: (zlib.crc32(entry.name.encode('utf-8')), entry.name))
+        for i, entry in enumerate(ordered):
+            entry.offset = i * self.period_seconds / len(ordered) if self.stagger else 0.0
+        if self.epoch is not None:
+            now = asyncio.get_running_loop().time()
+            for entry in ordered:
+                entry.next_time = self._next_phase(entry, now)
+        # 待っているタスクを起こす (待ち始めたイベントを set し、次の待ちには新しいイベントを使う)
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def _next_phase(self, entry, after):
+        # after 以降で最初に来る entry の位相の時刻
+        cycles = -((self.epoch + entry.offset - after) // self.period_seconds)
+        return self.epoch + entry.offset + max(0, cycles) * self.period_seconds
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = min(self.entries.values(), key=lambda entry: entry.next_time, default=None)
+            delay = entry.next_time - loop.time() if entry else None
+            if delay is None or delay > DUE_SLACK_SECONDS:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            entry.next_time += self.period_seconds
+            if entry.running and not entry.running.done():
+                self.skipped.inc()
+                continue
+            entry.running = asyncio.create_task(self._poll(entry), name=f"poll/{entry.name}")
+
+    async def _poll(self, entry):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            await asyncio.wait_for(entry.poll(), self.period_seconds * POLL_TIMEOUT_RATIO)
+        except Exception as e:
+            self.failed.inc()
+            print(f"{entry.name}の定期要求エラー: {e!r}")
+            return
+        latency_ms = (loop.time() - started) * 1000
+        entry.latency.record(latency_ms)
+        self.latency.record(latency_ms)
+        self.completed.inc()
@@ -0,0 +1,259 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import time
+
+import mesh_metrics
+
+# 建物全体の部屋の状態を集める集約サーバ
+# 各監視ホスト (nomorenoknock) は部屋の状態が変わった項目だけを UDP で送り、集約サーバが1つの表にまとめる。
+# データグラムは1行のJSON (キーは短縮):
+#   {"h": ホストID, "b": 起動ID, "q": 連番, "f": 1なら全件, "r": {部屋ID: {項目: 値, ...}, ...}}
+# 連番はホストごとに1ずつ増え、集約サーバは抜けた番号を取りこぼしとして数えて、そのホストに全件の再送を頼む
+#   ({"resync": 1} を送り返す)。ホストは FULL_SYNC_SECONDS ごとにも全件を送るので、頼みが届かなくても追いつく。
+# 起動IDが変わったら (ホストが起動し直したら) 連番を数え直す。
+
+COLLECTOR_PORT = 50700
+MAX_DATAGRAM_BYTES = 1200     # これを超えないように部屋を分けて送る
+FULL_SYNC_SECONDS = 60.0      # 全件を送り直す間隔
+RESYNC_INTERVAL_SECONDS = 1.0 # 同じホストに再送を頼む最短の間隔 (取りこぼしが続いても頼みすぎない)
+CSV_INTERVAL_SECONDS = 5.0    # 建物全体の表をCSVに書く間隔 (変化があったときだけ)
+BUILDING_CSV_FILE_NAME = 'building_status.csv'
+BUILDING_CSV_HEADERS = ["部屋ID", "空室状況", "温度", "湿度", "入室開始時刻", "ホスト", "更新時刻"]
+ROOM_FIELDS = ['occupancy', 'temperature', 'humidity', 'entry_start_time']
+
+def encode_message(message):
+    return json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def parse_address(text, default_port=COLLECTOR_PORT):
+    # "127.0.0.1:50700" -> ("127.0.0.1", 50700)
+    host, _, port = text.rpartition(":")
+    return (host, int(port)) if host else (text, default_port)
+
+# 監視ホスト側
+class RoomPublisher(asyncio.DatagramProtocol):
+    def __init__(self, host_id, full_sync_seconds=FULL_SYNC_SECONDS):
+        self.host_id = host_id
+        self.boot_id = random.getrandbits(32)
+        self.full_sync_seconds = full_sync_seconds
+        self.sequence = 0
+        self.rooms = {}    # {部屋ID: 最後に伝えた状態}
+        self.pending = {}  # {部屋ID: 送っていない変化}
+        self.transport = None
+        self.flush_handle = None
+        self.sync_task = None
+        self.sent = mesh_metrics.counter("publisher.datagrams")
+        self.resyncs = mesh_metrics.counter("publisher.resyncs")
+
+    @classmethod
+    async def connect(cls, host_id, address, **kwargs):
+        loop = asyncio.get_running_loop()
+        _, publisher = await loop.create_datagram_endpoint(lambda: cls(host_id, **kwargs), remote_addr=address)
+        publisher.sync_task = asyncio.create_task(publisher._sync_periodically(), name="publisher/sync")
+        return publisher
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        # 集約サーバから全件の再送を頼まれた
+        try:
+            request = json.loads(data)
+        except ValueError:
+            return
+        if request.get("resync"):
+            self.resyncs.inc()
+            self.send_full()
+
+    def error_received(self, exc):
+        pass # 集約サーバが止まっていても監視は続ける (再開したら全件の送り直しで追いつく)
+
+    def close(self):
+        if self.sync_task:
+            self.sync_task.cancel()
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush()
+        if self.transport:
+            self.transport.close()
+
+    def publish(self, room_id, status):
+        # 部屋の今の状態を渡す。前回から変わった項目だけを、同じ周回の他の変化とまとめて送る
+        last = self.rooms.setdefault(room_id, {})
+        changed = {field: status[field] for field in ROOM_FIELDS if field in status and last.get(field) != status[field]}
+        if not changed:
+            return
+        last.update(changed)
+        self.pending.setdefault(room_id, {}).update(changed)
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        pending, self.pending = self.pending, {}
+        self._send(pending, full=False)
+
+    def send_full(self):
+        self._send(self.rooms, full=True)
+
+    def _send(self, rooms, full):
+        # MAX_DATAGRAM_BYTES に収まるように部屋を分けて、それぞれに連番を付けて送る
+        if not self.transport or (not rooms and not full):
+            return
+        batch = {}
+        size = 0
+        for room_id, fields in rooms.items():
+            room_size = len(encode_message({room_id: fields}))
+            if batch and size + room_size > MAX_DATAGRAM_BYTES - 64:
+                self._send_datagram(batch, full)
+                batch, size = {}, 0
+            batch[room_id] = fields
+            size += room_size
+        if batch or full:
+            self._send_datagram(batch, full)
+
+    def _send_datagram(self, rooms, full):
+        self.sequence += 1
+        message = {"h": self.host_id, "b": self.boot_id, "q": self.sequence, "r": rooms}
+        if full:
+            message["f"] = 1
+        self.transport.sendto(encode_message(message))
+        self.sent.inc()
+
+    async def _sync_periodically(self):
+        while True:
+            await asyncio.sleep(self.full_sync_seconds)
+            self.send_full()
+
+# 集約サーバ側
+class HostState:
+    def __init__(self, boot_id):
+        self.boot_id = boot_id
+        self.last_sequence = 0
+        self.address = None
+        self.received = 0
+        self.lost = 0
+        self.resync_requested = None # 最後に再送を頼んだ時刻 (time.monotonic())
+
+class RoomCollector(asyncio.DatagramProtocol):
+    def __init__(self, on_update=None):
+        # on_update(host_id, room_id, fields): 部屋の状態を更新したときに呼ぶ関数
+        self.on_update = on_update
+        self.rooms = {} # {部屋ID: {項目: 値, "host": ホストID, "updated": 更新時刻}}
+        self.hosts = {} # {ホストID: HostState}
+        self.transport = None
+        self.version = 0 # 表が変わるたびに増やす (CSVを書くかどうかの判定)
+        self.datagrams = mesh_metrics.counter("collector.datagrams")
+        self.lost = mesh_metrics.counter("collector.lost")
+        self.stale = mesh_metrics.counter("collector.stale")     # 重複・順番が入れ替わって古くなったもの
+        self.invalid = mesh_metrics.counter("collector.invalid")
+        mesh_metrics.gauge("collector.rooms", lambda: len(self.rooms))
+
+    @classmethod
+    async def listen(cls, address, **kwargs):
+        loop = asyncio.get_running_loop()
+        _, collector = await loop.create_datagram_endpoint(lambda: cls(**kwargs), local_addr=address)
+        return collector
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+    def datagram_received(self, data, addr):
+        self.datagrams.inc()
+        try:
+            message = json.loads(data)
+            host_id, boot_id, sequence, rooms = message["h"], message["b"], message["q"], message["r"]
+        except (ValueError, KeyError, TypeError):
+            self.invalid.inc()
+            return
+        host = self.hosts.get(host_id)
+        if host is None or host.boot_id != boot_id:
+            # 初めてのホストか、起動し直したホスト。全件が来るまでの差分も受け入れる
+            host = self.hosts[host_id] = HostState(boot_id)
+            if not message.get("f"):
+                self._request_resync(host, addr)
+        host.address = addr
+        if sequence <= host.last_sequence:
+            self.stale.inc()
+            return
+        gap = sequence - host.last_sequence - 1
+        if gap > 0 and host.last_sequence > 0:
+            host.lost += gap
+            self.lost.inc(gap)
+            if not message.get("f"):
+                self._request_resync(host, addr)
+        host.last_sequence = sequence
+        host.received += 1
+        updated = time.strftime('%Y-%m-%d %H:%M:%S')
+        for room_id, fields in rooms.items():
+            room = self.rooms.setdefault(room_id, {})
+            room.update(fields)
+            room["host"] = host_id
+            room["updated"] = updated
+            if self.on_update:
+                self.on_update(host_id, room_id, fields)
+        self.version += 1
+
+    def _request_resync(self, host, addr):
+        now = time.monotonic()
+        if not self.transport or (host.resync_requested is not None and now - host.resync_requested < RESYNC_INTERVAL_SECONDS):
+            return
+        host.resync_requested = now
+        self.transport.sendto(encode_message({"resync": 1}), addr)
+
+    def loss_rate(self, host_id):
+        host = self.hosts[host_id]
+        expected = host.received + host.lost
+        return host.lost / expected if expected else 0.0
+
+    def report(self):
+        lines = [f"集約: {len(self.rooms)}部屋 / {len(self.hosts)}ホスト, 受信 {self.datagrams.value}件 "
+                 f"(取りこぼし {self.lost.value}件, 古い {self.stale.value}件, 不正 {self.invalid.value}件)"]
+        for host_id, host in sorted(self.hosts.items()):
+            lines.append(f"  {host_id}: 連番 {host.last_sequence}, 取りこぼし率 {self.loss_rate(host_id):.2%}")
+        return "\n".join(lines)
+
+    def write_csv(self, path):
+        # 書きかけのファイルが残らないよう置き換えで書く
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(BUILDING_CSV_HEADERS)
+            for room_id, room in sorted(self.rooms.items()):
+                writer.writerow([room_id] + [room.get(field, '') for field in ROOM_FIELDS] + [room["host"], room["updated"]])
+        os.replace(tmp_path, path)
+
+async def main(address, csv_path):
+    collector = await RoomCollector.listen(address)
+    print(f"集約サーバを起動しました: {address[0]}:{address[1]}")
+    written_version = 0
+    last_report = time.monotonic()
+    try:
+        while True:
+            await asyncio.sleep(CSV_INTERVAL_SECONDS)
+            if collector.version != written_version:
+                written_version = collector.version
+                collector.write_csv(csv_path)
+            if time.monotonic() - last_report >= 3600:
+                last_report = time.monotonic()
+                print(collector.report())
+    finally:
+        print(collector.report())
+        collector.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="監視ホストから部屋の状態を集める集約サーバ")
+    parser.add_argument("--listen", default=f"0.0.0.0:{COLLECTOR_PORT}", help="待ち受けるアドレス:ポート")
+    parser.add_argument("--csv", default=BUILDING_CSV_FILE_NAME, help="建物全体の状態を書くCSVファイル")
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(parse_address(args.listen), args.csv))
+    except KeyboardInterrupt:
+        print("集約サーバを停止しました。")
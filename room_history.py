@@ -0,0 +1,228 @@
+import queue
+import sqlite3
+import threading
+import time
+
+import mesh_metrics
+
+# 部屋の在室状況と温湿度の履歴 (SQLite)
+# 在室状況の変化と温湿度のサンプルを記録し、「今週 Room-A は何時間使われたか」などに答える。
+# 記録はキューに積むだけで戻り、バックグラウンドのスレッドがまとめて1つのトランザクションで書く。
+# WALモードなので、書いている間も別の接続から読める。
+# 在室していた時間と温湿度は、書くときに1時間ごと・1日ごとの集計表にも足し込んでおき、
+# 1年分の問い合わせでも集計表の数百行を足すだけで済ませる。
+# 時刻はUNIX時刻 (秒)。1時間の区切りはUNIX時刻の3600秒ごと、1日の区切りはローカル時刻の0時。
+# インドなど時差が1時間単位でないタイムゾーンでは0時が1時間の区切りと揃わないので、日ごとの集計表は使わない。
+
+HISTORY_FILE_NAME = 'room_history.db'
+OCCUPIED = '使用中'
+BATCH_SIZE = 500          # 1つのトランザクションで書く最大の件数
+BATCH_SECONDS = 1.0       # 最初の1件からこの秒数は続きを待ってまとめる
+HOUR = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS occupancy_events (room TEXT NOT NULL, ts REAL NOT NULL, occupancy TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS occupancy_events_room_ts ON occupancy_events (room, ts);
+CREATE TABLE IF NOT EXISTS samples (room TEXT NOT NULL, ts REAL NOT NULL, temperature REAL, humidity REAL);
+CREATE INDEX IF NOT EXISTS samples_room_ts ON samples (room, ts);
+CREATE TABLE IF NOT EXISTS occupancy_hourly (room TEXT NOT NULL, start INTEGER NOT NULL, occupied_seconds REAL NOT NULL,
+                                             PRIMARY KEY (room, start)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS occupancy_daily (room TEXT NOT NULL, start INTEGER NOT NULL, occupied_seconds REAL NOT NULL,
+                                            PRIMARY KEY (room, start)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS samples_hourly (room TEXT NOT NULL, start INTEGER NOT NULL, count INTEGER NOT NULL,
+                                           temperature_sum REAL NOT NULL, temperature_min REAL, temperature_max REAL,
+                                           humidity_sum REAL NOT NULL, PRIMARY KEY (room, start)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS samples_daily (room TEXT NOT NULL, start INTEGER NOT NULL, count INTEGER NOT NULL,
+                                          temperature_sum REAL NOT NULL, temperature_min REAL, temperature_max REAL,
+                                          humidity_sum REAL NOT NULL, PRIMARY KEY (room, start)) WITHOUT ROWID;
+"""
+
+def hour_start(ts):
+    return int(ts // HOUR * HOUR)
+
+def day_start(ts):
+    # ts を含むローカル時刻の日の0時
+    local = time.localtime(ts)
+    return int(time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1)))
+
+def next_day_start(ts):
+    local = time.localtime(ts)
+    return int(time.mktime((local.tm_year, local.tm_mon, local.tm_mday + 1, 0, 0, 0, 0, 0, -1)))
+
+def connect(path):
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL") # WALではコミットごとのfsyncを省いても壊れない (電源断で直近の数件を失うだけ)
+    return db
+
+class HistoryStore:
+    def __init__(self, path=HISTORY_FILE_NAME):
+        self.path = path
+        self.records = queue.SimpleQueue()
+        self.reader = None
+        self.written = mesh_metrics.counter("history.written")
+        self.batches = mesh_metrics.histogram("history.batch_size")
+        mesh_metrics.gauge("history.queued", self.records.qsize)
+        db = connect(path)
+        db.executescript(SCHEMA)
+        db.close()
+        self.writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self.writer.start()
+
+    # 記録 (どのスレッド・イベントループからでも呼べて、待たされない)
+    def record_occupancy(self, room, occupancy, ts=None):
+        self.records.put(("occupancy", room, time.time() if ts is None else ts, occupancy))
+
+    def record_sample(self, room, temperature, humidity, ts=None):
+        self.records.put(("sample", room, time.time() if ts is None else ts, temperature, humidity))
+
+    def flush(self, timeout=None):
+        # ここまでに積んだ記録が書き終わるまで待つ
+        done = threading.Event()
+        self.records.put(("flush", done))
+        return done.wait(timeout)
+
+    def close(self):
+        self.records.put(None)
+        self.writer.join()
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+
+    # 書き込み (バックグラウンドのスレッド)
+    def _write_loop(self):
+        db = connect(self.path)
+        # 部屋ごとの今の在室状況と、その始まりの時刻 {部屋: (在室状況, 時刻)}
+        current = {room: (occupancy, ts) for room, ts, occupancy in db.execute(
+            "SELECT room, MAX(ts), occupancy FROM occupancy_events GROUP BY room")}
+        closing = False
+        while not closing:
+            batch = [self.records.get()]
+            deadline = time.monotonic() + BATCH_SECONDS
+            while len(batch) < BATCH_SIZE and batch[-1] is not None and batch[-1][0] != "flush":
+                try:
+                    batch.append(self.records.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            waiting = []
+            with db:
+                for record in batch:
+                    if record is None:
+                        closing = True
+                    elif record[0] == "flush":
+                        waiting.append(record[1])
+                    elif record[0] == "occupancy":
+                        self._write_occupancy(db, current, *record[1:])
+                    else:
+                        self._write_sample(db, *record[1:])
+            written = len(batch) - len(waiting) - (1 if closing else 0)
+            if written:
+                self.written.inc(written)
+                self.batches.record(written)
+            for done in waiting:
+                done.set()
+        db.close()
+
+    def _write_occupancy(self, db, current, room, ts, occupancy):
+        previous = current.get(room)
+        if previous and previous[0] == occupancy:
+            return # 変化していない
+        db.execute("INSERT INTO occupancy_events (room, ts, occupancy) VALUES (?, ?, ?)", (room, ts, occupancy))
+        if previous and previous[0] == OCCUPIED and ts > previous[1]:
+            self._add_occupied(db, room, previous[1], ts)
+        current[room] = (occupancy, ts)
+
+    def _add_occupied(self, db, room, start, end):
+        # 在室していた区間 [start, end) を1時間ごと・1日ごとに分けて集計表に足す
+        for table, boundary, next_boundary in (("occupancy_hourly", hour_start, lambda ts: hour_start(ts) + HOUR),
+                                               ("occupancy_daily", day_start, next_day_start)):
+            t = start
+            while t < end:
+                until = min(end, next_boundary(t))
+                db.execute(f"INSERT INTO {table} (room, start, occupied_seconds) VALUES (?, ?, ?) "
+                           f"ON CONFLICT (room, start) DO UPDATE SET occupied_seconds = occupied_seconds + excluded.occupied_seconds",
+                           (room, boundary(t), until - t))
+                t = until
+
+    def _write_sample(self, db, room, ts, temperature, humidity):
+        db.execute("INSERT INTO samples (room, ts, temperature, humidity) VALUES (?, ?, ?, ?)", (room, ts, temperature, humidity))
+        for table, start in (("samples_hourly", hour_start(ts)), ("samples_daily", day_start(ts))):
+            db.execute(f"INSERT INTO {table} (room, start, count, temperature_sum, temperature_min, temperature_max, humidity_sum) "
+                       f"VALUES (?, ?, 1, ?, ?, ?, ?) ON CONFLICT (room, start) DO UPDATE SET "
+                       f"count = count + 1, temperature_sum = temperature_sum + excluded.temperature_sum, "
+                       f"temperature_min = MIN(temperature_min, excluded.temperature_min), "
+                       f"temperature_max = MAX(temperature_max, excluded.temperature_max), "
+                       f"humidity_sum = humidity_sum + excluded.humidity_sum",
+                       (room, start, temperature, temperature, temperature, humidity))
+
+    # 問い合わせ (呼び出したスレッドの読み取り用の接続で読む)
+    def _db(self):
+        if self.reader is None:
+            self.reader = connect(self.path)
+        return self.reader
+
+    def occupied_seconds(self, room, start, end, now=None):
+        # [start, end) に在室していた秒数
+        # 端の1時間未満は変化の記録から数え、間の時間は1時間ごと・1日ごとの集計表を足す
+        if now is None:
+            now = time.time()
+        first_hour = int(-(-start // HOUR) * HOUR)
+        last_hour = hour_start(end)
+        if first_hour >= last_hour:
+            return self.scan_occupied_seconds(room, start, end, now)
+        total = self.scan_occupied_seconds(room, start, first_hour, now) + self.scan_occupied_seconds(room, last_hour, end, now)
+        first_day = next_day_start(first_hour - 1)
+        last_day = day_start(last_hour)
+        # 日の区切りが1時間の区切りと揃うときだけ日ごとの集計表を使う (揃わなければ区切りの1時間を二重に数えてしまう)
+        if first_day < last_day and first_day % HOUR == 0 and last_day % HOUR == 0:
+            total += self._sum_rollup("occupancy_hourly", room, first_hour, first_day)
+            total += self._sum_rollup("occupancy_daily", room, first_day, last_day)
+            total += self._sum_rollup("occupancy_hourly", room, last_day, last_hour)
+        else:
+            total += self._sum_rollup("occupancy_hourly", room, first_hour, last_hour)
+        # 集計表には終わった区間しか入っていないので、今も続いている在室の分を足す
+        row = self._db().execute("SELECT ts, occupancy FROM occupancy_events WHERE room = ? ORDER BY ts DESC LIMIT 1",
+                                 (room,)).fetchone()
+        if row and row[1] == OCCUPIED:
+            total += max(0.0, min(now, last_hour) - max(row[0], first_hour))
+        return total
+
+    def _sum_rollup(self, table, room, start, end):
+        row = self._db().execute(f"SELECT TOTAL(occupied_seconds) FROM {table} WHERE room = ? AND start >= ? AND start < ?",
+                                 (room, start, end)).fetchone()
+        return row[0]
+
+    def scan_occupied_seconds(self, room, start, end, now=None):
+        # 変化の記録だけから [start, end) に在室していた秒数を数える (集計表を使わない)
+        if now is None:
+            now = time.time()
+        end = min(end, now)
+        if end <= start:
+            return 0.0
+        db = self._db()
+        row = db.execute("SELECT occupancy FROM occupancy_events WHERE room = ? AND ts <= ? ORDER BY ts DESC LIMIT 1",
+                         (room, start)).fetchone()
+        occupied_since = start if row and row[0] == OCCUPIED else None
+        total = 0.0
+        for ts, occupancy in db.execute("SELECT ts, occupancy FROM occupancy_events WHERE room = ? AND ts > ? AND ts < ? "
+                                        "ORDER BY ts", (room, start, end)):
+            if occupancy == OCCUPIED:
+                if occupied_since is None:
+                    occupied_since = ts
+            elif occupied_since is not None:
+                total += ts - occupied_since
+                occupied_since = None
+        if occupied_since is not None:
+            total += end - occupied_since
+        return total
+
+    def hourly_occupancy(self, room, start, end):
+        # [(1時間の始まり, 在室秒数), ...] (終わった区間のみ)
+        return self._db().execute("SELECT start, occupied_seconds FROM occupancy_hourly WHERE room = ? AND start >= ? AND start < ? "
+                                  "ORDER BY start", (room, start, end)).fetchall()
+
+    def daily_climate(self, room, start, end):
+        # [(日の始まり, 平均温度, 最低温度, 最高温度, 平均湿度), ...]
+        return self._db().execute("SELECT start, temperature_sum / count, temperature_min, temperature_max, humidity_sum / count "
+                                  "FROM samples_daily WHERE room = ? AND start >= ? AND start < ? ORDER BY start",
+                                  (room, start, end)).fetchall()
@@ -0,0 +1,121 @@
+import asyncio
+import json
+
+import mesh_metrics
+
+# 部屋の状態をMQTTブローカーに送る
+# トピック (どれも retain 付きで、購読し始めたビルのシステムにもすぐ今の値が届く):
+#   {prefix}/{部屋ID}/state       在室状況と入室開始時刻 (JSON。温湿度は不感帯を通したセンサーのトピックだけで送る)
+#   {prefix}/{部屋ID}/temperature 温度 (℃)
+#   {prefix}/{部屋ID}/humidity    湿度 (%)
+#   {prefix}/{部屋ID}/presence    人感 (1/0)
+# 値が意味のある変化をしたときだけ送る。温度・湿度は不感帯より小さい揺れを送らず、
+# 変化がなくても MAX_SILENCE_SECONDS ごとには送り直す。
+# 同じ周回の変化はまとめて、トピックごとに最後の値を1回だけ送る。
+# 接続は1本を張ったまま paho のネットワークスレッドに再接続を任せ、つながり直したら全トピックを送り直す。
+
+MQTT_PORT = 1883
+TOPIC_PREFIX = "building"
+TEMPERATURE_DEADBAND = 0.3 # ℃
+HUMIDITY_DEADBAND = 2.0    # %
+MAX_SILENCE_SECONDS = 900  # 変化がなくてもこの秒数ごとに送り直す
+QOS = 1
+RECONNECT_MIN_SECONDS = 1
+RECONNECT_MAX_SECONDS = 60
+
+DEADBANDS = {"temperature": TEMPERATURE_DEADBAND, "humidity": HUMIDITY_DEADBAND}
+STATE_FIELDS = ['occupancy', 'entry_start_time']
+
+class MqttRoomPublisher:
+    def __init__(self, prefix=TOPIC_PREFIX, client=None):
+        # client: paho の Client と同じ publish(topic, payload, qos, retain) を持つもの (省略時は connect() で作る)
+        self.prefix = prefix
+        self.client = client
+        self.loop = None
+        self.last = {}     # {トピック: (送った値, 送った時刻)}
+        self.pending = {}  # {トピック: 送っていない値}
+        self.flush_handle = None
+        self.connected = False # 一度でも接続できたか (2回目からを再接続として数える)
+        self.publishes = mesh_metrics.counter("mqtt.publishes")
+        self.suppressed = mesh_metrics.counter("mqtt.suppressed")
+        self.reconnects = mesh_metrics.counter("mqtt.reconnects")
+
+    def connect(self, host, port=MQTT_PORT, client_id=None, username=None, password=None):
+        # paho-mqtt (2.x) で接続を始める。接続できるまで待たず、つながらない間の送信は paho が溜めておく
+        import paho.mqtt.client as mqtt
+        self.loop = asyncio.get_running_loop()
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id or "")
+        if username:
+            self.client.username_pw_set(username, password)
+        self.client.reconnect_delay_set(RECONNECT_MIN_SECONDS, RECONNECT_MAX_SECONDS)
+        self.client.on_connect = self._on_connect
+        self.client.connect_async(host, port, keepalive=60)
+        self.client.loop_start()
+        return self
+
+    def close(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush()
+        if self.client and hasattr(self.client, "loop_stop"):
+            self.client.disconnect()
+            self.client.loop_stop()
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        # paho のネットワークスレッドから呼ばれる
+        if reason_code.is_failure:
+            return
+        self.loop.call_soon_threadsafe(self._republish)
+
+    def _republish(self):
+        # つながったので、送った全トピックの最後の値を送り直す (ブローカーが retain を失っていても戻る)
+        if self.connected:
+            self.reconnects.inc()
+        self.connected = True
+        for topic, (value, _) in self.last.items():
+            self.pending.setdefault(topic, value)
+        self._schedule_flush()
+
+    def publish_state(self, room_id, status):
+        # 部屋の状態 (room_status) を渡す。在室状況か入室開始時刻が変わったときだけ送る
+        # (温湿度を含めると0.1℃の変化ごとに送ることになり、不感帯が効かない)
+        state = {field: status[field] for field in STATE_FIELDS if field in status}
+        self._update(f"{self.prefix}/{room_id}/state", state)
+
+    def publish_sensor(self, room_id, kind, value):
+        # kind: "temperature", "humidity", "presence"
+        self._update(f"{self.prefix}/{room_id}/{kind}", value, DEADBANDS.get(kind))
+
+    def _update(self, topic, value, deadband=None):
+        now = asyncio.get_running_loop().time()
+        last = self.last.get(topic)
+        if last is not None and now - last[1] < MAX_SILENCE_SECONDS:
+            if deadband is None and last[0] == value:
+                self.suppressed.inc()
+                return
+            if deadband is not None and abs(value - last[0]) < deadband:
+                self.suppressed.inc()
+                return
+        self.last[topic] = (value, now)
+        self.pending[topic] = value
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        # この周回に変わったトピックを、トピックごとに最後の値だけ送る
+        self.flush_handle = None
+        pending, self.pending = self.pending, {}
+        for topic, value in pending.items():
+            payload = json.dumps(value, ensure_ascii=False) if isinstance(value, dict) else str(int(value) if isinstance(value, bool) else value)
+            self.client.publish(topic, payload, qos=QOS, retain=True)
+            self.publishes.inc()
+
+    def report(self, minutes, notifications):
+        # minutes 分間の1分あたりの送信数を、元の通知数と並べる。notifications: {名前: 通知数}
+        minutes = max(minutes, 1e-9)
+        raw = ", ".join(f"{name} {count / minutes:.1f}件/分" for name, count in notifications.items())
+        return (f"MQTT: {self.publishes.value / minutes:.1f}件/分を送信 (抑制 {self.suppressed.value}件, 再接続 {self.reconnects.value}回) "
+                f"/ 通知 {raw}")
@@ -0,0 +1,197 @@
+import bisect
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+import mesh_metrics
+
+# センサーの生のサンプルを列ごとにまとめて保存するアーカイブ
+# サンプルは列ごとの型付き配列 (array) に溜め、CHUNK_ROWS 行ごとに1つのチャンクとしてデータファイルの末尾に書く。
+# チャンクの中は列ごとに連続したバイト列 (8バイト境界に揃える) で、圧縮する設定なら列ごとに zlib で圧縮する。
+# 索引ファイルにはチャンクごとの位置と最初・最後の時刻を固定長で並べ、起動時に読み込んで二分探索する。
+# 範囲の問い合わせではデータファイルを mmap し、該当するチャンクの列を memoryview でそのまま (コピーせずに) 返すので、
+# 何か月分あっても読むのは範囲に含まれるチャンクだけになる。
+# 1列目は時刻 (UNIX時刻の double) で、時刻の順に追加する。バイト順は書いたマシンと同じ (索引の見出しに記録する)。
+
+CHUNK_ROWS = 4096
+INDEX_MAGIC = b"MSA1"
+INDEX_HEADER = struct.Struct('<4sB3x')         # 見出し, バイト順 (0: little, 1: big)
+INDEX_ENTRY = struct.Struct('<QQIIdd')         # データファイル上の位置, 長さ, 行数, 圧縮フラグ, 最初の時刻, 最後の時刻
+ALIGNMENT = 8
+
+# 記録する列 (列名, array の型コード)
+TH_COLUMNS = [("ts", "d"), ("temperature", "h"), ("humidity", "B")] # 温度は0.1℃単位
+MD_COLUMNS = [("ts", "d"), ("presence", "B")]
+ARCHIVE_DIR_NAME = 'room_archive' # 部屋のアーカイブを置く既定のディレクトリ
+
+def padded(length):
+    return -(-length // ALIGNMENT) * ALIGNMENT
+
+class SampleArchive:
+    def __init__(self, directory, name, columns, compress=False, chunk_rows=CHUNK_ROWS):
+        self.columns = columns
+        self.compress = compress
+        self.chunk_rows = chunk_rows
+        self.data_path = os.path.join(directory, f"{name}.dat")
+        self.index_path = os.path.join(directory, f"{name}.idx")
+        self.buffer = {column: array(typecode) for column, typecode in columns}
+        self.chunks = []   # [(位置, 長さ, 行数, 圧縮フラグ, 最初の時刻, 最後の時刻), ...]
+        self.chunk_starts = [] # 二分探索用の最初の時刻
+        self.chunk_ends = []   # 二分探索用の最後の時刻 (時刻の順に追加するので単調に増える)
+        self.map = None
+        self.mapped_size = 0
+        self.appended = mesh_metrics.counter(f"archive.{name}.samples")
+        self.flushed_chunks = mesh_metrics.counter(f"archive.{name}.chunks")
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+        self.data_file = open(self.data_path, 'ab')
+        self.index_file = open(self.index_path, 'ab')
+        if self.index_file.tell() == 0:
+            self.index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, 1 if sys.byteorder == 'big' else 0))
+
+    def _load_index(self):
+        # 索引を読み込み、途中で止まって書きかけになった末尾を切り詰める
+        # (索引だけ書けてデータがないチャンク、途中までの索引、索引のないデータ)。
+        # 切り詰めずに書き足すと、後のチャンクの索引がずれたり、古い索引が新しいデータを指したりする
+        data_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        index_size = 0
+        data_end = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            if len(data) >= INDEX_HEADER.size:
+                magic, byteorder = INDEX_HEADER.unpack_from(data)
+                if magic != INDEX_MAGIC or byteorder != (1 if sys.byteorder == 'big' else 0):
+                    raise ValueError(f"このマシンでは読めないアーカイブです: {self.index_path}")
+                index_size = INDEX_HEADER.size
+                for entry in INDEX_ENTRY.iter_unpack(data[INDEX_HEADER.size:len(data) - (len(data) - INDEX_HEADER.size) % INDEX_ENTRY.size]):
+                    if entry[0] != data_end or entry[0] + entry[1] > data_size:
+                        break # 索引だけ書けてデータが書けなかったチャンク
+                    self._add_chunk(entry)
+                    index_size += INDEX_ENTRY.size
+                    data_end = entry[0] + entry[1]
+            if len(data) > index_size:
+                os.truncate(self.index_path, index_size)
+        if data_size > data_end:
+            os.truncate(self.data_path, data_end)
+
+    def _add_chunk(self, entry):
+        self.chunks.append(entry)
+        self.chunk_starts.append(entry[4])
+        self.chunk_ends.append(entry[5])
+
+    def append(self, *values):
+        # 列の順に1行を追加する (1列目は時刻)
+        for (column, _), value in zip(self.columns, values):
+            self.buffer[column].append(value)
+        self.appended.inc()
+        if len(self.buffer["ts"]) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        # 溜まっている行を1つのチャンクとして書く (行数が CHUNK_ROWS に満たなくても書く)
+        timestamps = self.buffer["ts"]
+        rows = len(timestamps)
+        if not rows:
+            return
+        parts = []
+        for column, _ in self.columns:
+            data = self.buffer[column].tobytes()
+            if self.compress:
+                data = zlib.compress(data, 1)
+                parts.append(struct.pack('<I', len(data)) + data)
+            else:
+                parts.append(data + bytes(padded(len(data)) - len(data)))
+        body = b"".join(parts)
+        offset = self.data_file.tell()
+        self.data_file.write(body)
+        self.data_file.flush()
+        entry = (offset, len(body), rows, 1 if self.compress else 0, timestamps[0], timestamps[-1])
+        self.index_file.write(INDEX_ENTRY.pack(*entry))
+        self.index_file.flush()
+        self._add_chunk(entry)
+        self.flushed_chunks.inc()
+        self.buffer = {column: array(typecode) for column, typecode in self.columns}
+
+    def close(self):
+        self.flush()
+        self.data_file.close()
+        self.index_file.close()
+        if self.map:
+            try:
+                self.map.close()
+            except BufferError:
+                pass
+            self.map = None
+
+    def _mapped(self):
+        # データファイルを mmap する (書き足されていたら張り直す)
+        size = self.data_file.tell()
+        if self.map is None or self.mapped_size != size:
+            if self.map:
+                try:
+                    self.map.close()
+                except BufferError:
+                    pass # 返した memoryview がまだ使われている (参照がなくなれば閉じられる)
+            with open(self.data_path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped_size = size
+        return self.map
+
+    def _chunk_columns(self, entry):
+        # チャンクの列ごとの memoryview {列名: memoryview}
+        offset, length, rows, compressed, _, _ = entry
+        view = memoryview(self._mapped())[offset:offset + length]
+        columns = {}
+        position = 0
+        for column, typecode in self.columns:
+            size = rows * array(typecode).itemsize
+            if compressed:
+                (compressed_size,) = struct.unpack_from('<I', view, position)
+                data = zlib.decompress(view[position + 4:position + 4 + compressed_size])
+                columns[column] = memoryview(data).cast(typecode)
+                position += 4 + compressed_size
+            else:
+                columns[column] = view[position:position + size].cast(typecode)
+                position += padded(size)
+        return columns
+
+    def query(self, start, end, columns=None):
+        # [start, end) の行を、チャンクごとに {列名: memoryview} で順に返す
+        # 返した memoryview は次に書き足すまで (mmap を張り直すまで) 使える
+        names = columns or [column for column, _ in self.columns]
+        first = bisect.bisect_left(self.chunk_ends, start)
+        last = bisect.bisect_left(self.chunk_starts, end)
+        for entry in self.chunks[first:last]:
+            chunk = self._chunk_columns(entry)
+            timestamps = chunk["ts"]
+            low = 0 if entry[4] >= start else bisect.bisect_left(timestamps, start)
+            high = len(timestamps) if entry[5] < end else bisect.bisect_left(timestamps, end)
+            if low < high:
+                yield {name: chunk[name][low:high] for name in names}
+        # まだ書いていない行 (追加できなくならないよう、コピーを返す)
+        timestamps = self.buffer["ts"]
+        low = bisect.bisect_left(timestamps, start)
+        high = bisect.bisect_left(timestamps, end)
+        if low < high:
+            yield {name: self.buffer[name][low:high] for name in names}
+
+    def count(self, start, end):
+        return sum(len(chunk["ts"]) for chunk in self.query(start, end, ["ts"]))
+
+    def mean(self, column, start, end):
+        # [start, end) の column の平均 (行がなければ None)
+        total = 0
+        rows = 0
+        for chunk in self.query(start, end, [column]):
+            total += sum(chunk[column])
+            rows += len(chunk[column])
+        return total / rows if rows else None
+
+def open_room_archives(directory, compress=False):
+    # 温湿度と人感のアーカイブ
+    return (SampleArchive(directory, "th", TH_COLUMNS, compress),
+            SampleArchive(directory, "md", MD_COLUMNS, compress))
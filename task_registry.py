@@ -0,0 +1,69 @@
+import asyncio
+
+import event_log
+import mesh_metrics
+
+# フェーズごとのタスク管理
+# フェーズの中で作るタスクは scope.spawn() で作り、フェーズを抜けるときに
+# 終わっていないタスク (押されなかったボタンの待ち合わせなど) をキャンセルして回収する。
+# 取り残されたタスクが後のフェーズのボタン入力を横取りしないようにするため。
+# trace=True にすると、タスクの名前・数・所要時間と取り残しをフェーズごとに表示する。
+
+log = event_log.get("task")
+
+class TaskRegistry:
+    def __init__(self, name, trace=False):
+        self.name = name
+        self.trace = trace
+        self.live = set()
+        self.spawned = mesh_metrics.counter(f"{name}.tasks.spawned")
+        self.stragglers = mesh_metrics.counter(f"{name}.tasks.stragglers")
+        self.durations = mesh_metrics.histogram(f"{name}.tasks.duration_ms")
+        mesh_metrics.gauge(f"{name}.tasks.live", lambda: len(self.live))
+
+    def phase(self, phase_name):
+        return PhaseScope(self, phase_name)
+
+class PhaseScope:
+    def __init__(self, registry, phase_name):
+        self.registry = registry
+        self.phase_name = phase_name
+        self.tasks = {} # {task: 開始時刻}
+
+    def spawn(self, coro, name):
+        # 名前付きでタスクを作り、フェーズの終わりまで追跡する
+        loop = asyncio.get_running_loop()
+        task = asyncio.create_task(coro, name=f"{self.registry.name}/{self.phase_name}/{name}")
+        self.tasks[task] = loop.time()
+        self.registry.live.add(task)
+        self.registry.spawned.inc()
+        task.add_done_callback(self._on_done)
+        return task
+
+    def _on_done(self, task):
+        self.registry.live.discard(task)
+        started = self.tasks.get(task)
+        if started is not None:
+            elapsed_ms = (asyncio.get_running_loop().time() - started) * 1000
+            self.registry.durations.record(elapsed_ms)
+            if self.registry.trace:
+                state = "cancelled" if task.cancelled() else "done"
+                log.info("[task] %s %s (%.0fms)", task.get_name(), state, elapsed_ms)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        stragglers = [task for task in self.tasks if not task.done()]
+        if stragglers:
+            self.registry.stragglers.inc(len(stragglers))
+            if self.registry.trace:
+                names = ", ".join(task.get_name() for task in stragglers)
+                log.info("[task] %s: 終わっていないタスクをキャンセルします: %s", self.phase_name, names)
+            for task in stragglers:
+                task.cancel()
+            await asyncio.gather(*stragglers, return_exceptions=True)
+        if self.registry.trace:
+            log.info("[task] %s: %d個のタスクを使用, 取り残し%d個, 実行中 %d個",
+                     self.phase_name, len(self.tasks), len(stragglers), len(self.registry.live))
+        return False
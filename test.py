@@ -1,7 +1,14 @@
+import argparse
 import asyncio
+import json
+import random
+import statistics
 import time
-from bleak import BleakClient, BleakScanner
+from bleak import BleakClient
 from collections import Counter
+from struct import pack
+from mesh_advert import discover_blocks
+from mesh_broker import SOCKET_PATH, BrokerClient
 
 # UUID
 CORE_INDICATE_UUID = ('72c90005-57a9-4d40-b746-534e22ec9f9e')
@@ -38,6 +45,18 @@ TEST_BUTTON_SN = "1029369"
 TEST_GPIO_SN = "1050119" 
 TEST_MOTION_SN = "1029724"
 
+# 自動セルフテストの設定
+SELFTEST_PROBES = 20           # ブロックごとの往復計測の回数
+SELFTEST_PROBE_TIMEOUT = 1.0   # 応答 (Indicate) を待つ秒数。超えたら損失として数える
+SELFTEST_DRAIN_SECONDS = 1.0   # 損失のあと次の計測までこの秒数待ち、遅れて届いた応答を次の計測の応答と取り違えないようにする
+SELFTEST_CONCURRENCY = 4       # 同時に接続・計測するブロック数
+SELFTEST_REPORT_FILE = "selftest_report.json"
+SLOW_CONNECT_MS = 5000         # これより接続に時間がかかるブロックは slow
+SLOW_RTT_MS = 150              # 書き込み往復・通知遅延のp99がこれを超えるブロックは slow
+FLAKY_LOSS_RATE = 0.05         # 応答の損失率がこれを超えるブロックは flaky
+# 機能有効化コマンド。ブロックはIndicateでブロック情報を返すので、往復の計測に使う
+PROBE_COMMAND = pack('<BBBB', 0x00, 0x02, 0x01, 0x03)
+
 # グローバル変数 (テストの状態を管理)
 test_clients = {
     "led": None,
@@ -46,6 +65,8 @@ test_clients = {
     "motion": None
 }
 
+broker = None # ブローカー経由でテストするときの BrokerClient (None なら直接接続する)
+
 # 通知イベントキュー
 button_event_queue = asyncio.Queue()
 motion_orientation_event_queue = asyncio.Queue()
@@ -53,7 +74,11 @@ motion_orientation_event_queue = asyncio.Queue()
 # ヘルパー関数
 async def connect_to_mesh_block(address, block_id):
     try:
-        client = BleakClient(address)
+        if broker:
+            # ブローカーが接続を持っているので、address にはシリアルナンバーが入っている
+            client = broker.block(address)
+        else:
+            client = BleakClient(address)
         print(f"Connecting to {block_id} ({address})...")
         await client.connect()
         print(f"Connected to {block_id}!")
@@ -202,24 +227,22 @@ async def test_motion_block(motion_client):
 
     print("動きブロックテスト完了。")
 
-async def main():
-    global test_clients
+async def main(broker_path=None):
+    # broker_path: mesh_broker のソケット。指定するとスキャン・接続をせずにブローカーの接続を使う
+    global test_clients, broker
     
-    print("MESHブロックをスキャン中...")
-    devices = await BleakScanner.discover(timeout=60.0)
+    if broker_path:
+        print(f"MESHブローカーに接続中... ({broker_path})")
+        broker = await BrokerClient.connect(broker_path)
+        blocks = await broker.discover_blocks([TEST_LED_SN, TEST_BUTTON_SN, TEST_GPIO_SN, TEST_MOTION_SN])
+    else:
+        print("MESHブロックをスキャン中...")
+        blocks = await discover_blocks(timeout=60.0)
     
     discovered_mesh_devices_by_sn_suffix = {}
-    for d in devices:
-        if d.name and d.name.startswith("MESH-"):
-            sn_suffix = None
-            if 'U' in d.name: sn_suffix = d.name[d.name.rfind('U')+1:]
-            elif 'E' in d.name: sn_suffix = d.name[d.name.rfind('E')+1:]
-            elif 'C' in d.name: sn_suffix = d.name[d.name.rfind('C')+1:]
-            elif 'P' in d.name: sn_suffix = d.name[d.name.rfind('P')+1:]
-            
-            if sn_suffix:
-                discovered_mesh_devices_by_sn_suffix[sn_suffix] = d
-                print(f" - {d.name} -> シリアルナンバー識別子: {sn_suffix}")
+    for sn_suffix, (block_type, d, adv) in blocks.items():
+        discovered_mesh_devices_by_sn_suffix[sn_suffix] = d
+        print(f" - {d.name} -> シリアルナンバー識別子: {sn_suffix}")
 
     print("\nテスト対象ブロックに接続中...")
     
@@ -277,7 +300,177 @@ async def main():
         for client in test_clients.values():
             if client and client.is_connected:
                 await client.disconnect()
+        if broker:
+            await broker.close()
         print("切断完了。")
 
+# 自動セルフテスト
+# 人の操作なしで多数のブロックを並列に確認し、接続時間・書き込み往復・通知遅延・損失率を計測する
+class SimulatedAdapter:
+    # 実機の代わりに使う模擬アダプタ (ブロックごとの遅延と損失率をランダムに決める)
+    def __init__(self, block_count, seed=0):
+        self.rng = random.Random(seed)
+        self.blocks = []
+        kinds = ["LE", "BU", "AC", "GP"]
+        for i in range(block_count):
+            name = f"MESH-100{kinds[i % len(kinds)]}{1000000 + i}"
+            flaky = self.rng.random() < 0.1
+            slow = self.rng.random() < 0.1
+            self.blocks.append({
+                "name": name,
+                "address": f"SIM:{i:04d}",
+                "connect_seconds": self.rng.uniform(0.3, 1.5) * (4 if slow else 1),
+                "latency_seconds": self.rng.uniform(0.015, 0.045) * (6 if slow else 1),
+                "loss_rate": 0.2 if flaky else 0.0,
+            })
+
+    def client_for(self, block):
+        return SimulatedMeshClient(block, self.rng)
+
+class SimulatedMeshClient:
+    def __init__(self, block, rng):
+        self.block = block
+        self.rng = rng
+        self.address = block["address"]
+        self.is_connected = False
+        self.handlers = {}
+
+    async def connect(self):
+        await asyncio.sleep(self.block["connect_seconds"])
+        self.is_connected = True
+
+    async def disconnect(self):
+        self.is_connected = False
+
+    async def start_notify(self, char_uuid, handler):
+        self.handlers[char_uuid] = handler
+
+    async def stop_notify(self, char_uuid):
+        self.handlers.pop(char_uuid, None)
+
+    async def write_gatt_char(self, char_uuid, data, response=False):
+        latency = self.block["latency_seconds"] * self.rng.uniform(0.8, 1.5)
+        await asyncio.sleep(latency)
+        handler = self.handlers.get(CORE_INDICATE_UUID)
+        if bytes(data) == PROBE_COMMAND and handler and self.rng.random() >= self.block["loss_rate"]:
+            loop = asyncio.get_running_loop()
+            loop.call_later(latency / 2, handler, CORE_INDICATE_UUID, bytearray(b"\x00\x02\x01\x03"))
+
+def summarize_ms(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return {
+        "p50": round(statistics.median(ordered), 2),
+        "p99": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 2),
+        "max": round(ordered[-1], 2),
+    }
+
+async def selftest_block(name, address, client, semaphore, probes=SELFTEST_PROBES):
+    # 1台のブロックを計測して結果の辞書を返す
+    result = {"name": name, "address": address, "connect_ms": None, "write_rtt_ms": None,
+              "notify_latency_ms": None, "loss_rate": None, "late_indications": 0, "errors": [], "flags": []}
+    async with semaphore:
+        loop = asyncio.get_running_loop()
+        pending = [] # 応答待ちの計測 (1回に1つだけ)
+
+        def on_indicate(sender, data):
+            # 応答には計測の番号がないので、待っている計測がないときに届いたものは時間切れの後の遅れた応答として捨てる
+            if not pending or pending[0][1].done():
+                result["late_indications"] += 1
+                return
+            sent_at, future = pending.pop(0)
+            future.set_result(loop.time() - sent_at)
+
+        try:
+            started = loop.time()
+            await client.connect()
+            result["connect_ms"] = round((loop.time() - started) * 1000, 1)
+            await client.start_notify(CORE_INDICATE_UUID, on_indicate)
+
+            write_rtts = []
+            notify_latencies = []
+            lost = 0
+            for _ in range(probes):
+                future = loop.create_future()
+                sent_at = loop.time()
+                pending.append((sent_at, future))
+                await client.write_gatt_char(CORE_WRITE_UUID, PROBE_COMMAND, response=True)
+                write_rtts.append((loop.time() - sent_at) * 1000)
+                try:
+                    notify_latencies.append(await asyncio.wait_for(future, SELFTEST_PROBE_TIMEOUT) * 1000)
+                except asyncio.TimeoutError:
+                    lost += 1
+                    pending.clear()
+                    # 遅れて届く応答はここで捨てる (次の計測の応答として数えると遅延を少なく、損失を隠してしまう)
+                    await asyncio.sleep(SELFTEST_DRAIN_SECONDS)
+            result["write_rtt_ms"] = summarize_ms(write_rtts)
+            result["notify_latency_ms"] = summarize_ms(notify_latencies)
+            result["loss_rate"] = round(lost / probes, 3)
+        except Exception as e:
+            result["errors"].append(str(e))
+        finally:
+            if client.is_connected:
+                try:
+                    await client.disconnect()
+                except Exception as e:
+                    result["errors"].append(f"disconnect: {e}")
+
+    if result["errors"] or result["connect_ms"] is None:
+        result["flags"].append("failed")
+    if result["connect_ms"] is not None and result["connect_ms"] > SLOW_CONNECT_MS:
+        result["flags"].append("slow")
+    for key in ("write_rtt_ms", "notify_latency_ms"):
+        if result[key] and result[key]["p99"] > SLOW_RTT_MS and "slow" not in result["flags"]:
+            result["flags"].append("slow")
+    if result["loss_rate"] is not None and result["loss_rate"] > FLAKY_LOSS_RATE:
+        result["flags"].append("flaky")
+    flags = ", ".join(result["flags"]) or "OK"
+    print(f" - {name}: 接続 {result['connect_ms']}ms, 損失率 {result['loss_rate']}, 判定 {flags}")
+    return result
+
+async def run_selftest(report_path=SELFTEST_REPORT_FILE, simulate=0, scan_timeout=10.0):
+    # 見つかった全てのMESHブロックを並列に計測し、JSONのレポートを書き出す
+    semaphore = asyncio.Semaphore(SELFTEST_CONCURRENCY)
+    if simulate:
+        adapter = SimulatedAdapter(simulate)
+        targets = [(b["name"], b["address"], adapter.client_for(b)) for b in adapter.blocks]
+        print(f"模擬アダプタで{len(targets)}台のブロックをセルフテストします...")
+    else:
+        print("MESHブロックをスキャン中...")
+        blocks = await discover_blocks(timeout=scan_timeout)
+        targets = [(d.name, d.address, BleakClient(d.address)) for block_type, d, adv in blocks.values()]
+        print(f"{len(targets)}台のブロックをセルフテストします...")
+
+    started = time.time()
+    results = await asyncio.gather(*[selftest_block(name, address, client, semaphore)
+                                     for name, address, client in targets])
+    report = {
+        "generated_at": time.strftime('%Y-%m-%d %H:%M:%S'),
+        "simulated": bool(simulate),
+        "elapsed_seconds": round(time.time() - started, 2),
+        "thresholds": {"slow_connect_ms": SLOW_CONNECT_MS, "slow_rtt_ms": SLOW_RTT_MS,
+                       "flaky_loss_rate": FLAKY_LOSS_RATE},
+        "blocks": results,
+    }
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    flagged = [r for r in results if r["flags"]]
+    print(f"\nセルフテスト完了 ({report['elapsed_seconds']}秒): {len(results)}台中 {len(flagged)}台に問題があります。")
+    print(f"レポート: {report_path}")
+    return report
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="MESHブロックのテスト")
+    parser.add_argument("--selftest", action="store_true", help="人の操作なしで全ブロックを並列に計測する")
+    parser.add_argument("--simulate", type=int, default=0, metavar="N", help="実機の代わりにN台の模擬ブロックでセルフテストする")
+    parser.add_argument("--report", default=SELFTEST_REPORT_FILE, help="セルフテストのレポートの出力先 (JSON)")
+    parser.add_argument("--broker", nargs="?", const=SOCKET_PATH, metavar="SOCKET",
+                        help="mesh_broker デーモンの接続を使う (対話テストのみ。セルフテストは接続時間を計るため直接接続する)")
+    args = parser.parse_args()
+    if args.selftest or args.simulate:
+        if args.broker:
+            parser.error("セルフテストは接続そのものを計測するため、--broker とは一緒に使えません")
+        asyncio.run(run_selftest(args.report, args.simulate))
+    else:
+        asyncio.run(main(args.broker))
\ No newline at end of file
@@ -1,8 +1,9 @@
 import asyncio
 import time
-from bleak import BleakClient, BleakScanner, discover
+from bleak import BleakClient, BleakScanner
 from collections import Counter
 from struct import pack
+from mesh_advert import find_block
 
 # MESHブロックの共通サービスUUIDと特性UUID
 # 全てのMESHブロックが持つ共通サービスUUID
@@ -87,12 +88,9 @@ def on_receive_indicate(sender, data: bytearray):
     print('[indicate] ',data)
 
 async def scan(prefix):
-    while True:
-        print('scan...')
-        try:
-            return next(d for d in await discover() if d.name and d.name.startswith(prefix))
-        except StopIteration:
-            continue
+    # 共有スキャナで見つかるまで待つ (他のコルーチンの待ちとスキャンを共有する)
+    print('scan...')
+    return await find_block(prefix)
 
 async def main():
     # Scan device